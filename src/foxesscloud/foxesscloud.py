@@ -65,6 +65,15 @@ def plot_show():
 ##################################################################################################
 ##################################################################################################
 
+# fast parse of date / time string 'YYYY-MM-DD HH:MM:SS', falls back to strptime for other formats
+def parse_date(d):
+    if len(d) == 19 and d[4] == '-' and d[7] == '-' and d[10] == ' ' and d[13] == ':' and d[16] == ':':
+        try:
+            return datetime(int(d[0:4]), int(d[5:7]), int(d[8:10]), int(d[11:13]), int(d[14:16]), int(d[17:19]))
+        except ValueError:
+            pass
+    return datetime.strptime(d, "%Y-%m-%d %H:%M:%S")
+
 def convert_date(d):
     if d is not None and len(d) < 18:
         if len(d) == 10:
@@ -74,7 +83,7 @@ def convert_date(d):
         else:
             d += ':00'
     try:
-        t = datetime.now() if d is None else datetime.strptime(d, "%Y-%m-%d %H:%M:%S")
+        t = datetime.now() if d is None else parse_date(d)
     except Exception as e:
         output(f"** convert_date(): {str(e)}")
         return None
@@ -2162,6 +2171,9 @@ def split_hours(h):
     minutes = int (h % 1 * 60 + 0.5)
     return (hours, minutes)
 
+# cache of decimal hours for time strings HH:MM or HH:MM:SS that have been converted
+time_cache = {}
+
 # convert time string HH:MM:SS to decimal hours (range 0 to 24)
 # If BST time zone is included, convert to GMT (range -1 to 23)
 def time_hours(t, d = None):
@@ -2175,12 +2187,21 @@ def time_hours(t, d = None):
         return float(t)
     offset = 1 if 'BST' in t else 0
     t = t[0:8]
+    h = time_cache.get(t)
+    if h is not None:
+        return h - offset
     if type(t) is str and t.replace(':', '').isnumeric() and t.count(':') <= 2:
+        key = t
         t += ':00' if t.count(':') == 1 else ''
-        return sum(float(t) / x for x, t in zip([1, 60, 3600], t.split(":"))) - offset
+        h = sum(float(t) / x for x, t in zip([1, 60, 3600], t.split(":")))
+        time_cache[key] = h
+        return h - offset
     output(f"** invalid time string {t}")
     return None
 
+# time strings HH:MM for each 15 minute slot, covers 30 minute and 1 hour time lines
+time_labels = [f"{i // 4:02}:{i % 4 * 15:02}" for i in range(0, 96)]
+
 # convert decimal hours to time string HH:MM:SS
 def hours_time(h, ss = False, day = False, mm = True):
     if h is None:
@@ -2198,6 +2219,8 @@ def hours_time(h, ss = False, day = False, mm = True):
     suffix = ""
     if day:
         suffix = f"/{d:0}"
+    if n == 5 and h * 4 % 1 == 0:
+        return time_labels[int(h * 4)] + suffix
     return f"{int(h):02}:{int(h * 60 % 60):02}:{int(h * 3600 % 60):02}"[:n] + suffix
 
 # True if a decimal hour falls within a time period
@@ -28,6 +28,12 @@ import requests
 from requests.auth import HTTPBasicAuth
 import hashlib
 import math
+import random
+import bisect
+import array
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import matplotlib.pyplot as plt
 
 fox_domain = "https://www.foxesscloud.com"
@@ -66,6 +72,15 @@ def plot_show():
 ##################################################################################################
 ##################################################################################################
 
+# fast parse of date / time string 'YYYY-MM-DD HH:MM:SS', falls back to strptime for other formats
+def parse_date(d):
+    if len(d) == 19 and d[4] == '-' and d[7] == '-' and d[10] == ' ' and d[13] == ':' and d[16] == ':':
+        try:
+            return datetime(int(d[0:4]), int(d[5:7]), int(d[8:10]), int(d[11:13]), int(d[14:16]), int(d[17:19]))
+        except ValueError:
+            pass
+    return datetime.strptime(d, "%Y-%m-%d %H:%M:%S")
+
 def convert_date(d):
     if d is not None and len(d) < 18:
         if len(d) == 10:
@@ -75,12 +90,21 @@ def convert_date(d):
         else:
             d += ':00'
     try:
-        t = datetime.now() if d is None else datetime.strptime(d, "%Y-%m-%d %H:%M:%S")
+        t = datetime.now() if d is None else parse_date(d)
     except Exception as e:
         output(f"** convert_date(): {str(e)}")
         return None
     return t
 
+# return a datetime in UTC for a date / time string or datetime. Strings and naive datetimes are UTC
+def utc_date(d=None):
+    if d is None:
+        return datetime.now(tz=timezone.utc)
+    t = convert_date(d) if type(d) is str else d
+    if t is None or t.tzinfo is not None:
+        return t
+    return t.replace(tzinfo=timezone.utc)
+
 # return query date as a dictionary with year, month, day, hour, minute, second
 def query_date(d, offset = None):
     t = convert_date(d)
@@ -135,6 +159,7 @@ response_time = {}      # response time in seconds of the last call for a given
 query_delay = 1         # minimum time between calls in seconds
 http_timeout = 55       # http request timeout in seconds
 http_tries = 2          # number of times to re-try requst
+call_lock = threading.Lock()    # serialise throttling when queries run in parallel
 
 class MockResponse:
     def __init__(self, status_code, reason):
@@ -146,14 +171,15 @@ def signed_header(path, login = 0):
     global api_key, user_agent, time_zone, lang, debug_setting, last_call, query_delay
     headers = {}
     token = api_key if login == 0 else ""
-    t_now = time.time()
-    if 'query' in path:
-        t_last = last_call.get(path)
-        delta = t_now - t_last if t_last is not None else query_delay
-        if delta < query_delay:
-            time.sleep((query_delay - delta))
+    with call_lock:
+        # reserve the next time slot for this path so parallel queries stay query_delay apart
         t_now = time.time()
-    last_call[path] = t_now
+        t_last = last_call.get(path) if 'query' in path else None
+        t_slot = t_last + query_delay if t_last is not None and t_now - t_last < query_delay else t_now
+        last_call[path] = t_slot
+    if t_slot > t_now:
+        time.sleep(t_slot - t_now)
+    t_now = time.time()
     timestamp = str(round(t_now * 1000))
     headers['Token'] = token
     headers['Lang'] = lang
@@ -1195,6 +1221,8 @@ def set_modbus(register, value, slave=None, function=None, timeout=None):
 
 schedule = None
 max_periods = 8
+schedule_reconcile = 1          # 1 = set_schedule() only sends the periods and flag if they are different to the inverter
+schedule_age = 600              # seconds before the schedule cached for set_schedule() is read again
 
 # get the current switch status
 def get_flag():
@@ -1260,6 +1288,9 @@ def get_schedule(filter=1):
         enable = True if enable == 1 else False
     schedule['enable'] = enable
     schedule['periods'] = []
+    # keep all groups for set_schedule() to compare with
+    schedule['groups'] = [g for g in result['groups'] if g.get('enable') is None or g['enable'] == 1]
+    schedule['read'] = time.time()
     # remove invalid work mode from periods
     for g in result['groups']:
         if g['workMode'] in work_modes:
@@ -1269,6 +1300,35 @@ def get_schedule(filter=1):
                 schedule['periods'].append(g)
     return schedule
 
+# normalise a period from get_schedule() or set_period() so the same settings compare as equal
+# keys: optional list of the parameters to compare. The inverter returns every parameter, so use the keys sent by set_period()
+def schedule_key(period, keys=None):
+    times = ['startHour', 'startMinute', 'endHour', 'endMinute']
+    extra = {k: v for k, v in period.items() if k not in times + ['workMode', 'isRemainMode', 'enable', 'extraParam']}
+    if period.get('extraParam') is not None:
+        extra.update(period['extraParam'])
+    params = sorted((k, round(float(v), 3) if type(v) in [int, float] else v) for k, v in extra.items() if v is not None and (keys is None or k in keys))
+    return json.dumps([[int(period[k]) for k in times], period['workMode'], params])
+
+# True if the groups on the inverter match the periods from set_period(), comparing only the parameters that were set
+def schedule_match(current, periods):
+    times = lambda g: [int(g[k]) for k in ['startHour', 'startMinute', 'endHour', 'endMinute']]
+    if len(current) != len(periods):
+        return False
+    for (g, p) in zip(sorted(current, key=times), sorted(periods, key=times)):
+        keys = [k for k in p.keys() if k not in ['extraParam', 'isRemainMode']] + list((p.get('extraParam') or {}).keys())
+        if schedule_key(g, keys) != schedule_key(p, keys):
+            return False
+    return True
+
+# return the groups set on the inverter, reading the schedule if the cached copy is older than schedule_age
+def get_schedule_groups():
+    global schedule, schedule_age
+    if schedule is None or schedule.get('groups') is None or schedule.get('read') is None or time.time() - schedule['read'] > schedule_age:
+        if get_schedule() is None:
+            return None
+    return schedule.get('groups')
+
 # build strategy using current schedule
 def build_strategy_from_schedule():
     schedule = get_schedule()
@@ -1370,7 +1430,7 @@ def set_period(start=None, end=None, mode=None, min_soc=None, max_soc=None, fdso
 
 # set a schedule from a period or list of time segment periods
 def set_schedule(periods=None, enable=True, is_default=False):
-    global device_sn, debug_setting, schedule, max_periods
+    global device_sn, debug_setting, schedule, max_periods, schedule_reconcile
     if get_flag() is None:
         return None
     if schedule.get('support') == False:
@@ -1382,16 +1442,28 @@ def set_schedule(periods=None, enable=True, is_default=False):
         return None
     if type(enable) is int:
         enable = True if enable == 1 else False
-    if enable:
-        output(f"\nEnabling schedule", 1)
-    else:
-        output(f"\nDisabling schedule", 1)
+    groups = None
     if periods is not None:
         if type(periods) is not list:
             periods = [periods]
         if len(periods) > max_periods:
             output(f"** set_schedule(): maximum of {max_periods} periods allowed, {len(periods)} provided")
-        body = {'deviceSN': device_sn, 'isDefault': is_default, 'groups': periods[-max_periods:]}
+        groups = periods[-max_periods:]
+    # skip the groups and flag if they are the same as the inverter. The flag is always sent after the groups
+    if schedule_reconcile == 1:
+        current = get_schedule_groups() if groups is not None and not is_default else None
+        if current is not None and schedule_match(current, groups):
+            output(f"Schedule periods are unchanged", 2)
+            groups = None
+        if groups is None and (schedule.get('enable') == True) == enable:
+            output(f"\nSchedule is unchanged")
+            return schedule
+    if enable:
+        output(f"\nEnabling schedule", 1)
+    else:
+        output(f"\nDisabling schedule", 1)
+    if groups is not None:
+        body = {'deviceSN': device_sn, 'isDefault': is_default, 'groups': groups}
         setting_delay()
         response = signed_post(path="/op/v3/device/scheduler/enable", body=body)
         if response.status_code != 200:
@@ -1402,6 +1474,8 @@ def set_schedule(periods=None, enable=True, is_default=False):
             output(f"** set_schedule(), enable, {errno_message(response)}")
             return None
         schedule['periods'] = periods
+        schedule['groups'] = groups
+        schedule['read'] = time.time()
     body = {'deviceSN': device_sn, 'enable': 1 if enable else 0}
     setting_delay()
     response = signed_post(path="/op/v1/device/scheduler/set/flag", body=body)
@@ -1471,6 +1545,154 @@ def get_real(v = None, sns = None, version = 0):
     return result
 
 
+##################################################################################################
+# compact files for saving and loading history and report data
+##################################################################################################
+# save_format = 'json': save results as formatted JSON text (.txt)
+# save_format = 'compact': save results as compressed columns (.fxc):
+#   b'FXC1', header length (4 bytes), zlib compressed JSON header, zlib compressed blocks
+# The header holds the attributes of each variable and the offset / length of its blocks:
+#   time: seconds from midnight on the 'base' date (int32), with a table of time zone suffixes
+#   zone: index into the table of time zone suffixes for each sample (uint8)
+#   value: float64 values with NaN for missing values
+# Files are read in one call and every block is decompressed, so memory mapping would not save any reads.
+# Legacy JSON files are detected and loaded as before.
+##################################################################################################
+
+save_format = 'json'
+compact_magic = b'FXC1'
+
+# return the extension to use for saved files
+def save_extension():
+    global save_format
+    return '.fxc' if save_format == 'compact' else '.txt'
+
+# convert a sample time string to (days since base, seconds in day, zone suffix)
+def compact_time(s, base_ordinal):
+    ordinal = datetime(int(s[0:4]), int(s[5:7]), int(s[8:10])).toordinal()
+    seconds = int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19])
+    return ((ordinal - base_ordinal) * 86400 + seconds, s[19:])
+
+# pack a list of numbers (None -> NaN) into a compressed float64 block
+def compact_values(values):
+    block = array.array('d', [float('nan') if x is None else x for x in values])
+    return zlib.compress(block.tobytes())
+
+def save_compact(file_name, result):
+    global storage
+    header = {'vars': []}
+    blocks = []
+    offset = 0
+    def add_block(data):
+        nonlocal offset
+        blocks.append(data)
+        offset += len(data)
+        return [offset - len(data), len(data)]
+    for var in result:
+        meta = {k: var[k] for k in var.keys() if k not in ['data', 'values']}
+        item = {'meta': meta}
+        samples = var.get('data')
+        values = [y.get('value') for y in samples] if samples is not None else var.get('values')
+        if values is not None and len([x for x in values if x is not None and type(x) not in (int, float)]) > 0:
+            # non-numeric values are kept in the header
+            item['raw'] = samples if samples is not None else values
+        elif samples is not None:
+            base = samples[0]['time'][:10] if len(samples) > 0 else None
+            base_ordinal = datetime.strptime(base, "%Y-%m-%d").toordinal() if base is not None else 0
+            zones = []
+            times = array.array('i')
+            zone_index = array.array('B')
+            for y in samples:
+                (t, zone) = compact_time(y['time'], base_ordinal)
+                if zone not in zones:
+                    zones.append(zone)
+                times.append(t)
+                zone_index.append(zones.index(zone))
+            item['base'] = base
+            item['zones'] = zones
+            item['n'] = len(samples)
+            item['time'] = add_block(zlib.compress(times.tobytes()))
+            item['zone'] = add_block(zlib.compress(zone_index.tobytes()))
+            item['value'] = add_block(compact_values(values))
+        elif values is not None:
+            item['n'] = len(values)
+            item['values'] = add_block(compact_values(values))
+        header['vars'].append(item)
+    header = zlib.compress(json.dumps(header, ensure_ascii=False).encode('utf-8'))
+    file = open(storage + file_name, 'wb')
+    file.write(compact_magic + len(header).to_bytes(4, 'little') + header)
+    for data in blocks:
+        file.write(data)
+    file.close()
+    return file_name
+
+# load a compact file as columns: list of (meta, columns) where columns holds arrays
+def load_compact(file_name):
+    global storage
+    with open(storage + file_name, 'rb') as file:
+        data = file.read()
+    if data[0:4] != compact_magic:
+        return None
+    n = int.from_bytes(data[4:8], 'little')
+    header = json.loads(zlib.decompress(data[8:8 + n]).decode('utf-8'))
+    start = 8 + n
+    def get_block(position, code):
+        block = array.array(code)
+        block.frombytes(zlib.decompress(data[start + position[0]: start + position[0] + position[1]]))
+        return block
+    result = []
+    for item in header['vars']:
+        columns = {}
+        for key, code in [('time', 'i'), ('zone', 'B'), ('value', 'd'), ('values', 'd')]:
+            if item.get(key) is not None:
+                columns[key] = get_block(item[key], code)
+        for key in ['base', 'zones', 'raw']:
+            if item.get(key) is not None:
+                columns[key] = item[key]
+        result.append((item['meta'], columns))
+    return result
+
+# rebuild a history time string from compact columns
+def compact_time_string(base, seconds, zone):
+    return (base + timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S") + zone
+
+# load a saved result from a compact file or a legacy JSON file
+def load_result(file_name):
+    global storage
+    file = open(storage + file_name, 'rb')
+    magic = file.read(4)
+    file.close()
+    if magic != compact_magic:
+        file = open(storage + file_name)
+        result = json.load(file)
+        file.close()
+        return result
+    result = []
+    for meta, columns in load_compact(file_name):
+        var = dict(meta)
+        if columns.get('raw') is not None:
+            var['data' if type(columns['raw'][0]) is dict else 'values'] = columns['raw']
+        elif columns.get('time') is not None:
+            base = datetime.strptime(columns['base'], "%Y-%m-%d") if columns.get('base') is not None else None
+            zones = columns['zones']
+            var['data'] = [{'time': compact_time_string(base, t, zones[z]), 'value': None if math.isnan(x) else x}
+                for t, z, x in zip(columns['time'], columns['zone'], columns['value'])]
+        else:
+            var['values'] = [None if math.isnan(x) else x for x in columns['values']]
+        result.append(var)
+    return result
+
+# save a result using save_format
+def save_result(file_name, result):
+    global storage, save_format
+    if save_format == 'compact':
+        return save_compact(file_name, result)
+    file = open(storage + file_name, 'w', encoding='utf-8')
+    json.dump(result, file, indent=4, ensure_ascii= False)
+    file.close()
+    return file_name
+
+
 ##################################################################################################
 # get history data values
 ##################################################################################################
@@ -1493,6 +1715,45 @@ energy_vars = ['output_daily', 'feedin_daily', 'load_daily', 'grid_daily', 'bat_
 sample_time = 5.0       # 5 minutes default
 sample_rounding = 2     # round to 30 seconds
 
+# run a history query for begin / end timestamps in milliseconds and return the list of variables
+def history_query(t_begin, t_end, v=None):
+    global device_sn, var_list
+    body = {'sn': device_sn, 'begin': t_begin, 'end': t_end}
+    if v is not None:
+        if type(v) is not list:
+            v = [v]
+        if var_list is not None and len(var_list) > 0:
+            for var in v:
+                if var not in var_list:
+                    output(f"** get_history(): invalid variable '{var}'")
+                    output(f"var_list = {var_list}")
+                    return None
+        body['variables'] = v
+    response = signed_post(path="/op/v0/device/history/query", body=body)
+    if response.status_code != 200:
+        output(f"** get_history() got response code {response.status_code}: {response.reason}")
+        return None
+    result = response.json().get('result')
+    errno = response.json().get('errno')
+    if errno > 0 or result is None or len(result) == 0:
+        output(f"** get_history(), no data, {errno_message(response)}")
+        return None
+    return result[0].get('datas')
+
+# apply ct2 inversion, residual scaling and default units to a history variable
+def history_fix(var):
+    global invert_ct2, residual_scale
+    if var.get('variable') == 'meterPower2' and invert_ct2 == 1:
+        for y in var['data']:
+            y['value'] = -y['value']
+    elif var['variable'] == 'ResidualEnergy':
+        var['unit'] = 'kWh'
+        for y in var['data']:
+             y['value'] *= residual_scale
+    elif var.get('unit') is None:
+        var['unit'] = ''
+    return var
+
 def get_history(time_span='hour', d=None, v=None, summary=1, save=None, load=None, plot=0):
     global device_sn, debug_setting, var_list, invert_ct2, tariff, max_power_kw, sample_rounding, sample_time, residual_scale, storage
     if get_device() is None:
@@ -1512,54 +1773,26 @@ def get_history(time_span='hour', d=None, v=None, summary=1, save=None, load=Non
             plot_history(result_list, plot)
         return result_list
     output(f"getting history data", 2)
+    if v is not None and type(v) is not list:
+        v = [v]
     if load is None:
         (t_begin, t_end) = query_time(d, time_span)
         if t_begin is None:
             return None
-        body = {'sn': device_sn, 'begin': t_begin, 'end': t_end}
-        if v is not None:
-            if type(v) is not list:
-                v = [v]
-            if len(var_list) > 0:
-                for var in v:
-                    if var not in var_list:
-                        output(f"** get_history(): invalid variable '{var}'")
-                        output(f"var_list = {var_list}")
-                        return None        
-            body['variables'] = v
-        response = signed_post(path="/op/v0/device/history/query", body=body)
-        if response.status_code != 200:
-            output(f"** get_history() got response code {response.status_code}: {response.reason}")
-            return None
-        result = response.json().get('result')
-        errno = response.json().get('errno')
-        if errno > 0 or result is None or len(result) == 0:
-            output(f"** get_history(), no data, {errno_message(response)}")
+        result = history_query(t_begin, t_end, v)
+        if result is None:
             return None
-        result = result[0].get('datas')
     else:
-        file = open(storage + load)
-        result = json.load(file)
-        file.close()
+        result = load_result(load)
     if save is not None:
-        file_name = save + "_history_" + time_span + "_" + d[0:10].replace('-','') + ".txt"
-        file = open(storage + file_name, 'w', encoding='utf-8')
-        json.dump(result, file, indent=4, ensure_ascii= False)
-        file.close()
+        file_name = save + "_history_" + time_span + "_" + d[0:10].replace('-','') + save_extension()
+        save_result(file_name, result)
     for var in result:
         var['date'] = d[0:10]
         # remove 1 hour over-run when clocks go forward 1 hour
         while len(var['data']) > 0 and var['data'][-1]['time'][0:10] != d[0:10]:
             var['data'].pop()
-        if var.get('variable') == 'meterPower2' and invert_ct2 == 1:
-            for y in var['data']:
-                y['value'] = -y['value']
-        elif var['variable'] == 'ResidualEnergy':
-            var['unit'] = 'kWh'
-            for y in var['data']:
-                 y['value'] *= residual_scale
-        elif var.get('unit') is None:
-            var['unit'] = ''
+        history_fix(var)
     if summary <= 0 or time_span == 'hour':
         if plot > 0:
             plot_history(result, plot)
@@ -1704,6 +1937,285 @@ def plot_history(result, plot=1):
 
 get_raw = get_history
 
+
+##################################################################################################
+# get history data for any time range
+##################################################################################################
+# begin, end = 'YYYY-MM-DD HH:MM:SS' local time or datetime (naive is local time in time_zone, aware is converted)
+# v = list of variables to get
+# The range is split into windows of up to history_window hours that are fetched in parallel and
+# the results are joined and trimmed to begin <= time < end using the timestamp of each sample,
+# so ranges that cross a daylight saving change are handled correctly.
+##################################################################################################
+
+history_window = 24     # longest time range in hours accepted by a history query
+history_workers = 4     # number of history queries that can run in parallel
+
+# convert a date / time string or datetime to a unix timestamp in seconds. Strings and naive datetimes are local time in time_zone
+def range_timestamp(t):
+    if t is None:
+        return None
+    if type(t) is str:
+        t = convert_date(t)
+        if t is None:
+            return None
+    return local_datetime(t).timestamp()
+
+# convert a history sample time e.g. 'YYYY-MM-DD HH:MM:SS BST+0100' to a unix timestamp in seconds
+def sample_timestamp(s):
+    t = datetime.strptime(s[:19], "%Y-%m-%d %H:%M:%S")
+    zone = s[19:].strip()
+    i = max(zone.rfind('+'), zone.rfind('-'))
+    hhmm = zone[i+1:].replace(':', '') if i >= 0 else ''
+    if len(hhmm) == 4 and hhmm.isnumeric():
+        offset = (int(hhmm[:2]) * 60 + int(hhmm[2:])) * (1 if zone[i] == '+' else -1)
+    elif zone[:3] in ['GMT', 'UTC']:
+        offset = 0
+    elif zone[:3] == 'BST':
+        offset = 60
+    else:
+        return local_datetime(t).timestamp()
+    return (t - timedelta(minutes=offset)).replace(tzinfo=timezone.utc).timestamp()
+
+# split a time range into query windows of up to history_window hours (timestamps in milliseconds)
+def range_windows(t_begin, t_end):
+    global history_window
+    window = int(history_window * 3600 * 1000)
+    windows = []
+    t = t_begin
+    while t < t_end:
+        windows.append((t, min([t + window, t_end]) - 1))
+        t += window
+    return windows
+
+def get_history_range(begin, end=None, v=None):
+    global history_workers
+    if get_device() is None:
+        return None
+    t_begin = range_timestamp(begin)
+    t_end = range_timestamp(end) if end is not None else time.time()
+    if t_begin is None or t_end is None or t_begin >= t_end:
+        output(f"** get_history_range(): invalid time range {begin} to {end}")
+        return None
+    if v is not None and type(v) is not list:
+        v = [v]
+    windows = range_windows(int(t_begin * 1000), int(t_end * 1000))
+    output(f"getting history range in {len(windows)} windows", 2)
+    with ThreadPoolExecutor(max_workers=max([1, min([history_workers, len(windows)])])) as pool:
+        results = list(pool.map(lambda w: history_query(w[0], w[1], v), windows))
+    if None in results:
+        return None
+    # join windows in time order, dropping samples outside the range and duplicates at the edges
+    result = []
+    index = {}
+    for window_result in results:
+        for var in window_result:
+            name = var.get('variable')
+            if index.get(name) is None:
+                index[name] = {'var': dict(var, data=[]), 'last': None}
+                result.append(index[name]['var'])
+            joined = index[name]
+            for y in var['data']:
+                t = sample_timestamp(y['time'])
+                if t < t_begin or t >= t_end or (joined['last'] is not None and t <= joined['last']):
+                    continue
+                joined['var']['data'].append(y)
+                joined['last'] = t
+    for var in result:
+        var['date'] = datetime.fromtimestamp(t_begin, tz=local_zone()).strftime("%Y-%m-%d")
+        history_fix(var)
+    return result
+
+# get the value of variables at a point in time using the smallest query window around it
+def get_value_at(t, v=None):
+    global sample_time
+    if get_device() is None:
+        return None
+    t_point = range_timestamp(t)
+    if t_point is None:
+        output(f"** get_value_at(): invalid time {t}")
+        return None
+    if v is not None and type(v) is not list:
+        v = [v]
+    span = int(sample_time * 60 * 1000)
+    t_ms = int(t_point * 1000)
+    result = history_query(t_ms - span, t_ms + span, v)
+    if result is None:
+        return None
+    values = []
+    for var in result:
+        history_fix(var)
+        value = {'variable': var.get('variable'), 'name': var.get('name'), 'unit': var.get('unit'), 'time': None, 'value': None}
+        if len(var['data']) > 0:
+            nearest = min(var['data'], key=lambda y: abs(sample_timestamp(y['time']) - t_point))
+            value['time'] = nearest['time']
+            value['value'] = nearest['value']
+        values.append(value)
+    return values
+
+
+##################################################################################################
+# align history data to a common time grid
+##################################################################################################
+# grid is a list of unix timestamps in seconds. Samples are matched using their timestamps, so
+# variables with different sample times and days with daylight saving changes line up correctly.
+# method = 'nearest': value of the nearest sample within half an interval of each grid time
+# method = 'previous': value of the last sample at or before each grid time
+# method = 'mean': average of the samples from each grid time up to the next grid time
+##################################################################################################
+
+align_methods = ['nearest', 'previous', 'mean']
+
+# return the timestamps for the samples of a history variable
+def history_timestamps(var):
+    return [sample_timestamp(y['time']) for y in var['data']]
+
+# align a list of times and values to a grid
+def align_values(times, values, grid, method='nearest', interval=None):
+    n = len(times)
+    result = [None] * len(grid)
+    if n == 0 or len(grid) == 0:
+        return result
+    if interval is None:
+        interval = (grid[1] - grid[0]) if len(grid) > 1 else sample_time * 60
+    if method == 'mean':
+        edges = grid[1:] + [grid[-1] + interval]
+        j = bisect.bisect_left(times, grid[0])
+        for i, edge in enumerate(edges):
+            total = 0.0
+            count = 0
+            while j < n and times[j] < edge:
+                if values[j] is not None and type(values[j]) is not str:
+                    total += values[j]
+                    count += 1
+                j += 1
+            result[i] = total / count if count > 0 else None
+    elif method == 'previous':
+        for i, t in enumerate(grid):
+            j = bisect.bisect_right(times, t) - 1
+            result[i] = values[j] if j >= 0 else None
+    else:
+        tolerance = interval / 2
+        for i, t in enumerate(grid):
+            j = bisect.bisect_left(times, t)
+            if j > 0 and (j == n or t - times[j - 1] <= times[j] - t):
+                j -= 1
+            result[i] = values[j] if abs(times[j] - t) <= tolerance else None
+    return result
+
+# align history variables to a grid of timestamps, or to a grid of 'count' intervals in minutes from 'base'
+# method can be a dictionary of {variable: method} to use different methods for each variable
+def align_history(result, grid=None, method='nearest', interval=None, base=None, count=None):
+    global sample_time
+    if result is None:
+        return None
+    interval = sample_time if interval is None else interval
+    # join samples for each variable, for example when result covers several days
+    samples = {}
+    for var in result:
+        if var.get('data') is None:
+            continue
+        name = var['variable']
+        if samples.get(name) is None:
+            samples[name] = []
+        samples[name] += zip(history_timestamps(var), [y.get('value') for y in var['data']])
+    for name in samples.keys():
+        samples[name] = sorted(samples[name], key=lambda x: x[0])
+    if grid is None:
+        all_times = [x[0] for name in samples.keys() for x in samples[name][:1] + samples[name][-1:]]
+        t_begin = range_timestamp(base) if base is not None else (min(all_times) // (interval * 60) * interval * 60 if len(all_times) > 0 else None)
+        if t_begin is None:
+            return {'time': []}
+        if count is None:
+            count = int((max(all_times) - t_begin) // (interval * 60)) + 1 if len(all_times) > 0 else 0
+        grid = [t_begin + i * interval * 60 for i in range(0, count)]
+    aligned = {'time': grid}
+    for name in samples.keys():
+        m = method.get(name, 'nearest') if type(method) is dict else method
+        aligned[name] = align_values([x[0] for x in samples[name]], [x[1] for x in samples[name]], grid, m, interval * 60)
+    return aligned
+
+##################################################################################################
+# resample history data to a fixed interval for each day
+##################################################################################################
+# interval: minutes between values e.g. 1, 5, 15, 30, 60
+# method: 'mean', 'sum', 'last' or 'integral' (kW to kWh). Can be a dictionary of {variable: method}
+# each day runs from local midnight to the next local midnight so days when the clocks change
+# have 23 or 25 hours of values. 'time' holds the local time for each value.
+##################################################################################################
+
+resample_methods = ['mean', 'sum', 'last', 'integral']
+
+# return the local midnight timestamps (start, end) for the day of a list of samples
+def sample_day(data):
+    t_first = sample_timestamp(data[0]['time'])
+    t_last = sample_timestamp(data[-1]['time'])
+    midnight = datetime.strptime(data[0]['time'][:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    wall_first = datetime.strptime(data[0]['time'][:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    wall_last = datetime.strptime(data[-1]['time'][:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    day_start = midnight.timestamp() - (wall_first - t_first)
+    day_end = (midnight + timedelta(days=1)).timestamp() - (wall_last - t_last)
+    return (day_start, day_end)
+
+# resample history data returned by get_history() or get_history_range() for one or more days
+def resample_history(result, interval=30, method='mean'):
+    global sample_time
+    if result is None:
+        return None
+    step = int(interval * 60)
+    # group samples for each variable by day
+    days = {}
+    info = {}
+    for var in result:
+        if var.get('data') is None:
+            continue
+        name = var['variable']
+        info[name] = var
+        for y in var['data']:
+            key = (name, y['time'][:10])
+            if days.get(key) is None:
+                days[key] = []
+            days[key].append(y)
+    resampled = []
+    for (name, date) in sorted(days.keys(), key=lambda k: k[1]):
+        data = sorted(days[(name, date)], key=lambda y: sample_timestamp(y['time']))
+        m = method.get(name, 'mean') if type(method) is dict else method
+        if m not in resample_methods:
+            output(f"** resample_history(): method must be one of {resample_methods}")
+            return None
+        (day_start, day_end) = sample_day(data)
+        count = int((day_end - day_start + step - 1) // step)
+        values = [None] * count
+        n = [0] * count
+        times = [sample_timestamp(y['time']) for y in data]
+        offsets = [datetime.strptime(y['time'][:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp() - times[i] for i, y in enumerate(data)]
+        # duration of each sample in hours for integration, limited to the sample time
+        durations = [min([times[i + 1] - times[i], sample_time * 60]) / 3600 if i + 1 < len(times) else sample_time / 60 for i in range(0, len(times))]
+        for i, y in enumerate(data):
+            value = y.get('value')
+            j = int((times[i] - day_start) // step)
+            if value is None or type(value) is str or j < 0 or j >= count:
+                continue
+            if m == 'last':
+                values[j] = value
+            elif m == 'integral':
+                values[j] = (values[j] if values[j] is not None else 0.0) + value * durations[i]
+            else:
+                values[j] = (values[j] if values[j] is not None else 0.0) + value
+            n[j] += 1
+        if m == 'mean':
+            values = [values[j] / n[j] if n[j] > 0 else None for j in range(0, count)]
+        # local time of each value using the time zone offset of the next sample
+        labels = []
+        for j in range(0, count):
+            t = day_start + j * step
+            k = min([bisect.bisect_left(times, t), len(times) - 1])
+            labels.append(datetime.fromtimestamp(t + offsets[k], tz=timezone.utc).strftime("%H:%M"))
+        var = info[name]
+        resampled.append({'variable': name, 'name': var.get('name'), 'unit': 'kWh' if m == 'integral' and var.get('unit') == 'kW' else var.get('unit'), 'date': date,
+            'interval': interval, 'method': m, 'time': labels, 'data': values})
+    return resampled
+
 # take a report and return (average value and 24 hour profile)
 def report_value_profile(result):
     if type(result) is not list or result[0]['type'] != 'day':
@@ -1735,29 +2247,22 @@ def report_value_profile(result):
         result.append(by_hour[t] * daily_average / current_total if current_total != 0.0 else 0.0)
     return (daily_average, result)
 
-# rescale history data based on time and steps
+# rescale history data for a day to 24 * steps values by local time using resample_history()
+# on days when the clocks change, the missing hour is None and the repeated hour is the average of both
 def rescale_history(data, steps):
-    if data is None:
+    if data is None or len(data) == 0:
         return None
-    result = [None for i in range(0, 24 * steps)]
-    bst = 1 if 'BST' in data[0]['time'] else 0
-    average = 0.0
-    n = 0
-    i = 0
-    for d in data:
-        h = round_time(time_hours(d['time'][11:]) + bst)
-        new_i = int(h * steps)
-        if new_i != i and i < len(result):
-            result[i] = average / n if n > 0 else None
-            average = 0.0
-            n = 0
-            i = new_i
-        if d['value'] is not None:
-            average += d['value']
-            n += 1
-    if n > 0 and i < len(result):
-        result[i] = average / n
-    return result
+    resampled = resample_history([{'variable': 'data', 'data': data}], interval=60 / steps, method='mean')
+    if resampled is None or len(resampled) == 0:
+        return None
+    totals = [0.0] * (24 * steps)
+    n = [0] * (24 * steps)
+    for t, value in zip(resampled[0]['time'], resampled[0]['data']):
+        j = int(time_hours(t) * steps)
+        if value is not None and j < len(totals):
+            totals[j] += value
+            n[j] += 1
+    return [totals[j] / n[j] if n[j] > 0 else None for j in range(0, len(totals))]
 
 
 ##################################################################################################
@@ -1891,14 +2396,10 @@ def get_report(dimension='day', d=None, v=None, summary=1, save=None, load=None,
         for x in v:
             result.append({'variable': x, 'values': [], 'date': d})
     if load is not None:
-        file = open(storage + load)
-        result = json.load(file)
-        file.close()
+        result = load_result(load)
     elif save is not None:
-        file_name = save + "_report_" + dimension + "_" + d.replace('-','') + ".txt"
-        file = open(storage + file_name, 'w', encoding='utf-8')
-        json.dump(result, file, indent=4, ensure_ascii= False)
-        file.close()
+        file_name = save + "_report_" + dimension + "_" + d.replace('-','') + save_extension()
+        save_result(file_name, result)
     if summary == 0:
         return result
     # calculate and add summary data
@@ -2008,6 +2509,154 @@ def plot_report(result, plot=1, station=0):
     return
 
 
+##################################################################################################
+# stream history and report data by day and export to CSV or Parquet
+##################################################################################################
+# history_stream() is a generator that yields one day at a time as columns:
+#   {'date': 'YYYY-MM-DD', 'history': {variable: {'name', 'unit', 'time': [...], 'value': [...]}},
+#    'report': {variable: {'name', 'unit', 'time': [...], 'value': [...]}}}
+# The next 'prefetch' days are fetched in parallel while the current day is being processed, so
+# memory is bounded by prefetch + 1 days.
+# export_history() writes the stream to a CSV file (date,time,variable,value,unit) or to a Parquet
+# dataset partitioned by date (file/date=YYYY-MM-DD/data.parquet). With resume=1, days that have
+# already been written are skipped.
+##################################################################################################
+
+export_prefetch = 2     # number of days to fetch ahead
+
+# convert a history result to columns by variable
+def history_columns(result):
+    columns = {}
+    if result is None:
+        return columns
+    for var in result:
+        if var.get('data') is None:
+            continue
+        columns[var['variable']] = {'name': var.get('name'), 'unit': var.get('unit'),
+            'time': [y['time'] for y in var['data']], 'value': [y.get('value') for y in var['data']]}
+    return columns
+
+# convert a day report result to columns by variable with hourly time labels
+def report_columns(result):
+    columns = {}
+    if result is None:
+        return columns
+    for var in result:
+        columns[var['variable']] = {'name': var.get('name'), 'unit': 'kWh',
+            'time': [f"{var['date']} {h:02d}:00:00" for h in range(0, len(var['values']))], 'value': list(var['values'])}
+    return columns
+
+# get the columns for one day
+def stream_day(d, v=None, report_v=None):
+    chunk = {'date': d, 'history': {}, 'report': {}}
+    if v is not None:
+        result = get_history('day', d=d, v=v, summary=0)
+        if result is None:
+            return None
+        chunk['history'] = history_columns(result)
+    if report_v is not None:
+        result = get_report('day', d=d, v=report_v, summary=0)
+        if result is None:
+            return None
+        for var in result:
+            var['date'] = d
+        chunk['report'] = report_columns(result)
+    return chunk
+
+# generator yielding a day of history and report data at a time
+def history_stream(d=None, v=None, report_v=None, prefetch=None):
+    global export_prefetch
+    if get_device() is None:
+        return
+    if d is None:
+        d = date_list()
+    elif type(d) is not list:
+        d = [d]
+    if v is None and report_v is None:
+        v = power_vars
+    prefetch = export_prefetch if prefetch is None else prefetch
+    with ThreadPoolExecutor(max_workers=prefetch + 1) as pool:
+        pending = [pool.submit(stream_day, day, v, report_v) for day in d[:prefetch + 1]]
+        for i in range(0, len(d)):
+            chunk = pending.pop(0).result()
+            if i + prefetch + 1 < len(d):
+                pending.append(pool.submit(stream_day, d[i + prefetch + 1], v, report_v))
+            if chunk is None:
+                output(f"** history_stream(): no data for {d[i]}")
+                for p in pending:
+                    p.cancel()
+                return
+            yield chunk
+    return
+
+# flatten the columns in a chunk to rows of (date, time, variable, value, unit)
+def chunk_rows(chunk):
+    rows = []
+    for columns in [chunk['history'], chunk['report']]:
+        for variable, c in columns.items():
+            rows += [(chunk['date'], t[11:19], variable, x, c['unit']) for t, x in zip(c['time'], c['value'])]
+    return rows
+
+# return the last date written to an export
+def export_last_date(file, parquet):
+    global storage
+    path = storage + file
+    if parquet:
+        if not os.path.isdir(path):
+            return None
+        dates = [p[5:] for p in os.listdir(path) if p[:5] == 'date=' and os.path.exists(os.path.join(path, p, 'data.parquet'))]
+        return max(dates) if len(dates) > 0 else None
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as file:
+        file.seek(max([0, os.path.getsize(path) - 1024]))
+        lines = file.read().decode('utf-8').strip().split('\n')
+    last = lines[-1][:10]
+    return last if last[:4].isnumeric() else None
+
+def export_history(file, d=None, s=None, e=None, v=None, report_v=None, resume=1, prefetch=None):
+    global storage
+    parquet = not file.lower().endswith('.csv')
+    if parquet:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            output(f"** export_history(): pyarrow is needed to write Parquet files, use a file name ending in .csv to write CSV")
+            return None
+    if d is None:
+        d = date_list(s=s, e=e, limit=3660)
+    elif type(d) is not list:
+        d = [d]
+    last = export_last_date(file, parquet) if resume == 1 else None
+    if last is not None:
+        d = [day for day in d if day > last]
+        output(f"Resuming export to {file} after {last}", 1)
+    path = storage + file
+    if not parquet and (resume == 0 or not os.path.exists(path)):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("date,time,variable,value,unit\n")
+    days = 0
+    for chunk in history_stream(d=d, v=v, report_v=report_v, prefetch=prefetch):
+        rows = chunk_rows(chunk)
+        if parquet:
+            columns = list(zip(*rows)) if len(rows) > 0 else [[]] * 5
+            table = pyarrow.table({'date': columns[0], 'time': columns[1], 'variable': columns[2],
+                'value': pyarrow.array([x if type(x) in (int, float) else None for x in columns[3]], type=pyarrow.float64()), 'unit': columns[4]})
+            folder = os.path.join(path, f"date={chunk['date']}")
+            os.makedirs(folder, exist_ok=True)
+            pyarrow.parquet.write_table(table, os.path.join(folder, 'data.tmp'))
+            os.replace(os.path.join(folder, 'data.tmp'), os.path.join(folder, 'data.parquet'))
+        else:
+            lines = "".join(f"{r[0]},{r[1]},{r[2]},{r[3] if r[3] is not None else ''},{r[4]}\n" for r in rows)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+        days += 1
+        output(f"  {chunk['date']}: {len(rows)} rows", 2)
+    output(f"Exported {days} days to {file}", 1)
+    return days
+
+
 ##################################################################################################
 ##################################################################################################
 # Operations section
@@ -2041,6 +2690,9 @@ def split_hours(h):
     minutes = int (h % 1 * 60 + 0.5)
     return (hours, minutes)
 
+# cache of decimal hours for time strings HH:MM or HH:MM:SS that have been converted
+time_cache = {}
+
 # convert time string HH:MM:SS to decimal hours (range 0 to 24)
 # If BST time zone is included, convert to GMT (range -1 to 23)
 def time_hours(t, d = None):
@@ -2054,12 +2706,21 @@ def time_hours(t, d = None):
         return float(t)
     offset = 1 if 'BST' in t else 0
     t = t[0:8]
+    h = time_cache.get(t)
+    if h is not None:
+        return h - offset
     if type(t) is str and t.replace(':', '').isnumeric() and t.count(':') <= 2:
+        key = t
         t += ':00' if t.count(':') == 1 else ''
-        return sum(float(t) / x for x, t in zip([1, 60, 3600], t.split(":"))) - offset
+        h = sum(float(t) / x for x, t in zip([1, 60, 3600], t.split(":")))
+        time_cache[key] = h
+        return h - offset
     output(f"** invalid time string {t}")
     return None
 
+# time strings HH:MM for each 15 minute slot, covers 30 minute and 1 hour time lines
+time_labels = [f"{i // 4:02}:{i % 4 * 15:02}" for i in range(0, 96)]
+
 # convert decimal hours to time string HH:MM:SS
 def hours_time(h, ss = False, day = False, mm = True):
     if h is None:
@@ -2077,6 +2738,8 @@ def hours_time(h, ss = False, day = False, mm = True):
     suffix = ""
     if day:
         suffix = f"/{d:0}"
+    if n == 5 and h * 4 % 1 == 0:
+        return time_labels[int(h * 4)] + suffix
     return f"{int(h):02}:{int(h * 60 % 60):02}:{int(h * 3600 % 60):02}"[:n] + suffix
 
 # True if a decimal hour falls within a time period
@@ -2193,8 +2856,118 @@ def british_summer_time(d=None):
         return 1
     return 0
 
+# cached daylight saving transitions for each time zone: {'zone', 'first', 'end', 'years', 'times', 'values'}
+# times are UTC timestamps in seconds and values are the daylight saving in hours from that time
+dst_tables = {}
+
+# return zone info for a time zone or None if zoneinfo or the time zone data is not available
+def zone_info(name):
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(name)
+    except Exception:
+        return None
+
+# daylight saving in hours for a UTC timestamp using zone info
+def zone_dst(zone, t):
+    dst = zone.dst(datetime.fromtimestamp(t, tz=timezone.utc).astimezone(zone))
+    hours = dst.total_seconds() / 3600 if dst is not None else 0
+    return int(hours) if hours % 1 == 0 else hours
+
+# add the daylight saving transitions for a year to a table
+def dst_year(table, zone, year):
+    t = datetime(year, 1, 1, tzinfo=timezone.utc).timestamp()
+    t_end = datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp()
+    value = zone_dst(zone, t)
+    changes = [(t, value)]
+    while t < t_end:
+        t_next = min([t + 86400, t_end])
+        if zone_dst(zone, t_next) != value:
+            # find the time of the change to the nearest minute
+            (a, b) = (t, t_next)
+            while b - a > 60:
+                m = a + (b - a) // 120 * 60
+                (a, b) = (m, b) if zone_dst(zone, m) == value else (a, m)
+            value = zone_dst(zone, b)
+            changes.append((b, value))
+            t_next = b
+        t = t_next
+    table['years'][year] = changes
+    changes = [c for y in sorted(table['years'].keys()) for c in table['years'][y]]
+    table['times'] = [c[0] for c in changes]
+    table['values'] = [c[1] for c in changes]
+    table['first'] = datetime(min(table['years'].keys()), 1, 1, tzinfo=timezone.utc).timestamp()
+    table['end'] = datetime(max(table['years'].keys()) + 1, 1, 1, tzinfo=timezone.utc).timestamp()
+    return
+
+# return the transition table for time_zone covering UTC timestamps from t_min to t_max
+def dst_table(t_min, t_max=None):
+    global time_zone, dst_tables
+    t_max = t_min if t_max is None else t_max
+    table = dst_tables.get(time_zone)
+    if table is None:
+        zone = zone_info(time_zone)
+        if zone is None:
+            return None
+        table = {'zone': zone, 'first': None, 'end': None, 'years': {}, 'times': [], 'values': []}
+        dst_tables[time_zone] = table
+    if table['first'] is None or t_min < table['first'] or t_max >= table['end']:
+        year_min = datetime.fromtimestamp(t_min, tz=timezone.utc).year
+        year_max = datetime.fromtimestamp(t_max, tz=timezone.utc).year
+        for year in range(year_min, year_max + 1):
+            if year not in table['years']:
+                dst_year(table, table['zone'], year)
+    return table
+
+# fold used for local times that occur twice when the clocks go back: 0 = first (daylight saving), 1 = second
+dst_fold = 0
+
+# return the zone info for time_zone or UTC if zoneinfo or the time zone data is not available
+def local_zone():
+    global time_zone
+    zone = zone_info(time_zone)
+    return timezone.utc if zone is None else zone
+
+# return an aware datetime, treating a naive datetime as local time in time_zone
+def local_datetime(d):
+    global dst_fold
+    if d.tzinfo is not None:
+        return d
+    return d.replace(tzinfo=local_zone(), fold=dst_fold)
+
+# return the UTC timestamp for a date time string, datetime or None (now)
+# strings and naive datetimes are local times in time_zone
+def dst_timestamp(d):
+    if d is None:
+        return time.time()
+    if type(d) is str:
+        hour = int(d[11:13]) if len(d) >= 16 else 12
+        minute = int(d[14:16]) if len(d) >= 16 else 0
+        d = datetime(int(d[0:4]), int(d[5:7]), int(d[8:10]), hour, minute)
+    return local_datetime(d).timestamp()
+
+# daylight saving in hours for a list of UTC timestamps
+def dst_list(times):
+    if len(times) == 0:
+        return []
+    table = dst_table(min(times), max(times))
+    if table is None:
+        return [british_summer_time(datetime.fromtimestamp(t, tz=timezone.utc)) for t in times]
+    return [table['values'][bisect.bisect_right(table['times'], t) - 1] for t in times]
+
+# work out the daylight saving for a date in time_zone. Returns 1 for summer time, 0 for standard time
+# Falls back to british_summer_time() if zoneinfo is not available
+def zone_daylight_saving(d=None):
+    if type(d) is list:
+        return dst_list([dst_timestamp(x) for x in d])
+    t = dst_timestamp(d)
+    table = dst_table(t)
+    if table is None:
+        return british_summer_time(d)
+    return table['values'][bisect.bisect_right(table['times'], t) - 1]
+
 # hook for alternative daylight saving methods
-daylight_saving = british_summer_time
+daylight_saving = zone_daylight_saving
 
 # helper function to return change in daylight saving between 2 datetimes
 def daylight_changes(a,b):
@@ -2315,14 +3088,46 @@ test_strategy = [
         {'start': 16, 'end': 20, 'mode': 'Feedin'},
         {'start': 21, 'end': 22, 'mode': 'ForceCharge'}]
 
+strategy_cache = {}         # strategies from get_strategy() and compiled by strategy_index(), by key
+strategy_cache_size = 64    # max number of entries kept in strategy_cache
+
+# key for strategy_cache from the values a strategy depends on
+def strategy_key(name, *values):
+    global strategy_cache, strategy_cache_size
+    if len(strategy_cache) >= strategy_cache_size:
+        strategy_cache.clear()
+    return name + ' ' + hashlib.md5(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+# compile a strategy into a sorted interval index. Each interval between 2 period boundaries has the list of
+# (period, valid_for set) that include it, in strategy order. Wrap around periods are included either side of midnight
+def strategy_index(strategy):
+    global strategy_cache
+    key = strategy_key('index', strategy)
+    if strategy_cache.get(key) is not None:
+        return strategy_cache[key]
+    points = sorted(set([0.0, 24.0] + [float(x) for d in strategy for x in [d.get('start'), d.get('end')] if x is not None and x > 0 and x < 24]))
+    match = []
+    for h in points[:-1]:
+        match.append([(dict(d), set(d['valid_for']) if d.get('valid_for') is not None else None) for d in strategy if hour_in(h, d)])
+    strategy_cache[key] = {'points': points, 'match': match}
+    return strategy_cache[key]
+
 # return a strategy that has been sorted and filtered for charge times:
 def get_strategy(use=None, strategy=None, quiet=1, remove=None, reserve=0, limit=24, timed_mode=1):
-    global tariff, base_time
+    global tariff, base_time, strategy_cache
     if timed_mode == 0:
         return []
     if use is None:
         use = tariff
     base_time_adjust = 0
+    key = None
+    if strategy is None and tariff is not None and quiet != 0 and remove is None:
+        # strategy from the tariff and agile plunge slots does not change until these do. valid_for is set below so is not part of the key
+        agile = use.get('agile') if use is not None and timed_mode > 1 else None
+        slots = [{k: v for k, v in s.items() if k != 'valid_for'} for s in agile['strategy']] if agile is not None and agile.get('strategy') is not None else None
+        key = strategy_key('strategy', tariff.get('strategy'), slots, agile.get('base_time') if agile is not None else None, base_time, reserve, limit, timed_mode, steps_per_hour)
+        if strategy_cache.get(key) is not None:
+            return [dict(s) for s in strategy_cache[key]]
     if strategy is None and tariff is not None:
         strategy = []
         if tariff.get('strategy') is not None:
@@ -2364,6 +3169,8 @@ def get_strategy(use=None, strategy=None, quiet=1, remove=None, reserve=0, limit
         updated.append(segment)
         if len(updated) + reserve == 8:
             break
+    if key is not None:
+        strategy_cache[key] = [dict(s) for s in updated]
     return updated
 
 
@@ -2382,6 +3189,7 @@ tariff_config = {
     'region': "H",                        # region code to use for Octopus API
     'update_time': 16.5,                  # time in hours when tomrow's data can be fetched
     'weighting': None,                    # weights for weighted average
+    'export_price': 15.0,                 # export price in p/kWh used by arbitrage_plan()
     'plunge_price': [3, 3],               # plunge price in p/kWh inc VAT over 24 hours from 7am, 7pm
     'plunge_slots': 8,                    # number of 30 minute slots to use
     'data_wrap': 6,                       # prices to show per line
@@ -2396,7 +3204,7 @@ def get_agile_times(tariff=agile_octopus, d=None):
     if d is not None and len(d) < 11:
         d += " 18:00"
     # get dates and times
-    system_time = (datetime.now(tz=timezone.utc) + timedelta(hours=time_shift)) if d is None else convert_date(d)
+    system_time = (datetime.now(tz=timezone.utc) + timedelta(hours=time_shift)) if d is None else utc_date(d)
     time_offset = daylight_saving(system_time) if daylight_saving is not None else 0
     # adjust system to get local time now
     now = system_time + timedelta(hours=time_offset)
@@ -2432,7 +3240,7 @@ def get_agile_times(tariff=agile_octopus, d=None):
     for i in range(0, len(results)):
         hour = i / 2
         start = (now.hour + hour) % 24
-        time_offset = daylight_saving(results[i]['valid_from'][:16]) if daylight_saving is not None else 0
+        time_offset = daylight_saving(datetime.strptime(results[i]['valid_from'][:16], '%Y-%m-%dT%H:%M').replace(tzinfo=timezone.utc)) if daylight_saving is not None else 0
         prices.append({
             'start': start,
             'end': round_time(start + 0.5),
@@ -2497,18 +3305,19 @@ def get_agile_times(tariff=agile_octopus, d=None):
     return tariff['agile']
 
 # return the best charge time:
-def get_best_charge_period(start, duration):
+def get_best_charge_period(start, duration, use=None):
     global tariff
-    if tariff is None or tariff.get('agile') is None or tariff['agile'].get('prices') is None:
+    use = tariff if use is None else use
+    if use is None or use.get('agile') is None or use['agile'].get('prices') is None:
         return None
-    key = [k for k in ['off_peak1', 'off_peak2', 'off_peak3', 'off_peak4'] if hour_in(start, tariff.get(k))]
+    key = [k for k in ['off_peak1', 'off_peak2', 'off_peak3', 'off_peak4'] if hour_in(start, use.get(k))]
     key = key[0] if len(key) > 0 else None
-    end = tariff[key]['end'] if key is not None else round_time(start + duration)
+    end = use[key]['end'] if key is not None else round_time(start + duration)
     span = int(duration * 2 + 0.99)         # number of slots needed for charging
     last = (duration * 2) % 1               # amount of last slot used for charging
     coverage = max([round_time(end - start), duration])
     period = {'start': start, 'end': round_time(start + coverage)}
-    prices = tariff['agile']['prices']
+    prices = use['agile']['prices']
     slots = [i for i in range(0, len(prices)) if hour_in(time_hours(prices[i]['start']), period)]
     if len(slots) == 0:
         return None
@@ -2533,8 +3342,73 @@ def get_best_charge_period(start, duration):
                 best = t
         best_start = prices[best[0]]['start']
     # save best time slot for charge duration
-    tariff['agile']['best'] = {'start': best_start, 'end': round_time(best_start + span / 2), 'price': price, 'slots': best, 'key': key}
-    return tariff['agile']['best']
+    use['agile']['best'] = {'start': best_start, 'end': round_time(best_start + span / 2), 'price': price, 'slots': best, 'key': key}
+    return use['agile']['best']
+
+# return the cheapest set of 30 minute slots to charge for duration hours:
+#  period: optional dict with 'start' and 'end' hours to search. The default is all slots in the agile prices
+#  blocks: maximum number of separate charge periods. The default is max_periods
+# slots are weighted in time order using tariff_config['weighting'], with the last slot pro rata to the duration
+def get_best_charge_slots(duration, period=None, blocks=None, use=None):
+    global tariff, max_periods
+    use = tariff if use is None else use
+    if use is None or use.get('agile') is None or use['agile'].get('prices') is None or duration is None or duration <= 0.0:
+        return None
+    blocks = max_periods if blocks is None else blocks
+    prices = use['agile']['prices']
+    slots = [i for i in range(0, len(prices)) if period is None or hour_in(time_hours(prices[i]['start']), period)]
+    span = min([int(duration * 2 + 0.99), len(slots)])     # number of slots needed for charging
+    if span == 0 or blocks < 1:
+        return None
+    last = (duration * 2) % 1                               # amount of last slot used for charging
+    weighting = tariff_config.get('weighting')
+    weights = ([1.0] * (span)) if weighting is None else (weighting + [1.0] * span)[:span]
+    weights[-1] *= last if last > 0.0 and span == int(duration * 2 + 0.99) else 1.0
+    # dynamic programme over slots. State is (slots used, blocks used, previous slot used) with the lowest cost and chain of slots used
+    states = {(0, 0, 0): (0.0, None)}
+    previous = None
+    for x in slots:
+        adjacent = previous is not None and x == previous + 1
+        price = prices[x]['price']
+        updated = {}
+        for (j, b, used), (cost, chain) in states.items():
+            key = (j, b, 0)
+            if updated.get(key) is None or cost < updated[key][0]:
+                updated[key] = (cost, chain)
+            if j == span:
+                continue
+            b_next = b + (0 if used == 1 and adjacent else 1)
+            if b_next > blocks:
+                continue
+            key = (j + 1, b_next, 1)
+            cost_next = cost + price * weights[j]
+            if updated.get(key) is None or cost_next < updated[key][0]:
+                updated[key] = (cost_next, (x, chain))
+        states = updated
+        previous = x
+    best = None
+    for (j, b, used), (cost, chain) in states.items():
+        if j == span and (best is None or cost < best[0] or (cost == best[0] and b < best[1])):
+            best = (cost, b, chain)
+    if best is None:
+        return None
+    (cost, b, chain) = best
+    chosen = []
+    while chain is not None:
+        (x, chain) = chain
+        chosen.append(x)
+    chosen = chosen[::-1]
+    periods = []
+    for x in chosen:
+        if len(periods) > 0 and x == periods[-1]['slots'][-1] + 1:
+            periods[-1]['end'] = prices[x]['end']
+            periods[-1]['slots'].append(x)
+        else:
+            periods.append({'start': prices[x]['start'], 'end': prices[x]['end'], 'slots': [x]})
+    price = round(cost / sum(weights), 2)
+    use['agile']['best_slots'] = {'start': periods[0]['start'], 'end': periods[-1]['end'], 'price': price, 'slots': chosen,
+        'times': [prices[x]['start'] for x in chosen], 'periods': periods, 'last': last}
+    return use['agile']['best_slots']
 
 # pushover app key for set_tariff()
 set_tariff_app_key = "apx24dswzinhrbeb62sdensvt42aqe"
@@ -2671,6 +3545,95 @@ def timed_list(data, base_hour, run_time):
         h = round_time(h + 1 / steps_per_hour)
     return result
 
+# return the average generation in kWh for gen_days up to last_date
+def generation_history(last_date, gen_days):
+    history = get_raw('week', d=last_date, v=['pvPower','meterPower2'], summary=2)
+    pv_history = {}
+    if history is None or len(history) == 0:
+        return None
+    for day in history:
+        date = day['date']
+        if pv_history.get(date) is None:
+            pv_history[date] = 0.0
+        if day.get('kwh') is not None and day.get('kwh_neg') is not None:
+            pv_history[date] += day['kwh_neg'] / 0.92 if day['variable'] == 'meterPower2' else day['kwh']
+    pv_sum = sum([pv_history[d] for d in sorted(pv_history.keys())[-gen_days:]])
+    output(f"\nGeneration (kWh):")
+    s = ""
+    for d in sorted(pv_history.keys())[-gen_days:]:
+        s += f" {d} {pv_history[d]:4.1f},"
+    output(' ' + s[:-1])
+    generation = pv_sum / gen_days
+    output(f"  Average of last {gen_days} days: {generation:.1f}kWh")
+    return generation
+
+# weights for blending forecasts. Can also be a dictionary of weights for each season, set using forecast_backtest() results
+forecast_weights = {'solcast': 1.0, 'solar': 1.0, 'history': 0.0}
+forecast_weights_default = forecast_weights
+forecast_weights_save = 'forecast_weights.txt'      # file in storage used to keep weights from set_forecast_weights()
+
+# set forecast_weights from forecast_backtest() results, weighting each source by 1 / rmse ^ 2 for each season
+def set_forecast_weights(result):
+    global forecast_weights, seasonal_sun, forecast_weights_save, storage
+    if result is None or len(result) == 0:
+        return None
+    weights = {}
+    for season in [x['name'] for x in seasonal_sun]:
+        w = {}
+        for source in result.keys():
+            metrics = result[source]['season'].get(season)
+            metrics = result[source]['all'] if metrics is None else metrics
+            if metrics is not None and metrics['rmse'] > 0.0:
+                w[source] = 1 / metrics['rmse'] ** 2
+        total = sum(w.values())
+        weights[season] = {k: round(v / total, 3) for k, v in w.items()} if total > 0.0 else None
+    forecast_weights = weights
+    if forecast_weights_save is not None:
+        file = open(storage + forecast_weights_save, 'w')
+        json.dump(forecast_weights, file, sort_keys = True, indent=4, ensure_ascii= False)
+        file.close()
+    return forecast_weights
+
+# load weights saved by set_forecast_weights() if forecast_weights has not been changed
+def forecast_weights_load():
+    global forecast_weights, forecast_weights_default, forecast_weights_save, storage
+    if forecast_weights is forecast_weights_default and forecast_weights_save is not None and os.path.exists(storage + forecast_weights_save):
+        file = open(storage + forecast_weights_save)
+        forecast_weights = json.load(file)
+        file.close()
+    return forecast_weights
+
+# return the forecast weights for a season
+def blend_weights(season=None):
+    global forecast_weights
+    forecast_weights_load()
+    if forecast_weights.get(season) is not None:
+        return forecast_weights[season]
+    if len([k for k in forecast_weights.keys() if type(forecast_weights[k]) is dict]) > 0:
+        return {'solcast': 1.0, 'solar': 1.0}
+    return forecast_weights
+
+# blend daily forecast values. Returns the blended value and the weight used for each source
+def blend_forecasts(values, weights):
+    used = {k: weights[k] for k in values.keys() if values[k] is not None and weights.get(k) is not None and weights[k] > 0.0}
+    total = sum(used.values())
+    if total == 0.0:
+        return (None, {})
+    used = {k: w / total for k, w in used.items()}
+    return (sum(values[k] * w for k, w in used.items()), used)
+
+# blend forecast time lines, using the sources that have a value for each time
+def blend_timed_forecasts(timed, weights):
+    sources = [(timed[k], weights[k]) for k in timed.keys() if timed[k] is not None and weights.get(k) is not None and weights[k] > 0.0]
+    if len(sources) == 0:
+        return None
+    result = []
+    for i in range(0, max(len(x[0]) for x in sources)):
+        pairs = [(x[i], w) for x, w in sources if i < len(x) and x[i] is not None]
+        total = sum(w for x, w in pairs)
+        result.append(sum(x * w for x, w in pairs) / total if total > 0.0 else None)
+    return result
+
 # align forecast with base_hour and expand to cover run_time
 def forecast_value_timed(forecast, today, tomorrow, base_hour, run_time, time_offset=0):
     global steps_per_hour
@@ -2694,21 +3657,22 @@ def forecast_value_timed(forecast, today, tomorrow, base_hour, run_time, time_of
     return profile[:run_time]
 
 # build the timed work mode profile from the tariff strategy:
-def strategy_timed(timed_mode, time_line, run_time, min_soc=10, max_soc=100, current_mode=None):
+def strategy_timed(timed_mode, time_line, run_time, min_soc=10, max_soc=100, current_mode=None, strategy=None):
     global tariff, steps_per_hour
     work_mode_timed = []
     min_soc_now = min_soc
     max_soc_now = max_soc
     current_mode = 'SelfUse' if current_mode is None else current_mode
-    strategy = get_strategy(timed_mode=timed_mode)
+    strategy = get_strategy(timed_mode=timed_mode) if strategy is None else strategy
+    index = strategy_index(strategy) if strategy is not None else None
     for i in range(0, run_time):
         h = time_line[i]
         period = {'mode': current_mode, 'min_soc': min_soc_now, 'max_soc': max_soc, 'fdpwr': 0, 'fdsoc': min_soc_now, 'duration': 1.0,
             'pv': 0.0, 'charge': 0.0, 'discharge': 0.0, 'fd_kwh': 0.0, 'hold': 0, 'kwh': None}
         if strategy is not None:
             period['mode'] = 'SelfUse'
-            for d in strategy:
-                if hour_in(h, d) and (d.get('valid_for') is None or i in d['valid_for']):
+            for (d, valid_for) in index['match'][bisect.bisect_right(index['points'], h % 24) - 1]:
+                if valid_for is None or i in valid_for:
                     mode = d['mode']
                     period['mode'] = mode
                     min_soc_now = d['min_soc'] if d.get('min_soc') is not None else min_soc
@@ -2726,14 +3690,15 @@ def strategy_timed(timed_mode, time_line, run_time, min_soc=10, max_soc=100, cur
 
 # build the timed battery residual from the charge / discharge, work mode and min_soc
 # all power values are as measured at the inverter battery connection
-def battery_timed(work_mode_timed, kwh_current, capacity, time_to_next, kwh_min=None, reserve_drain=None):
+def battery_timed(work_mode_timed, kwh_current, capacity, time_to_next, kwh_min=None, reserve_drain=None, config=None):
     global charge_config, steps_per_hour
-    allowed_drain = charge_config['allowed_drain'] if charge_config.get('allowed_drain') is not None else 4
-    bms_loss = (charge_config['bms_power'] / 1000 if charge_config.get('bms_power') is not None else 0.05)
-    charge_loss = charge_config['_charge_loss']
-    discharge_loss = charge_config['_discharge_loss']
-    charge_limit = charge_config['charge_limit']
-    float_charge = charge_config['float_charge']
+    config = charge_config if config is None else config
+    allowed_drain = config['allowed_drain'] if config.get('allowed_drain') is not None else 4
+    bms_loss = (config['bms_power'] / 1000 if config.get('bms_power') is not None else 0.05)
+    charge_loss = config['_charge_loss']
+    discharge_loss = config['_discharge_loss']
+    charge_limit = config['charge_limit']
+    float_charge = config['float_charge']
     run_time = len(work_mode_timed)
     for i in range(0, run_time):
         w = work_mode_timed[i]
@@ -2750,7 +3715,7 @@ def battery_timed(work_mode_timed, kwh_current, capacity, time_to_next, kwh_min=
             kwh_next = max_now if kwh_next > max_now else kwh_next
         if kwh_next > fdsoc_limit and w['fd_kwh'] > 0.0:
             # force discharge
-            kwh_next += (w['pv' * charge_loss - w['fd_kwh'] / discharge_loss]) / steps_per_hour
+            kwh_next += (w['pv'] * charge_loss - w['fd_kwh'] / discharge_loss) / steps_per_hour
             if kwh_current > fdsoc_limit and kwh_next < fdsoc_limit:
                 kwh_next = fdsoc_limit - w['discharge'] * (1.0 - w['duration']) / discharge_loss / steps_per_hour
         else:
@@ -2780,8 +3745,95 @@ def battery_timed(work_mode_timed, kwh_current, capacity, time_to_next, kwh_min=
         kwh_current = kwh_next
     return ([work_mode_timed[i]['kwh'] for i in range(0, run_time)], kwh_min)
 
-# use work_mode_timed to generate time periods for the inverter schedule
-def charge_periods(work_mode_timed, base_hour, min_soc, capacity):
+# compile the values for each time step of work_mode_timed used by battery_batch()
+def battery_steps(work_mode_timed, capacity, allowed_drain, charge_limit, charge_loss, discharge_loss, pv=None, discharge=None):
+    global steps_per_hour
+    steps = []
+    for i in range(0, len(work_mode_timed)):
+        w = work_mode_timed[i]
+        p = w['pv'] if pv is None else pv[i]
+        d = w['discharge'] if discharge is None else discharge[i]
+        min_soc_now = w['min_soc']
+        fdsoc_limit = (capacity * w['fdsoc'] / 100) if 'ForceDischarge' in w['mode'] else capacity
+        charge_add = (min([w['charge'], charge_limit - p]) * charge_loss / steps_per_hour) if w['charge'] > 0.0 else None
+        fd_add = ((p * charge_loss - w['fd_kwh'] / discharge_loss) / steps_per_hour) if w['fd_kwh'] > 0.0 else None
+        steps.append((i, w['max_soc'] * capacity / 100, capacity * min_soc_now / 100, capacity * (min_soc_now - allowed_drain) / 100,
+            fdsoc_limit, charge_add, fd_add, fdsoc_limit - d * (1.0 - w['duration']) / discharge_loss / steps_per_hour,
+            (p * charge_loss - d / discharge_loss) / steps_per_hour))
+    return steps
+
+# run the battery_timed() model for a batch of scenarios. Returns a list of battery residuals and kwh_min for each scenario:
+#  work_mode_timed: a work mode time line shared by all scenarios or a list of work mode time lines, one per scenario
+#  kwh_current: the starting residual, or a list with the starting residual for each scenario
+#  pv, discharge: optional lists (scenarios x steps) that replace the 'pv' and 'discharge' values in work_mode_timed
+# work_mode_timed is not updated. Other parameters are the same as battery_timed()
+def battery_batch(work_mode_timed, kwh_current, capacity, time_to_next, kwh_min=None, reserve_drain=None, pv=None, discharge=None, config=None):
+    global charge_config, steps_per_hour
+    config = charge_config if config is None else config
+    allowed_drain = config['allowed_drain'] if config.get('allowed_drain') is not None else 4
+    bms_step = (config['bms_power'] / 1000 if config.get('bms_power') is not None else 0.05) / steps_per_hour
+    charge_loss = config['_charge_loss']
+    discharge_loss = config['_discharge_loss']
+    charge_limit = config['charge_limit']
+    float_step = config['float_charge'] * charge_loss / steps_per_hour
+    shared = len(work_mode_timed) == 0 or type(work_mode_timed[0]) is dict
+    count = len(pv) if pv is not None else len(discharge) if discharge is not None else len(kwh_current) if type(kwh_current) is list \
+        else 1 if shared else len(work_mode_timed)
+    steps = None
+    bat_list = []
+    min_list = []
+    for n in range(0, count):
+        if steps is None or not shared or pv is not None or discharge is not None:
+            steps = battery_steps(work_mode_timed if shared else work_mode_timed[n], capacity, allowed_drain, charge_limit, charge_loss, discharge_loss,
+                pv=pv[n] if pv is not None else None, discharge=discharge[n] if discharge is not None else None)
+        kwh = kwh_current[n] if type(kwh_current) is list else kwh_current
+        kwh_low = kwh_min
+        drain = reserve_drain
+        bat = []
+        for (i, max_now, reserve_now, reserve_limit, fdsoc_limit, charge_add, fd_add, fd_end, normal_add) in steps:
+            bat.append(kwh)
+            kwh_next = kwh
+            if charge_add is not None and kwh_next < max_now:
+                # charge from grid or force charge
+                kwh_next += charge_add
+                if kwh_next > max_now:
+                    kwh_next = max_now
+            if fd_add is not None and kwh_next > fdsoc_limit:
+                # force discharge
+                kwh_next += fd_add
+                if kwh > fdsoc_limit and kwh_next < fdsoc_limit:
+                    kwh_next = fd_end
+            else:
+                # normal discharge
+                kwh_next += normal_add
+            if kwh_next > capacity:
+                kwh_next = capacity
+            if kwh_next < reserve_now and (i < time_to_next or kwh_low is None):
+                if kwh > reserve_now and kwh_next < reserve_now:
+                    kwh_next = reserve_now
+                if drain is None or kwh_next > drain:
+                    drain = kwh_next
+                if drain <= reserve_limit:
+                    # float charge
+                    drain += float_step
+                    if drain > reserve_now:
+                        drain = reserve_now
+                    kwh_next = drain
+                else:
+                    # BMS power drain
+                    kwh_next = drain
+                    drain -= bms_step
+            else:
+                drain = reserve_now
+            if kwh_low is not None and kwh_next < kwh_low and i >= time_to_next:
+                kwh_low = kwh_next
+            kwh = kwh_next
+        bat_list.append(bat)
+        min_list.append(kwh_low)
+    return (bat_list, min_list)
+
+# use work_mode_timed to generate the time segments for the inverter schedule
+def charge_segments(work_mode_timed, base_hour, min_soc, capacity):
     global steps_per_hour
     strategy = []
     start = base_hour
@@ -2811,10 +3863,87 @@ def charge_periods(work_mode_timed, base_hour, min_soc, capacity):
         return []
     if strategy[-1]['min_soc'] != min_soc:
         strategy.append({'start': start %24, 'end': (start + 1 / steps_per_hour) % 24, 'mode': 'SelfUse', 'min_soc': min_soc})
+    return strategy
+
+# settings of a segment that must be the same to merge it with the next segment
+def segment_settings(s):
+    return json.dumps({k: v for k, v in s.items() if k not in ['start', 'end']}, sort_keys=True)
+
+# estimate the kWh affected by a segment: grid charge, force discharge or the energy kept in the battery by a hold or a change in min_soc.
+# The energy kept is limited to the average discharge (load) in kW for the duration of the segment
+def segment_impact(s, work_mode_timed, base_hour, min_soc, capacity, load, reset_soc=None):
+    global steps_per_hour
+    duration = (s['end'] - s['start']) % 24
+    duration = duration if duration > 0 else 24
+    t = int(round((s['start'] - base_hour) % 24 * steps_per_hour))
+    steps = work_mode_timed[t: t + int(round(duration * steps_per_hour))]
+    reserve = abs(s['min_soc'] - (min_soc if reset_soc is None else reset_soc))
+    if 'ForceCharge' in s['mode']:
+        kwh = sum(w['charge'] for w in steps) / steps_per_hour
+    elif 'ForceDischarge' in s['mode'] and s.get('fdpwr') == 0:
+        kwh = 0.0
+        reserve = max([(s['fdsoc'] if s.get('fdsoc') is not None else min_soc) - min_soc, 0])
+    elif 'ForceDischarge' in s['mode']:
+        kwh = sum(w['fd_kwh'] for w in steps) / steps_per_hour
+    elif s['mode'] != 'SelfUse':
+        kwh = sum(w['pv'] + w['discharge'] for w in steps) / steps_per_hour
+    else:
+        kwh = 0.0
+    return kwh + min([capacity * reserve / 100, load * duration])
+
+# compile the segments from charge_segments() into a schedule that fits in limit periods (default max_periods):
+#  segments that end at midnight are set to end at 24:00 so set_period() accepts them
+#  segments next to each other with the same settings are merged, except over midnight
+#  SelfUse segments with the default min_soc are left to the remain mode, unless they reset min_soc after another segment
+#  if there are still too many segments, those with the least impact are dropped
+# returns the segments and a list of the changes made
+def schedule_compile(segments, work_mode_timed, base_hour, min_soc, capacity, limit=None):
+    global max_periods, steps_per_hour
+    limit = max_periods if limit is None else limit
+    changes = []
+    compiled = []
+    for s in segments:
+        s = dict(s)
+        s['end'] = 24 if s['end'] == 0 and s['start'] > 0 else s['end']
+        last = compiled[-1] if len(compiled) > 0 else None
+        if last is not None and last['end'] == s['start'] and segment_settings(last) == segment_settings(s):
+            changes.append(f"merged {format_period(last)} and {format_period(s)} {s['mode']}")
+            last['end'] = s['end']
+            continue
+        compiled.append(s)
+    for n in range(0, 2):
+        folded = []
+        for s in compiled:
+            if s['mode'] == 'SelfUse' and s['min_soc'] == min_soc and (len(folded) == 0 or folded[-1]['min_soc'] == min_soc):
+                changes.append(f"removed {format_period(s)} SelfUse, same as remain mode")
+                continue
+            folded.append(s)
+        compiled = folded
+        if n > 0 or len(compiled) <= limit:
+            break
+        # drop the segments with the least impact
+        timed = [w['discharge'] for w in work_mode_timed[:24 * steps_per_hour] if w['hold'] == 0 and w['mode'] == 'SelfUse']
+        load = sum(timed) / len(timed) if len(timed) > 0 else 0.0
+        impact = [segment_impact(s, work_mode_timed, base_hour, min_soc, capacity, load,
+            compiled[i - 1]['min_soc'] if i > 0 and s['mode'] == 'SelfUse' and s['min_soc'] == min_soc else None) for i, s in enumerate(compiled)]
+        drop = sorted(sorted(range(0, len(compiled)), key=lambda i: impact[i])[:len(compiled) - limit])
+        for i in drop:
+            changes.append(f"dropped {format_period(compiled[i])} {compiled[i]['mode']} ({impact[i]:.2f}kWh)")
+        compiled = [s for i, s in enumerate(compiled) if i not in drop]
+    return (compiled, changes)
+
+# use work_mode_timed to generate time periods for the inverter schedule
+def charge_periods(work_mode_timed, base_hour, min_soc, capacity):
+    strategy = charge_segments(work_mode_timed, base_hour, min_soc, capacity)
+    (strategy, changes) = schedule_compile(strategy, work_mode_timed, base_hour, min_soc, capacity)
+    if len(strategy) == 0:
+        return []
     output(f"\nConfiguring schedule:",1)
     periods = []
     for s in strategy:
         periods.append(set_period(segment = s, quiet=0))
+    for c in changes:
+        output(f"   Schedule: {c}", 1)
     return periods
 
 
@@ -2854,7 +3983,11 @@ charge_config = {
     'use_today': 21.0,                # hour when todays consumption and generation can be used
     'min_hours': 0.5,                 # minimum charge time in decimal hours
     'min_kwh': 0.5,                   # minimum to add in kwh
+    'charge_slots': 0,                # 1 = charge in the cheapest agile slots (timed_mode=2), 0 = single charge period
+    'arbitrage': 0,                   # 1 = use arbitrage_plan() to set work modes from agile prices (timed_mode=2)
+    'probability': None,              # probability (0-1) of staying above min_soc, uses charge_robust() instead of contingency
     'forecast_selection': 0,          # 0 = use available forecast / generation, 1 only update settings with forecast
+    'forecast_blend': 0,              # 1 = blend available forecasts and generation history using forecast_weights
     'annual_consumption': None,       # optional annual consumption in kWh
     'timed_mode': 0,                  # 0 = None, 1 = timed mode, 2 = strategy mode
     'special_contingency': 35,        # contingency for special days when consumption might be higher
@@ -2872,35 +4005,661 @@ charge_config = {
 # app key for charge_needed (used to send output via pushover)
 charge_needed_app_key = "awcr5gro2v13oher3v1qu6hwnovp28"
 
-# work out the charge times to set using the parameters:
-#  forecast: the kWh expected tomorrow. If none, forecast data is loaded from solcast etc
-#  consumption: the kWh consumed. If none, consumption is loaded from history
-#  update_settings: 0 no updates, 1 update charge settings. The default is 0
-#  show_data: 1 shows battery SoC, 2 shows battery residual. Default = 0
-#  show_plot: 1 plots battery SoC, 2 plots battery residual. Default = 1
-#  run_after: 0 over-rides 'forecast_times'. The default is 1.
-#  forecast_times: list of hours when forecast can be fetched (UTC)
-#  force_charge: 1 = hold battery, 2 = charge for whole period
+# contingency % for a quarter (0 = winter) from the charge_config settings
+def plan_contingency(config, quarter, special_day=False):
+    contingency = config['special_contingency'] if special_day else config['contingency']
+    return contingency[quarter] if type(contingency) is list else contingency
 
-def charge_needed(forecast=None, consumption=None, update_settings=0, timed_mode=None, show_data=None, show_plot=None, run_after=None, reload=2,
-        forecast_times=None, force_charge=0, test_time=None, test_soc=None, test_charge=None, **settings):
-    global device, seasonality, solcast_api_key, debug_setting, tariff, solar_arrays, legend_location, time_shift, charge_needed_app_key
-    global timed_strategy, steps_per_hour, base_time, storage, battery, battery_params
-    print(f"\n---------------- charge_needed ----------------")
-    # validate parameters
-    args = locals()
-    s = ""
-    for k in [k for k in args.keys() if args[k] is not None and k != 'settings']:
-        s += f"\n  {k} = {args[k]}"
-    # store settings:
-    for key, value in settings.items():
-        if key not in charge_config:
-            print(f"** unknown configuration parameter: {key}")
-        else:
-            charge_config[key] = value
-            s += f"\n  {key} = {value}"
-    if len(s) > 0:
-        output(f"Parameters: {s}", 2)
+# max power into the battery (charge_limit) and from the grid (charge_power) in kW for a charge current
+def plan_charge_power(config, charge_current, bat_ocv, bat_resistance, device_power, operating_loss, timed_mode):
+    charge_limit = min([charge_current * (bat_ocv + charge_current * bat_resistance) / 1000, max([6, device_power])])
+    force_charge_power = config['force_charge_power'] if timed_mode > 1 and config.get('force_charge_power') is not None else 100
+    charge_power = min([(device_power - operating_loss) * config['ac_dc_loss'], force_charge_power * config['ac_dc_loss'], charge_limit])
+    return (charge_limit, charge_power)
+
+# parameters for battery_timed() from charge_plan() inputs
+def plan_config(inputs):
+    return {**inputs['config'], 'charge_limit': inputs['charge_limit'], 'charge_power': inputs['charge_power'], 'float_charge': inputs['float_charge'],
+        '_charge_loss': inputs['charge_loss'], '_discharge_loss': inputs['discharge_loss']}
+
+# work out the PV charge and discharge for each time step from generation, consumption and work mode
+# updates work_mode_timed and returns the time lines for charge and discharge
+def plan_flows(inputs, work_mode_timed, generation_timed, consumption_timed):
+    timed_mode = inputs['timed_mode']
+    bat_hold = inputs['bat_hold']
+    time_to_start = inputs['time_to_start']
+    time_to_end = inputs['time_to_end']
+    charge_power = inputs['charge_power']
+    discharge_limit = inputs['discharge_limit']
+    export_limit = inputs['export_limit']
+    dc_ac_loss = inputs['dc_ac_loss']
+    operating_loss = inputs['operating_loss']
+    # produce time lines for charge, discharge and work mode
+    charge_timed = [min([inputs['charge_limit'], c_float(x) * inputs['pv_loss']]) for x in generation_timed]
+    discharge_timed = [min([discharge_limit, c_float(x) / dc_ac_loss]) + operating_loss for x in consumption_timed]
+    for i in range(0, len(work_mode_timed)):
+        # get work mode
+        work_mode = work_mode_timed[i]['mode']
+        duration = work_mode_timed[i]['duration']
+        # apply changes due to work mode
+        if timed_mode > 0 and work_mode == 'ForceCharge':
+            discharge_timed[i] = discharge_timed[i] * (1.0 - duration)
+            work_mode_timed[i]['charge'] = charge_power * duration
+        elif timed_mode > 0 and 'ForceDischarge' in work_mode:
+            fdpwr = work_mode_timed[i]['fdpwr'] / dc_ac_loss / 1000
+            work_mode_timed[i]['fd_kwh'] = min([discharge_limit, export_limit + discharge_timed[i], fdpwr]) * duration
+        elif bat_hold > 0 and i >= int(time_to_start) and i < int(time_to_end):
+            discharge_timed[i] = operating_loss
+            work_mode_timed[i]['hold'] = 1
+        elif timed_mode > 0 and work_mode == 'Backup':
+            discharge_timed[i] = operating_loss if charge_timed[i] == 0.0 else 0.0
+        elif timed_mode > 0 and work_mode == 'Feedin':
+            (discharge_timed[i], charge_timed[i]) = (0.0 if (charge_timed[i] >= discharge_timed[i]) else (discharge_timed[i] - charge_timed[i]),
+                0.0 if (charge_timed[i] <= export_limit + discharge_timed[i]) else (charge_timed[i] - export_limit - discharge_timed[i]))
+        else: # work_mode == 'SelfUse'
+            (discharge_timed[i], charge_timed[i]) = (0.0 if (charge_timed[i] >= discharge_timed[i]) else (discharge_timed[i] - charge_timed[i]),
+                0.0 if (charge_timed[i] <= discharge_timed[i]) else (charge_timed[i] - discharge_timed[i]))
+        work_mode_timed[i]['pv'] = charge_timed[i]
+        work_mode_timed[i]['discharge'] = discharge_timed[i]
+    return (charge_timed, discharge_timed)
+
+# plan the charge from a dict of inputs without any I/O. The inputs are:
+#  base_hour, hour_now, time_line, run_time: time line for the plan, starting at base_hour
+#  time_to_start, time_to_end, charge_time, start_at, bat_hold, full_charge: the next charge period
+#  capacity, residual, current_soc, min_soc, max_soc: battery state
+#  charge_limit, charge_power, discharge_limit, export_limit, float_charge: power limits in kW
+#  charge_loss, discharge_loss, pv_loss, dc_ac_loss, operating_loss, bms_loss: losses
+#  timed_mode, current_mode, strategy: work mode strategy. If strategy is None, get_strategy() is used
+#  consumption, consumption_timed, generation_timed: daily kWh and time lines
+#  contingency: % of consumption to add, test_charge: kWh to add for testing (or None)
+#  config: charge_config settings, tariff: tariff used to find the best charge period (default is the current tariff)
+# returns a plan dict with the work modes, battery time line and charge times
+def charge_plan(inputs):
+    global steps_per_hour
+    config = inputs['config']
+    capacity = inputs['capacity']
+    time_line = inputs['time_line']
+    run_time = inputs['run_time']
+    time_to_start = inputs['time_to_start']
+    time_to_end = inputs['time_to_end']
+    charge_time = inputs['charge_time']
+    bat_hold = inputs['bat_hold']
+    timed_mode = inputs['timed_mode']
+    charge_power = inputs['charge_power']
+    charge_loss = inputs['charge_loss']
+    consumption = inputs['consumption']
+    test_charge = inputs.get('test_charge')
+    reserve = capacity * inputs['min_soc'] / 100
+    bat_config = plan_config(inputs)
+    work_mode_timed = strategy_timed(timed_mode, time_line, run_time, min_soc=inputs['min_soc'], max_soc=inputs['max_soc'],
+        current_mode=inputs.get('current_mode'), strategy=inputs.get('strategy'))
+    (charge_timed, discharge_timed) = plan_flows(inputs, work_mode_timed, inputs['generation_timed'], inputs['consumption_timed'])
+    # build the battery residual if we don't add any charge and don't limit discharge at min_soc
+    kwh_current = inputs['residual'] - (charge_timed[0] - discharge_timed[0]) * (inputs['hour_now'] % 1)
+    (bat_timed, kwh_min) = battery_timed(work_mode_timed, kwh_current, capacity, time_to_next=time_to_end, kwh_min=capacity, config=bat_config)
+    # work out what we need to add to stay above reserve and provide contingency or to hit target_soc
+    contingency = inputs['contingency']
+    kwh_contingency = consumption * contingency / 100
+    kwh_needed = reserve + kwh_contingency - kwh_min
+    start_residual = interpolate(time_to_start, bat_timed)      # residual when charge time starts
+    end_residual = interpolate(time_to_end, bat_timed)          # residual when charge time ends without charging
+    target_soc = config.get('target_soc')
+    target_kwh = capacity if inputs.get('full_charge') is not None or bat_hold == 2 else (target_soc / 100 * capacity) if target_soc is not None else 0
+    plan = {'test_charge': None, 'kwh_min': kwh_min, 'contingency': contingency, 'price': None, 'charge_rate': None}
+    if target_kwh > (end_residual + kwh_needed):
+        kwh_needed = target_kwh - end_residual
+    elif test_charge is not None:
+        kwh_needed = test_charge
+        plan['test_charge'] = test_charge
+    # work out charge needed
+    if kwh_min > reserve and kwh_needed < config['min_kwh'] and test_charge is None:
+        plan['message'] = "no charge needed"
+        kwh_needed = 0.0
+        kwh_spare = kwh_min - reserve
+        hours = 0.0
+        start_timed = time_to_end
+        end_timed = time_to_end
+    else:
+        # work out time to add kwh_needed to battery
+        charge_rate = charge_power * charge_loss
+        discharge_rate = max([(start_residual - end_residual) / charge_time - inputs['bms_loss'], 0.0])
+        hours = kwh_needed / charge_rate
+        plan['message'] = "** test charge **" if plan['test_charge'] is not None else "with charge added"
+        plan['charge_rate'] = charge_rate
+        plan['charge_hours'] = hours
+        # check if charge time exceeded or charge needed exceeds capacity
+        hours_to_full = (capacity - end_residual) / charge_rate
+        if hours > charge_time or bat_hold == 2:
+            hours = charge_time
+        elif hours > hours_to_full:
+            kwh_shortfall = kwh_needed - (capacity - end_residual)        # amount of energy that won't be added
+            required = (hours_to_full + kwh_shortfall / discharge_rate) if discharge_rate > 0.0 else charge_time
+            hours = required if required > hours and required < charge_time else charge_time
+        # round charge time
+        min_hours = config['min_hours']
+        hours = int(hours / min_hours + 0.99) * min_hours
+        # rework charge and discharge
+        charge_slots = None
+        if config.get('charge_slots') == 1 and timed_mode > 1:
+            period = {'start': inputs['start_at'], 'end': round_time(inputs['start_at'] + charge_time)}
+            charge_slots = get_best_charge_slots(hours, period=period, blocks=inputs.get('max_periods'), use=inputs.get('tariff'))
+        if charge_slots is not None:
+            # charge in the cheapest slots, each slot is 30 minutes with the last slot pro rata to the charge time
+            intervals = []
+            for k in range(0, len(charge_slots['times'])):
+                start = time_to_start + round_time(charge_slots['times'][k] - inputs['start_at']) * steps_per_hour
+                used = charge_slots['last'] if k == len(charge_slots['times']) - 1 and charge_slots['last'] > 0.0 else 1.0
+                intervals.append((start, start + used * steps_per_hour / 2))
+            plan['price'] = charge_slots['price']
+            plan['charge_periods'] = [{'start': p['start'], 'end': p['end']} for p in charge_slots['periods']]
+            start_timed = intervals[0][0]
+            end_timed = intervals[-1][1]
+        else:
+            charge_period = get_best_charge_period(inputs['start_at'], hours, use=inputs.get('tariff'))
+            charge_offset = round_time(charge_period['start'] - inputs['start_at']) if charge_period is not None else charge_time - hours
+            plan['price'] = charge_period.get('price') if charge_period is not None else None
+            start_timed = time_to_start + charge_offset * steps_per_hour
+            end_timed = start_timed + hours * steps_per_hour
+            intervals = [(start_timed, end_timed)]
+        start_residual = interpolate(start_timed, bat_timed)
+        kwh_added = (hours * charge_rate) if hours < hours_to_full else (capacity - start_residual)
+        kwh_added += discharge_rate * hours         # discharge saved by charging
+        kwh_spare = kwh_min - reserve + kwh_added
+        plan['start_residual'] = start_residual
+        plan['start_soc'] = start_residual / capacity * 100
+        plan['kwh_added'] = kwh_added
+        for i in range(int(time_to_start), int(time_to_end)):
+            j = i + 1
+            # work out time (fraction of hour) when charging in hour from i to j
+            t = 0.0
+            charging = False
+            for (start_now, end_now) in intervals:
+                if start_now >= i and end_now < j:
+                    t += end_now - start_now            # start and end in same hour
+                elif start_now >= i and start_now < j and end_now >= j:
+                    t += j - start_now                  # start this hour but not end
+                elif end_now > i and end_now <= j and start_now <= i:
+                    t += end_now - i                    # end this hour but not start
+                elif start_now <= i and end_now > j:
+                    t += 1.0                            # complete hour inside start and end
+                charging = charging or (i >= start_now and i < end_now)
+            if charging:
+                work_mode_timed[i]['mode'] = 'ForceCharge'
+                work_mode_timed[i]['charge'] = charge_power * t
+                work_mode_timed[i]['max_soc'] = target_soc if target_soc is not None else inputs['max_soc']
+                work_mode_timed[i]['discharge'] *= (1-t)
+    # rebuild the battery residual with any charge added and min_soc
+    (bat_timed, x) = battery_timed(work_mode_timed, kwh_current, capacity, time_to_next=start_timed, config=bat_config)
+    end_residual = interpolate(time_to_end, bat_timed)          # residual when charge time ends
+    plan['work_mode'] = work_mode_timed
+    plan['bat'] = bat_timed
+    plan['kwh_needed'] = kwh_needed
+    plan['kwh_spare'] = kwh_spare
+    plan['hours'] = hours
+    plan['start_timed'] = start_timed
+    plan['end_timed'] = end_timed
+    plan['end_residual'] = end_residual
+    plan['end_soc'] = end_residual / capacity * 100
+    # charge times for set_charge(). First period is battery hold, second period is battery charge / hold
+    base_hour = inputs['base_hour']
+    start1 = round_time(base_hour + time_to_start / steps_per_hour)
+    start2 = round_time(base_hour + start_timed / steps_per_hour)
+    end1 = start1 if bat_hold == 0 else start2
+    end2 = round_time(base_hour + (end_timed if bat_hold == 0 else time_to_end) / steps_per_hour)
+    plan['charge_times'] = {'st1': start1, 'en1': end1, 'st2': start2, 'en2': end2}
+    return plan
+
+# return the agile import price for each step in time_line. base_time is the date and time of the first step
+def agile_timed(time_line, base_time=None, use=None):
+    global tariff, steps_per_hour
+    use = tariff if use is None else use
+    if use is None or use.get('agile') is None or use['agile'].get('prices') is None:
+        return None
+    prices = use['agile']['prices']
+    offset = hours_difference(base_time, use['agile'].get('base_time')) if base_time is not None else 0.0
+    by_hour = {p['hour']: p['price'] for p in prices}
+    return [by_hour.get(int((offset + i / steps_per_hour) * 2) / 2) for i in range(0, len(time_line))]
+
+# work modes used by arbitrage_plan(). Hold stops the battery discharging
+arbitrage_modes = ['SelfUse', 'Hold', 'ForceCharge', 'ForceDischarge']
+
+# energy flows for each work mode in a time step, with battery residual kwh, floor and ceiling in kWh and pv and load in kW
+# returns the change in battery residual and the grid import and export in kWh
+def arbitrage_step(mode, kwh, floor, ceiling, pv, load, a):
+    dt = 1 / steps_per_hour
+    pv_dc = min([a['charge_limit'], pv * a['pv_loss']])
+    load_dc = load / a['dc_ac_loss'] + a['operating_loss']
+    room = max([ceiling - kwh, 0.0]) / a['charge_loss'] / dt             # max DC power the battery can take
+    stored = max([kwh - floor, 0.0]) * a['discharge_loss'] / dt          # max DC power the battery can provide
+    grid_dc = 0.0
+    if mode == 2:
+        # force charge from grid and pv, load is supplied by the grid
+        bat_in = min([pv_dc + a['charge_power'], a['charge_limit'], room])
+        grid_dc = max([bat_in - pv_dc, 0.0])
+        bat_out = 0.0
+        net = pv_dc - bat_in + grid_dc - load_dc
+    elif mode == 3:
+        # force discharge up to the export limit
+        bat_out = min([a['discharge_limit'], stored, max([a['export_limit'] + load_dc - pv_dc, 0.0])])
+        bat_in = 0.0
+        net = pv_dc + bat_out - load_dc
+    else:
+        # self use / hold: pv surplus charges the battery, deficit is supplied by the battery (self use) or grid (hold)
+        net = pv_dc - load_dc
+        bat_in = min([net, room]) if net > 0.0 else 0.0
+        bat_out = min([-net, a['discharge_limit'], stored]) if net < 0.0 and mode == 0 else 0.0
+        net += bat_out - bat_in
+    kwh_import = (grid_dc / a['ac_dc_loss'] + (-net * a['dc_ac_loss'] if net < 0.0 else 0.0)) * dt
+    kwh_export = min([net, a['export_limit']]) * a['dc_ac_loss'] * dt if net > 0.0 else 0.0
+    return ((bat_in * a['charge_loss'] - bat_out / a['discharge_loss']) * dt, kwh_import, kwh_export)
+
+# find the lowest cost work mode for each step of the time line using dynamic programming over battery levels:
+#  inputs: the same inputs as charge_plan() with 'base_time' for the first step
+#  import_timed: import price for each step in p/kWh. The default is the agile prices
+#  export_timed: export price for each step or a single value. The default is tariff_config['export_price']
+#  levels: number of battery levels between min_soc and max_soc. Default 40
+#  segments: maximum number of schedule segments in the first 24 hours. The default is max_periods
+# returns a plan dict with the work modes, battery residual, cost and schedule segments for set_period()
+def arbitrage_plan(inputs, import_timed=None, export_timed=None, levels=None, segments=None):
+    global steps_per_hour, max_periods, tariff_config
+    config = inputs['config']
+    capacity = inputs['capacity']
+    time_line = inputs['time_line']
+    run_time = inputs['run_time']
+    import_timed = agile_timed(time_line, inputs.get('base_time'), use=inputs.get('tariff')) if import_timed is None else import_timed
+    if import_timed is None:
+        return None
+    known = [x for x in import_timed[:run_time] if x is not None]
+    if len(known) == 0:
+        return None
+    average = sum(known) / len(known)
+    import_timed = [x if x is not None else average for x in import_timed]
+    export_timed = tariff_config.get('export_price') if export_timed is None else export_timed
+    export_timed = [export_timed if export_timed is not None else 0.0] * run_time if type(export_timed) is not list else export_timed
+    levels = 40 if levels is None else levels
+    segments = max_periods if segments is None else segments
+    a = {k: inputs[k] for k in ['charge_limit', 'charge_power', 'discharge_limit', 'export_limit', 'charge_loss', 'discharge_loss', 'pv_loss', 'dc_ac_loss', 'operating_loss']}
+    a['ac_dc_loss'] = config['ac_dc_loss']
+    floor = capacity * inputs['min_soc'] / 100
+    ceiling = capacity * inputs['max_soc'] / 100
+    if ceiling <= floor:
+        return None
+    size = (ceiling - floor) / levels
+    grid = [floor + k * size for k in range(0, levels + 1)]
+    # value of energy left in the battery at the end of the time line
+    end_value = inputs['end_value'] if inputs.get('end_value') is not None else average * inputs['discharge_loss'] * inputs['dc_ac_loss']
+    day_steps = 24 * steps_per_hour
+    midnight = [(inputs['base_hour'] + i / steps_per_hour) == 24 for i in range(0, run_time)]
+    mode_range = range(0, len(arbitrage_modes))
+    # work modes after the first 24 hours are not in the schedule, so use SelfUse
+    step_modes = [mode_range if i < day_steps else [0] for i in range(0, run_time)]
+    # energy flows and cost for each step, level and mode
+    flows = []
+    for i in range(0, run_time):
+        pv = c_float(inputs['generation_timed'][i])
+        load = c_float(inputs['consumption_timed'][i])
+        step = []
+        for kwh in grid:
+            row = {}
+            for m in step_modes[i]:
+                (change, kwh_import, kwh_export) = arbitrage_step(m, kwh, floor, ceiling, pv, load, a)
+                x = min([max([(kwh + change - floor) / size, 0.0]), levels])
+                k = min([int(x), levels - 1])
+                row[m] = (kwh_import * import_timed[i] - kwh_export * export_timed[i], k, x - k)
+            step.append(row)
+        flows.append(step)
+    # penalty for starting a schedule segment at step i in mode m after mode p
+    def penalty(i, p, m, cost):
+        return cost if m != 0 and i < day_steps and (m != p or midnight[i]) else 0.0
+    # solve backwards from the end of the time line for a segment cost. Value is indexed by [previous mode][level]
+    def solve(cost):
+        value = [[(floor + k * size) * -end_value for k in range(0, levels + 1)] for p in mode_range]
+        values = [value]
+        for i in range(run_time - 1, -1, -1):
+            next_value = value
+            value = [[0.0] * (levels + 1) for p in mode_range]
+            for k in range(0, levels + 1):
+                options = {}
+                for m in step_modes[i]:
+                    (c, j, f) = flows[i][k][m]
+                    v = next_value[m]
+                    options[m] = c + v[j] + (v[j + 1] - v[j]) * f
+                for p in mode_range:
+                    value[p][k] = min([options[m] + penalty(i, p, m, cost) for m in step_modes[i]])
+            values.append(value)
+        return values[::-1]
+    # run forward from the current residual using the value function
+    def follow(values, cost):
+        kwh = inputs['residual']
+        p = arbitrage_modes.index(inputs['current_mode']) if inputs.get('current_mode') in arbitrage_modes else 0
+        path = []
+        for i in range(0, run_time):
+            pv = c_float(inputs['generation_timed'][i])
+            load = c_float(inputs['consumption_timed'][i])
+            best = None
+            for m in step_modes[i]:
+                (change, kwh_import, kwh_export) = arbitrage_step(m, kwh, floor, ceiling, pv, load, a)
+                c = kwh_import * import_timed[i] - kwh_export * export_timed[i]
+                x = min([max([(kwh + change - floor) / size, 0.0]), levels])
+                j = min([int(x), levels - 1])
+                v = values[i + 1][m]
+                total = c + penalty(i, p, m, cost) + v[j] + (v[j + 1] - v[j]) * (x - j)
+                if best is None or total < best[0]:
+                    best = (total, m, change, kwh_import, kwh_export, c)
+            (total, m, change, kwh_import, kwh_export, c) = best
+            path.append({'kwh': kwh, 'mode': m, 'import': kwh_import, 'export': kwh_export, 'cost': c})
+            kwh += change
+            p = m
+        path.append({'kwh': kwh})
+        count = sum(1 for i in range(0, min([run_time, day_steps])) if penalty(i, path[i - 1]['mode'] if i > 0 else -1, path[i]['mode'], 1.0) > 0.0)
+        return (path, count)
+    # find the smallest segment cost that keeps the schedule within the number of segments
+    cost = 0.0
+    (path, count) = follow(solve(cost), cost)
+    if count > segments:
+        low = 0.0
+        high = 1.0
+        result = None
+        for n in range(0, 20):
+            (trial, trial_count) = follow(solve(high), high)
+            if trial_count <= segments:
+                result = (trial, trial_count, high)
+                break
+            (low, high) = (high, high * 4)
+        if result is None:
+            return None
+        for n in range(0, 8):
+            middle = (low + high) / 2
+            (trial, trial_count) = follow(solve(middle), middle)
+            if trial_count <= segments:
+                result = (trial, trial_count, middle)
+                high = middle
+            else:
+                low = middle
+        (path, count, cost) = result
+    end_residual = path.pop()['kwh']
+    # build work modes in the same format as charge_plan()
+    work_mode_timed = []
+    for x in path:
+        mode = arbitrage_modes[x['mode']]
+        w = {'mode': 'SelfUse' if mode == 'Hold' else mode, 'min_soc': inputs['min_soc'], 'max_soc': inputs['max_soc'], 'fdpwr': 0, 'fdsoc': inputs['min_soc'],
+            'duration': 1.0, 'pv': 0.0, 'charge': 0.0, 'discharge': 0.0, 'fd_kwh': 0.0, 'hold': 1 if mode == 'Hold' else 0, 'kwh': x['kwh']}
+        if mode == 'ForceDischarge':
+            w['fdpwr'] = int(min([inputs['discharge_limit'], inputs['export_limit']]) * inputs['dc_ac_loss'] * 1000)
+        work_mode_timed.append(w)
+    plan = {'work_mode': work_mode_timed, 'bat': [x['kwh'] for x in path], 'modes': [arbitrage_modes[x['mode']] for x in path],
+        'cost': sum(x['cost'] for x in path), 'import': sum(x['import'] for x in path), 'export': sum(x['export'] for x in path),
+        'import_timed': import_timed[:run_time], 'segment_count': count, 'segment_cost': cost}
+    plan['end_residual'] = end_residual
+    plan['segments'] = charge_segments(work_mode_timed, inputs['base_hour'], inputs['min_soc'], capacity)
+    return plan
+
+# uncertainty as the standard deviation of the daily total and of each time step, as a fraction of the expected value
+uncertainty = {'generation': 0.30, 'consumption': 0.15, 'step': 0.10}
+robust_samples = 500                # number of generation and consumption samples
+robust_workers = 0                  # number of processes used to run samples, 0 runs them in this process
+
+# fit uncertainty from forecast_backtest() results and / or daily consumption from get_report()
+#  result: results from forecast_backtest(). source: the source to use, default is the source with the lowest daily error
+#  history: list of daily reports with 'total' from get_report()
+def fit_uncertainty(result=None, source=None, history=None):
+    global uncertainty
+    fitted = deepcopy(uncertainty)
+    if result is not None and len(result) > 0:
+        sources = [k for k in result.keys() if result[k]['all'] is not None and result[k]['all'].get('kwh_pct') is not None]
+        source = min(sources, key=lambda k: result[k]['all']['kwh_pct']) if source is None and len(sources) > 0 else source
+        if source in sources:
+            # mean absolute error to standard deviation for a normal distribution
+            fitted['generation'] = round(result[source]['all']['kwh_pct'] / 100 * math.sqrt(math.pi / 2), 3)
+    if history is not None:
+        totals = [h['total'] for h in history if h.get('total') is not None]
+        if len(totals) >= 3 and sum(totals) > 0.0:
+            mean = sum(totals) / len(totals)
+            fitted['consumption'] = round(math.sqrt(sum((x - mean) ** 2 for x in totals) / (len(totals) - 1)) / mean, 3)
+    return fitted
+
+# perturb a time line with a normal daily factor and a uniform step factor with the same standard deviation
+def sample_timed(timed, sigma, step, rng):
+    daily = max([1.0 + rng.gauss(0.0, sigma), 0.0])
+    width = step * math.sqrt(12)
+    return [c_float(x) * daily * max([1.0 + (rng.random() - 0.5) * width, 0.0]) for x in timed]
+
+# run count samples from sample index first and return the minimum battery residual for each sample
+# each sample has its own random generator, so the results do not depend on how the samples are split
+def robust_samples_min(inputs, spread, seed, count, first=0):
+    modes = strategy_timed(inputs['timed_mode'], inputs['time_line'], inputs['run_time'], min_soc=inputs['min_soc'], max_soc=inputs['max_soc'],
+        current_mode=inputs.get('current_mode'), strategy=inputs.get('strategy'))
+    plan_flows(inputs, modes, inputs['generation_timed'], inputs['consumption_timed'])
+    pv = []
+    discharge = []
+    kwh_current = []
+    for n in range(first, first + count):
+        rng = random.Random(f"{seed}:{n}")
+        generation_timed = sample_timed(inputs['generation_timed'], spread['generation'], spread['step'], rng)
+        consumption_timed = sample_timed(inputs['consumption_timed'], spread['consumption'], spread['step'], rng)
+        (charge_timed, discharge_timed) = plan_flows(inputs, [dict(w) for w in modes], generation_timed, consumption_timed)
+        pv.append(charge_timed)
+        discharge.append(discharge_timed)
+        kwh_current.append(inputs['residual'] - (charge_timed[0] - discharge_timed[0]) * (inputs['hour_now'] % 1))
+    (bat_list, min_list) = battery_batch(modes, kwh_current, inputs['capacity'], inputs['time_to_end'], kwh_min=inputs['capacity'],
+        pv=pv, discharge=discharge, config=plan_config(inputs))
+    return min_list
+
+# work out the charge needed to stay above min_soc with a probability, using samples of generation and consumption:
+#  inputs: the same inputs as charge_plan()
+#  probability: the probability of staying above min_soc. Default 0.9
+#  samples: the number of samples. Default is robust_samples
+#  workers: the number of processes to use. Default is robust_workers, 0 runs in this process
+#  spread: uncertainty to use. Default is f.uncertainty
+#  seed: seed for the random samples. Default is derived from the inputs, so the same inputs give the same result
+# returns the kWh needed and the contingency that provides the same charge in charge_plan()
+def charge_robust(inputs, probability=None, samples=None, workers=None, spread=None, seed=None):
+    global uncertainty, robust_samples, robust_workers
+    probability = 0.9 if probability is None else probability
+    samples = robust_samples if samples is None else samples
+    workers = robust_workers if workers is None else workers
+    spread = uncertainty if spread is None else spread
+    seed = int(plan_fingerprint(inputs), 16) if seed is None else seed
+    if samples < 1 or probability <= 0.0 or probability >= 1.0 or inputs['consumption'] <= 0.0:
+        return None
+    reserve = inputs['capacity'] * inputs['min_soc'] / 100
+    # minimum residual without any charge for the point forecast
+    kwh_point = robust_samples_min(inputs, {'generation': 0.0, 'consumption': 0.0, 'step': 0.0}, seed, 1)[0]
+    chunks = max([min([workers, samples // 100]), 1])
+    sizes = [samples // chunks + (1 if n < samples % chunks else 0) for n in range(0, chunks)]
+    firsts = [sum(sizes[:n]) for n in range(0, chunks)]
+    min_list = None
+    if chunks > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=chunks) as executor:
+                results = executor.map(robust_samples_min, [inputs] * chunks, [spread] * chunks, [seed] * chunks, sizes, firsts)
+                min_list = [x for result in results for x in result]
+        except Exception as e:
+            output(f"** charge_robust(): process pool failed, running in this process: {e}", 2)
+    if min_list is None:
+        min_list = [x for n in range(0, chunks) for x in robust_samples_min(inputs, spread, seed, sizes[n], firsts[n])]
+    needed = sorted(reserve - x for x in min_list)
+    kwh_needed = needed[min([int(math.ceil(probability * len(needed))) - 1, len(needed) - 1])]
+    kwh_extra = max([kwh_needed - (reserve - kwh_point), 0.0])
+    return {'samples': len(needed), 'probability': probability, 'kwh_needed': kwh_needed, 'kwh_point': reserve - kwh_point,
+        'contingency': kwh_extra / inputs['consumption'] * 100, 'point_probability': sum(1 for x in needed if x <= reserve - kwh_point) / len(needed),
+        'uncertainty': deepcopy(spread)}
+
+plan_save = 'plan_cache.txt'    # file in storage with the last plan and the settings applied, used to skip unchanged plans. None disables
+plan_cache = None               # last plan and settings applied, loaded from plan_save
+plan_apply_ttl = 6              # hours before charge times that have not changed are set again
+
+# load and save the plan cache
+def plan_cache_load():
+    global plan_save, plan_cache, storage
+    if plan_cache is None:
+        plan_cache = {}
+        if plan_save is not None and os.path.exists(storage + plan_save):
+            file = open(storage + plan_save)
+            plan_cache = json.load(file)
+            file.close()
+    return plan_cache
+
+def plan_cache_store():
+    global plan_save, plan_cache, storage
+    if plan_save is not None and plan_cache is not None:
+        file = open(storage + plan_save, 'w')
+        json.dump(plan_cache, file, sort_keys = True, indent=4, ensure_ascii= False)
+        file.close()
+    return
+
+# tariff values used by a plan: charge periods, name and agile prices
+def tariff_data(tariff):
+    if tariff is None:
+        return None
+    data = {k: v for k, v in tariff.items() if k[:8] == 'off_peak' or k[:4] == 'peak' or k == 'name'}
+    if tariff.get('agile') is not None and tariff['agile'].get('prices') is not None:
+        data['agile'] = {'prices': tariff['agile']['prices'], 'base_time': tariff['agile'].get('base_time')}
+    return data
+
+# round values so small changes in SoC, forecast and prices don't change a fingerprint
+def fingerprint_value(value, digits=2):
+    if type(value) is float:
+        return round(value, digits)
+    if type(value) is list or type(value) is tuple:
+        return [fingerprint_value(x, digits) for x in value]
+    if type(value) is dict:
+        return {k: fingerprint_value(v, digits) for k, v in value.items()}
+    return value
+
+# hash of the planning inputs: SoC to 1%, residual to 0.1kWh and time to the current time step
+def plan_fingerprint(data):
+    global steps_per_hour
+    if type(data) is not dict or data.get('time_line') is None:
+        return hashlib.md5(json.dumps(fingerprint_value(data), sort_keys=True, default=str).encode()).hexdigest()[:16]
+    inputs = {k: v for k, v in data.items() if k not in ['config', 'tariff', 'current_soc', 'residual', 'hour_now']}
+    inputs['current_soc'] = round(data['current_soc'])
+    inputs['residual'] = round(data['residual'], 1)
+    inputs['hour_now'] = int(data['hour_now'] * steps_per_hour) / steps_per_hour
+    inputs['config'] = data['config']
+    inputs['tariff'] = tariff_data(data['tariff'])
+    return plan_fingerprint([inputs, steps_per_hour])
+
+# run charge_plan() or use the cached plan when the fingerprint of the inputs has not changed
+def plan_cached(inputs):
+    cache = plan_cache_load()
+    key = plan_fingerprint(inputs)
+    if cache.get('key') == key and cache.get('plan') is not None:
+        output(f"\nPlan {key}: inputs unchanged, using cached plan", 2)
+        return cache['plan']
+    plan = charge_plan(inputs)
+    output(f"\nPlan {key}: new plan", 2)
+    cache['key'] = key
+    cache['plan'] = plan
+    plan_cache_store()
+    return plan
+
+# show the charge plan from charge_plan()
+def plan_output(inputs, plan):
+    if plan['test_charge'] is not None:
+        output(f"\nTest charge of {inputs['test_charge']}kWh")
+    if plan.get('kwh_added') is None:
+        output(f"\nNo charging needed:")
+    elif inputs['test_charge'] is None:
+        output(f"\nCharge needed: {plan['kwh_needed']:.2f}kWh ({hours_time(plan['charge_hours'])})")
+    output(f"  SoC now:     {inputs['current_soc']:.0f}% at {hours_time(inputs['hour_now'])} on {inputs['base_time'][:10]}")
+    if plan.get('kwh_added') is not None:
+        start_time = hours_time(adjusted_hour(plan['start_timed'], inputs['time_line']))
+        output(f"  Start SoC:   {plan['start_soc']:.0f}% at {start_time} ({plan['start_residual']:.2f}kWh)")
+        charge_times = f"{start_time}-{hours_time(adjusted_hour(plan['end_timed'], inputs['time_line']))}" if plan.get('charge_periods') is None \
+            else ", ".join(format_period(p) for p in plan['charge_periods'])
+        output(f"  Charge:      {charge_times}" + (f" at {plan['price']:.2f}p" if plan['price'] is not None else "") + f" ({plan['kwh_added']:.2f}kWh added)")
+    output(f"  End SoC:     {plan['end_soc']:.0f}% at {hours_time(adjusted_hour(inputs['time_to_end'], inputs['time_line']))} ({plan['end_residual']:.2f}kWh)")
+    output(f"  Contingency: {plan['kwh_spare'] / inputs['consumption'] * 100:.0f}%, {plan['kwh_spare']:.2f}kWh (using {inputs['contingency']:.0f}%)")
+    return
+
+# apply the charge plan from charge_plan(), using arbitrage_plan() if configured. Returns the work modes, battery and message used
+def plan_apply(inputs, plan, update_settings=0):
+    work_mode_timed = plan['work_mode']
+    bat_timed = plan['bat']
+    charge_message = plan['message']
+    if inputs['config'].get('arbitrage') == 1 and inputs['timed_mode'] > 1:
+        arbitrage = arbitrage_plan(inputs)
+        if arbitrage is not None:
+            work_mode_timed = arbitrage['work_mode']
+            bat_timed = arbitrage['bat']
+            charge_message = "arbitrage"
+            output(f"\nArbitrage: {arbitrage['cost']:.0f}p ({arbitrage['import']:.2f}kWh import, {arbitrage['export']:.2f}kWh export)")
+            output(f"  End SoC:     {arbitrage['end_residual'] / inputs['capacity'] * 100:.0f}% ({arbitrage['end_residual']:.2f}kWh)")
+    # setup charging, skipping charge times that were applied by a recent run
+    cache = plan_cache_load()
+    result = None
+    skip = False
+    if inputs['timed_mode'] > 1:
+        # set_schedule() compares the periods with the schedule on the inverter and only sends changes
+        periods = charge_periods(work_mode_timed, inputs['base_hour'], inputs['min_soc'], inputs['capacity'])
+        key = plan_fingerprint(periods)
+        if update_settings > 0:
+            result = set_schedule(periods = periods)
+    else:
+        key = plan_fingerprint(plan['charge_times'])
+        applied = cache.get('applied_time')
+        skip = update_settings > 0 and cache.get('applied') == key and applied is not None and time.time() - applied < plan_apply_ttl * 3600
+        result = set_charge(ch1=False, ch2=True, force=1, enable=update_settings if not skip else 0, **plan['charge_times'])
+    if skip:
+        output(f"\nSettings {key}: unchanged, not updated")
+    elif update_settings > 0 and result is not None:
+        if inputs['timed_mode'] <= 1:
+            output(f"\nSettings {key}: updated", 2)
+        cache['applied'] = key
+        cache['applied_time'] = time.time()
+        plan_cache_store()
+    if update_settings == 0:
+        output(f"\nNo changes made to charge settings")
+    return (work_mode_timed, bat_timed, charge_message)
+
+# show the battery SoC (show_data=1) or residual (show_data=2) for each hour of the plan
+def plan_data(inputs, bat_timed, show_data=1, start_t=0):
+    global steps_per_hour
+    config = inputs['config']
+    time_line = inputs['time_line']
+    data_wrap = config['data_wrap'] if config.get('data_wrap') is not None else 6
+    s = f"\nBattery Energy kWh:" if show_data == 2 else f"\nBattery SoC:"
+    h = inputs['base_hour']
+    t = start_t
+    while t < len(time_line) and bat_timed[t] is not None:
+        col = h % data_wrap
+        s += f"\n  {hours_time(time_line[t])}" if t == start_t or col == 0 else ""
+        s += f" {bat_timed[t]:5.2f}" if show_data == 2 else f"  {bat_timed[t] / inputs['capacity'] * 100:3.0f}%"
+        h += 1
+        t += steps_per_hour
+    output(s)
+    return
+
+# work out the charge times to set using the parameters:
+#  forecast: the kWh expected tomorrow. If none, forecast data is loaded from solcast etc
+#  consumption: the kWh consumed. If none, consumption is loaded from history
+#  update_settings: 0 no updates, 1 update charge settings. The default is 0
+#  show_data: 1 shows battery SoC, 2 shows battery residual. Default = 0
+#  show_plot: 1 plots battery SoC, 2 plots battery residual. Default = 1
+#  run_after: 0 over-rides 'forecast_times'. The default is 1.
+#  forecast_times: list of hours when forecast can be fetched (UTC)
+#  force_charge: 1 = hold battery, 2 = charge for whole period
+
+def charge_needed(forecast=None, consumption=None, update_settings=0, timed_mode=None, show_data=None, show_plot=None, run_after=None, reload=2,
+        forecast_times=None, force_charge=0, test_time=None, test_soc=None, test_charge=None, **settings):
+    global device, seasonality, solcast_api_key, debug_setting, tariff, solar_arrays, legend_location, time_shift, charge_needed_app_key
+    global timed_strategy, steps_per_hour, base_time, storage, battery, battery_params, max_periods, last_plan
+    print(f"\n---------------- charge_needed ----------------")
+    # validate parameters
+    args = locals()
+    s = ""
+    for k in [k for k in args.keys() if args[k] is not None and k != 'settings']:
+        s += f"\n  {k} = {args[k]}"
+    # store settings:
+    for key, value in settings.items():
+        if key not in charge_config:
+            print(f"** unknown configuration parameter: {key}")
+        else:
+            charge_config[key] = value
+            s += f"\n  {key} = {value}"
+    if len(s) > 0:
+        output(f"Parameters: {s}", 2)
     if tariff is not None:
         output(f"  tariff = {tariff['name']}", 2)
     # set default parameters
@@ -2913,7 +4672,7 @@ def charge_needed(forecast=None, consumption=None, update_settings=0, timed_mode
     if type(forecast_times) is not list:
         forecast_times = [forecast_times]
     # get dates and times
-    system_time = (datetime.now(tz=timezone.utc) + timedelta(hours=time_shift)) if test_time is None else convert_date(test_time)
+    system_time = (datetime.now(tz=timezone.utc) + timedelta(hours=time_shift)) if test_time is None else utc_date(test_time)
     time_offset = daylight_saving(system_time) if daylight_saving is not None else 0
     now = system_time + timedelta(hours=time_offset)
     today = datetime.strftime(now, '%Y-%m-%d')
@@ -3056,11 +4815,9 @@ def charge_needed(forecast=None, consumption=None, update_settings=0, timed_mode
     bms_loss = bms_power / 1000
     # work out charge limit, power and losses. Max power going to the battery after ac conversion losses
     ac_dc_loss = charge_config['ac_dc_loss']
-    charge_limit = min([charge_current * (bat_ocv + charge_current * bat_resistance) / 1000, max([6, device_power])])
+    (charge_limit, charge_power) = plan_charge_power(charge_config, charge_current, bat_ocv, bat_resistance, device_power, operating_loss, timed_mode)
     if charge_limit < 0.1:
         output(f"** charge_current is too low ({charge_current:.1f}A)")
-    force_charge_power = charge_config['force_charge_power'] if timed_mode > 1 and charge_config.get('force_charge_power') is not None else 100
-    charge_power = min([(device_power - operating_loss) * ac_dc_loss, force_charge_power * ac_dc_loss, charge_limit])
     float_charge = (charge_config['float_current'] if charge_config.get('float_current') is not None else 4) * bat_ocv / 1000
     pv_loss = charge_config['pv_loss']
     # work out discharge limit = max power coming from the battery before ac conversion losses
@@ -3092,6 +4849,7 @@ def charge_needed(forecast=None, consumption=None, update_settings=0, timed_mode
     if current_mode is not None:
         output(f"  Work Mode: {current_mode}")
     # get consumption data
+    history = None
     annual_consumption = charge_config['annual_consumption']
     if annual_consumption is not None:
         consumption = annual_consumption / 365 * seasonality[now.month - 1] / sum(seasonality) * 12
@@ -3123,19 +4881,28 @@ def charge_needed(forecast=None, consumption=None, update_settings=0, timed_mode
     daily_sum = sum(consumption_by_hour)
     consumption_timed = timed_list([consumption * x / daily_sum for x in consumption_by_hour], base_hour, run_time)
     # get Solcast data and produce time line
+    forecast_age = {}       # age in hours of the forecast data used
     solcast_value = None
     if forecast is None and solcast_api_key is not None and solcast_api_key != 'my.solcast_api_key' and (system_time.hour in forecast_times or run_after == 0):
-        fsolcast = Solcast(quiet=True, reload=reload, shading=charge_config.get('shading'), d=base_time)
+        fsolcast = get_forecast('solcast', day=forecast_day, reload=reload, shading=charge_config.get('shading'), d=base_time)
         if fsolcast is not None and hasattr(fsolcast, 'daily') and fsolcast.daily.get(forecast_day) is not None:
             solcast_value = fsolcast.daily[forecast_day]['kwh']
             solcast_timed = forecast_value_timed(fsolcast, today, tomorrow, base_hour, run_time, time_offset)
+            forecast_age['solcast'] = fsolcast.age
+            output(f"  Solcast data age: {fsolcast.age}h, API calls today: {fsolcast.calls}, API calls left: {fsolcast.quota}", 2)
+    elif forecast is None and solcast_api_key is not None and solcast_api_key != 'my.solcast_api_key' and forecast_background == 1 and forecast_due(forecast_times, system_time.hour):
+        forecast_refresh('solcast', shading=charge_config.get('shading'), d=base_time)
     # get forecast.solar data and produce time line
     solar_value = None
     if forecast is None and solar_arrays is not None and (system_time.hour in forecast_times or run_after == 0):
-        fsolar = Solar(quiet=True, shading=charge_config.get('shading'), d=base_time)
+        fsolar = get_forecast('solar', day=forecast_day, reload=reload, shading=charge_config.get('shading'), d=base_time)
         if fsolar is not None and hasattr(fsolar, 'daily') and fsolar.daily.get(forecast_day) is not None:
             solar_value = fsolar.daily[forecast_day]['kwh']
             solar_timed = forecast_value_timed(fsolar, today, tomorrow, base_hour, run_time, 0)
+            forecast_age['solar'] = fsolar.age
+            output(f"  Solar data age: {fsolar.age}h", 2)
+    elif forecast is None and solar_arrays is not None and forecast_background == 1 and forecast_due(forecast_times, system_time.hour):
+        forecast_refresh('solar', shading=charge_config.get('shading'), d=base_time)
     # choose expected value
     quarter = int(today[5:7] if charge_today else tomorrow[5:7]) // 3 % 4
     sun_name = seasonal_sun[quarter]['name']
@@ -3146,191 +4913,83 @@ def charge_needed(forecast=None, consumption=None, update_settings=0, timed_mode
     if forecast is not None:
         expected = forecast
         generation_timed = [expected * x / sun_sum for x in sun_timed]
+        forecast_sources = {'forecast': 1.0}
         output(f"\nForecast: {forecast:.1f}kWh")
+    elif charge_config['forecast_blend'] == 1 and (solcast_value is not None or solar_value is not None):
+        # blend the available forecasts and generation history
+        blend_values = {'solcast': solcast_value, 'solar': solar_value}
+        blend_timed = {'solcast': solcast_timed if solcast_value is not None else None, 'solar': solar_timed if solar_value is not None else None}
+        weights = blend_weights(sun_name)
+        if weights.get('history') is not None and weights['history'] > 0.0:
+            generation = generation_history(today if hour_now >= charge_config['use_today'] else yesterday, charge_config['generation_days'])
+            if generation is not None and generation > 0.0:
+                blend_values['history'] = generation
+                blend_timed['history'] = [generation * x / sun_sum for x in sun_timed]
+        (expected, used) = blend_forecasts(blend_values, weights)
+        generation_timed = blend_timed_forecasts(blend_timed, weights)
+        if expected is None or generation_timed is None:
+            (expected, generation_timed, used) = (solcast_value, solcast_timed, {'solcast': 1.0}) if solcast_value is not None else (solar_value, solar_timed, {'solar': 1.0})
+        forecast_sources = used
+        output(f"\nBlend: {tomorrow} {expected:.1f}kWh from " + ", ".join(f"{k} {w:.2f}" for k, w in used.items()))
     elif solcast_value is not None:
         expected = solcast_value
         generation_timed = solcast_timed
+        forecast_sources = {'solcast': 1.0}
         output(f"\nSolcast: {tomorrow} {fsolcast.daily[tomorrow]['kwh']:.1f}kWh")
     elif solar_value is not None:
         expected = solar_value
         generation_timed = solar_timed
+        forecast_sources = {'solar': 1.0}
         output(f"\nSolar: {tomorrow} {fsolar.daily[tomorrow]['kwh']:.1f}kWh")
     else:
         # no forecast, use generation data
-        generation = None
-        last_date = today if hour_now >= charge_config['use_today'] else yesterday
-        gen_days = charge_config['generation_days']
-        history = get_raw('week', d=last_date, v=['pvPower','meterPower2'], summary=2)
-        pv_history = {}
-        if history is not None and len(history) > 0:
-            for day in history:
-                date = day['date']
-                if pv_history.get(date) is None:
-                    pv_history[date] = 0.0
-                if day.get('kwh') is not None and day.get('kwh_neg') is not None:
-                    pv_history[date] += day['kwh_neg'] / 0.92 if day['variable'] == 'meterPower2' else day['kwh']
-            pv_sum = sum([pv_history[d] for d in sorted(pv_history.keys())[-gen_days:]])
-            output(f"\nGeneration (kWh):")
-            s = ""
-            for d in sorted(pv_history.keys())[-gen_days:]:
-                s += f" {d} {pv_history[d]:4.1f},"
-            output(' ' + s[:-1])
-            generation = pv_sum / gen_days
-            output(f"  Average of last {gen_days} days: {generation:.1f}kWh")
+        generation = generation_history(today if hour_now >= charge_config['use_today'] else yesterday, charge_config['generation_days'])
         if generation is None or generation == 0.0:
             output(f"\nNo generation data available")
             output_close()
             return None
         expected = generation
         generation_timed = [expected * x / sun_sum for x in sun_timed]
+        forecast_sources = {'history': 1.0}
         if charge_config['forecast_selection'] == 1 and update_settings > 0:
             output(f"\nSettings will not be updated when forecast is not available")
             update_settings = 0
-    # produce time lines for charge, discharge and work mode
-    charge_timed = [min([charge_limit, c_float(x) * pv_loss]) for x in generation_timed]
-    discharge_timed = [min([discharge_limit, c_float(x) / dc_ac_loss]) + operating_loss for x in consumption_timed]
-    work_mode_timed = strategy_timed(timed_mode, time_line, run_time, min_soc=min_soc, max_soc=max_soc, current_mode=current_mode)
-    for i in range(0, len(work_mode_timed)):
-        # get work mode
-        work_mode = work_mode_timed[i]['mode']
-        duration = work_mode_timed[i]['duration']
-        # apply changes due to work mode
-        if timed_mode > 0 and work_mode == 'ForceCharge':
-            discharge_timed[i] = discharge_timed[i] * (1.0 - duration)
-            work_mode_timed[i]['charge'] = charge_power * duration
-        elif timed_mode > 0 and 'ForceDischarge' in work_mode:
-            fdpwr = work_mode_timed[i]['fdpwr'] / dc_ac_loss / 1000
-            work_mode_timed[i]['fd_kwh'] = min([discharge_limit, export_limit + discharge_timed[i], fdpwr]) * duration
-        elif bat_hold > 0 and i >= int(time_to_start) and i < int(time_to_end):
-            discharge_timed[i] = operating_loss
-            work_mode_timed[i]['hold'] = 1
-        elif timed_mode > 0 and work_mode == 'Backup':
-            discharge_timed[i] = operating_loss if charge_timed[i] == 0.0 else 0.0
-        elif timed_mode > 0 and work_mode == 'Feedin':
-            (discharge_timed[i], charge_timed[i]) = (0.0 if (charge_timed[i] >= discharge_timed[i]) else (discharge_timed[i] - charge_timed[i]),
-                0.0 if (charge_timed[i] <= export_limit + discharge_timed[i]) else (charge_timed[i] - export_limit - discharge_timed[i]))
-        else: # work_mode == 'SelfUse'
-            (discharge_timed[i], charge_timed[i]) = (0.0 if (charge_timed[i] >= discharge_timed[i]) else (discharge_timed[i] - charge_timed[i]),
-                0.0 if (charge_timed[i] <= discharge_timed[i]) else (charge_timed[i] - discharge_timed[i]))
-        work_mode_timed[i]['pv'] = charge_timed[i]
-        work_mode_timed[i]['discharge'] = discharge_timed[i]
-    # build the battery residual if we don't add any charge and don't limit discharge at min_soc
-    kwh_current = residual - (charge_timed[0] - discharge_timed[0]) * (hour_now % 1)
-    (bat_timed, kwh_min) = battery_timed(work_mode_timed, kwh_current, capacity, time_to_next=time_to_end, kwh_min=capacity)
-    # work out what we need to add to stay above reserve and provide contingency or to hit target_soc
-    contingency = charge_config['special_contingency'] if tomorrow[-5:] in charge_config['special_days'] else charge_config['contingency']
-    contingency = contingency[quarter] if type(contingency) is list else contingency
-    kwh_contingency = consumption * contingency / 100
-    kwh_needed = reserve + kwh_contingency - kwh_min
-    start_residual = interpolate(time_to_start, bat_timed)      # residual when charge time starts
-    end_residual = interpolate(time_to_end, bat_timed)          # residual when charge time ends without charging
-    target_soc = charge_config.get('target_soc')
-    target_kwh = capacity if full_charge is not None or bat_hold == 2 else (target_soc / 100 * capacity) if target_soc is not None else 0
-    if target_kwh > (end_residual + kwh_needed):
-        kwh_needed = target_kwh - end_residual
-    elif test_charge is not None:
-        output(f"\nTest charge of {test_charge}kWh")
-        kwh_needed = test_charge
-        charge_message = "** test charge **"
-    # work out charge needed
-    if kwh_min > reserve and kwh_needed < charge_config['min_kwh'] and test_charge is None:
-        output(f"\nNo charging needed:")
-        output(f"  SoC now:     {current_soc:.0f}% at {hours_time(hour_now)} on {today}")
-        charge_message = "no charge needed"
-        kwh_needed = 0.0
-        kwh_spare = kwh_min - reserve
-        hours = 0.0
-        start_timed = time_to_end
-        end_timed = time_to_end
-    else:
-        # work out time to add kwh_needed to battery
-        charge_rate = charge_power * charge_loss
-        discharge_rate = max([(start_residual - end_residual) / charge_time - bms_loss, 0.0])
-        hours = kwh_needed / charge_rate
-        if test_charge is None:
-            output(f"\nCharge needed: {kwh_needed:.2f}kWh ({hours_time(hours)})")
-            charge_message = "with charge added"
-        output(f"  SoC now:     {current_soc:.0f}% at {hours_time(hour_now)} on {today}")
-        # check if charge time exceeded or charge needed exceeds capacity
-        hours_to_full = (capacity - end_residual) / charge_rate
-        if hours > charge_time or bat_hold == 2:
-            hours = charge_time
-        elif hours > hours_to_full:
-            kwh_shortfall = kwh_needed - (capacity - end_residual)        # amount of energy that won't be added
-            required = (hours_to_full + kwh_shortfall / discharge_rate) if discharge_rate > 0.0 else charge_time
-            hours = required if required > hours and required < charge_time else charge_time
-        # round charge time
-        min_hours = charge_config['min_hours']
-        hours = int(hours / min_hours + 0.99) * min_hours
-        # rework charge and discharge
-        charge_period = get_best_charge_period(start_at, hours)
-        charge_offset = round_time(charge_period['start'] - start_at) if charge_period is not None else charge_time - hours
-        price = charge_period.get('price') if charge_period is not None else None
-        start_timed = time_to_start + charge_offset * steps_per_hour
-        end_timed = start_timed + hours * steps_per_hour
-        start_residual = interpolate(start_timed, bat_timed)
-        start_soc = start_residual / capacity * 100
-        kwh_added = (hours * charge_rate) if hours < hours_to_full else (capacity - start_residual)
-        kwh_added += discharge_rate * hours         # discharge saved by charging
-        kwh_spare = kwh_min - reserve + kwh_added
-        output(f"  Start SoC:   {start_soc:.0f}% at {hours_time(adjusted_hour(start_timed, time_line))} ({start_residual:.2f}kWh)")
-        output(f"  Charge:      {hours_time(adjusted_hour(start_timed, time_line))}-{hours_time(adjusted_hour(end_timed, time_line))}"
-            + (f" at {price:.2f}p" if price is not None else "") + f" ({kwh_added:.2f}kWh added)")
-        for i in range(int(time_to_start), int(time_to_end)):
-            j = i + 1
-            # work out time (fraction of hour) when charging in hour from i to j
-            if start_timed >= i and end_timed < j:
-                t = end_timed - start_timed         # start and end in same hour
-            elif start_timed >= i and start_timed < j and end_timed >= j:
-                t = j - start_timed                 # start this hour but not end
-            elif end_timed > i and end_timed <= j and start_timed <= i:
-                t = end_timed - i                   # end this hour but not start
-            elif start_timed <= i and end_timed > j:
-                t = 1.0                             # complete hour inside start and end
-            else:
-                t = 0.0                             # complete hour before start or after end
-            output(f"i = {i}, j = {j}, t = {t}", 3)
-            if i >= start_timed and i < end_timed:
-                work_mode_timed[i]['mode'] = 'ForceCharge'
-                work_mode_timed[i]['charge'] = charge_power * t
-                work_mode_timed[i]['max_soc'] = target_soc if target_soc is not None else max_soc
-                work_mode_timed[i]['discharge'] *= (1-t)
-    # rebuild the battery residual with any charge added and min_soc
-    (bat_timed, x) = battery_timed(work_mode_timed, kwh_current, capacity, time_to_next=start_timed)
-    end_residual = interpolate(time_to_end, bat_timed)          # residual when charge time ends
-    end_soc = end_residual / capacity * 100
+    # work out the charge plan
+    special_day = tomorrow[-5:] in charge_config['special_days']
+    contingency = plan_contingency(charge_config, quarter, special_day)
+    inputs = {'base_hour': base_hour, 'hour_now': hour_now, 'time_line': time_line, 'run_time': run_time,
+        'time_to_start': time_to_start, 'time_to_end': time_to_end, 'charge_time': charge_time, 'start_at': start_at,
+        'bat_hold': bat_hold, 'full_charge': full_charge, 'capacity': capacity, 'residual': residual, 'current_soc': current_soc,
+        'min_soc': min_soc, 'max_soc': max_soc, 'charge_limit': charge_limit, 'charge_power': charge_power,
+        'discharge_limit': discharge_limit, 'export_limit': export_limit, 'float_charge': float_charge,
+        'charge_loss': charge_loss, 'discharge_loss': discharge_loss, 'pv_loss': pv_loss, 'dc_ac_loss': dc_ac_loss,
+        'operating_loss': operating_loss, 'bms_loss': bms_loss, 'timed_mode': timed_mode, 'current_mode': current_mode,
+        'strategy': get_strategy(timed_mode=timed_mode), 'consumption': consumption, 'consumption_timed': consumption_timed,
+        'generation_timed': generation_timed, 'contingency': contingency, 'test_charge': test_charge, 'config': charge_config, 'tariff': tariff,
+        'max_periods': max_periods, 'base_time': base_time, 'quarter': quarter, 'special_day': special_day}
+    if charge_config.get('probability') is not None:
+        # replace contingency with the charge needed to stay above min_soc with the probability requested
+        robust = charge_robust(inputs, probability=charge_config['probability'], spread=fit_uncertainty(history=history))
+        if robust is not None:
+            contingency = robust['contingency']
+            inputs['contingency'] = contingency
+            output(f"\nProbability: {robust['probability'] * 100:.0f}% needs {robust['kwh_needed']:.2f}kWh above min_soc ({robust['samples']} samples)")
+            output(f"  Uncertainty: generation {robust['uncertainty']['generation'] * 100:.0f}%, consumption {robust['uncertainty']['consumption'] * 100:.0f}%", 2)
+    plan = plan_cached(inputs)
     # show the results
-    output(f"  End SoC:     {end_soc:.0f}% at {hours_time(adjusted_hour(time_to_end, time_line))} ({end_residual:.2f}kWh)")
-    output(f"  Contingency: {kwh_spare / consumption * 100:.0f}%, {kwh_spare:.2f}kWh (using {contingency:.0f}%)")
+    plan_output(inputs, plan)
     if not charge_today:
         output(f"  PV cover:    {expected / consumption * 100:.0f}% ({expected:.1f}/{consumption:.1f})")
-    # setup charging
-    if timed_mode > 1:
-        periods = charge_periods(work_mode_timed, base_hour, min_soc, capacity)
-        if update_settings > 0:
-            set_schedule(periods = periods)
-    else:
-        # work out the charge times and set. First period is battery hold, second period is battery charge / hold
-        start1 = round_time(base_hour + time_to_start / steps_per_hour)
-        start2 = round_time(base_hour + start_timed / steps_per_hour)
-        end1 = start1 if bat_hold == 0 else start2
-        end2 = round_time(base_hour + (end_timed if bat_hold == 0 else time_to_end) / steps_per_hour)
-        set_charge(ch1=False, st1=start1, en1=end1, ch2=True, st2=start2, en2=end2, force=1, enable=update_settings)
-    if update_settings == 0:
-        output(f"\nNo changes made to charge settings")
+    (work_mode_timed, bat_timed, charge_message) = plan_apply(inputs, plan, update_settings)
+    # keep the plan for charge_update()
+    last_plan = {'inputs': inputs, 'plan': plan, 'time': system_time, 'fetched': {'forecast': system_time, 'consumption': system_time},
+        'args': {k: args[k] for k in ['forecast', 'consumption', 'timed_mode', 'show_plot', 'run_after', 'reload', 'forecast_times', 'force_charge', 'test_charge']},
+        'saved': {'forecast_age': forecast_age, 'forecast_sources': forecast_sources, 'device': {'power': device_power, 'current': device_current,
+        'bms_current': bms_charge_current, 'bat_ocv': bat_ocv, 'bat_resistance': bat_resistance}}}
+    last_plan_store()
     start_t = 0 #int(hour_now % 1 + 0.5) * steps_per_hour
     if show_data > 0:
-        data_wrap = charge_config['data_wrap'] if charge_config.get('data_wrap') is not None else 6
-        s = f"\nBattery Energy kWh:" if show_data == 2 else f"\nBattery SoC:"
-        h = base_hour
-        t = start_t
-        while t < len(time_line) and bat_timed[t] is not None:
-            col = h % data_wrap
-            s += f"\n  {hours_time(time_line[t])}" if t == start_t or col == 0 else ""
-            s += f" {bat_timed[t]:5.2f}" if show_data == 2 else f"  {bat_timed[t] / capacity * 100:3.0f}%"
-            h += 1
-            t += steps_per_hour
-        output(s)
+        plan_data(inputs, bat_timed, show_data, start_t)
     if show_plot > 0:
         print()
         plt.figure(figsize=(figure_width, figure_width/2))
@@ -3357,30 +5016,167 @@ def charge_needed(forecast=None, consumption=None, update_settings=0, timed_mode
         plt.grid()
         plt.legend(fontsize=8, loc='upper right')
         plot_show()
-    if charge_config.get('save') is not None:
-        file_name = charge_config['save'].replace('###', today)
-        data = {}
-        data['base_time'] = base_time
-        data['hour_now'] = hour_now
-        data['current_soc'] = current_soc
-        data['steps'] = steps_per_hour
-        data['capacity'] = capacity
-        data['config'] = charge_config
-        data['time'] = time_line
-        data['work_mode'] = work_mode_timed
-        data['generation'] = generation_timed
-        data['consumption'] = consumption_timed
-        file = open(storage + file_name, 'w')
-        json.dump(data, file, sort_keys = True, indent=4, ensure_ascii= False)
-        file.close()
+    charge_save(inputs, work_mode_timed, last_plan['saved'])
     output_close(plot=show_plot)
     return None
 
+# save the data for a plan to charge_config['save'] for charge_compare() and charge_replay()
+#  saved: forecast_age, forecast_sources and device values from charge_needed()
+def charge_save(inputs, work_mode_timed, saved):
+    global charge_config, steps_per_hour, storage
+    if charge_config.get('save') is None:
+        return
+    file_name = charge_config['save'].replace('###', inputs['base_time'][:10])
+    data = {}
+    data['base_time'] = inputs['base_time']
+    data['hour_now'] = inputs['hour_now']
+    data['current_soc'] = inputs['current_soc']
+    data['steps'] = steps_per_hour
+    data['capacity'] = inputs['capacity']
+    data['config'] = charge_config
+    data['time'] = inputs['time_line']
+    data['work_mode'] = work_mode_timed
+    data['generation'] = inputs['generation_timed']
+    data['consumption'] = inputs['consumption_timed']
+    data['forecast_age'] = saved['forecast_age']
+    data['forecast_sources'] = saved['forecast_sources']
+    # planning inputs and tariff for charge_replay()
+    data['inputs'] = {k: v for k, v in inputs.items() if k not in ['config', 'tariff', 'time_line', 'generation_timed', 'consumption_timed']}
+    if inputs.get('tariff') is not None:
+        data['tariff'] = tariff_data(inputs['tariff'])
+    data['device'] = saved['device']
+    file = open(storage + file_name, 'w')
+    json.dump(data, file, sort_keys = True, indent=4, ensure_ascii= False)
+    file.close()
+    return
+
+##################################################################################################
+# CHARGE_UPDATE - re-plan from the current battery state using the inputs from the last charge_needed()
+##################################################################################################
+
+last_plan = None                                    # inputs, plan and fetch times from the last charge_needed(), used by charge_update()
+last_plan_save = 'last_plan.txt'                    # file in storage used to keep last_plan between runs. None keeps it in memory only
+replan_ttl = {'forecast': 6, 'consumption': 24}     # hours before charge_update() runs charge_needed() to fetch the forecast or consumption again
+
+# save last_plan to last_plan_save so charge_update() can use it in a new process
+# config and tariff are not saved, the current charge_config and tariff are used when it is loaded
+def last_plan_store():
+    global last_plan, last_plan_save, storage
+    if last_plan is None or last_plan_save is None:
+        return
+    data = dict(last_plan)
+    data['inputs'] = {k: v for k, v in last_plan['inputs'].items() if k not in ['config', 'tariff']}
+    data['time'] = utc_date(last_plan['time']).isoformat()
+    data['fetched'] = {k: utc_date(v).isoformat() for k, v in last_plan['fetched'].items()}
+    file = open(storage + last_plan_save, 'w')
+    json.dump(data, file, sort_keys = True, indent=4, ensure_ascii= False)
+    file.close()
+    return
+
+# load last_plan from last_plan_save if there is no plan in memory
+def last_plan_load():
+    global last_plan, last_plan_save, storage, charge_config, tariff
+    if last_plan is None and last_plan_save is not None and os.path.exists(storage + last_plan_save):
+        file = open(storage + last_plan_save)
+        data = json.load(file)
+        file.close()
+        data['inputs']['config'] = charge_config
+        data['inputs']['tariff'] = tariff
+        data['time'] = datetime.fromisoformat(data['time'])
+        data['fetched'] = {k: datetime.fromisoformat(v) for k, v in data['fetched'].items()}
+        last_plan = data
+    return last_plan
+
+# re-anchor the inputs from a previous plan at the current hour with the current SoC and work mode
+# the time lines are moved forward to the new base hour. Returns None if this is not possible e.g. the charge period has started
+def replan_inputs(inputs, base_time_now, hour_now, current_soc, residual, current_mode=None):
+    global steps_per_hour
+    shift = int(round(hours_difference(base_time_now, inputs['base_time']) * steps_per_hour))
+    base_hour = int(hour_now)
+    if shift < 0 or shift >= inputs['run_time']:
+        return None
+    if inputs['time_to_start'] - shift <= (hour_now - base_hour) * steps_per_hour:
+        return None
+    if inputs['time_line'][shift] != round_time(base_hour):
+        return None
+    updated = dict(inputs)
+    for k in ['time_line', 'generation_timed', 'consumption_timed']:
+        updated[k] = inputs[k][shift:]
+    updated['run_time'] = inputs['run_time'] - shift
+    updated['time_to_start'] = inputs['time_to_start'] - shift
+    updated['time_to_end'] = inputs['time_to_end'] - shift
+    updated['base_hour'] = base_hour
+    updated['base_time'] = base_time_now
+    updated['hour_now'] = hour_now
+    updated['current_soc'] = current_soc
+    updated['residual'] = residual
+    updated['current_mode'] = current_mode
+    if inputs.get('strategy') is not None:
+        updated['strategy'] = [dict(s, valid_for=[i - shift for i in s['valid_for'] if i >= shift]) if s.get('valid_for') is not None else s for s in inputs['strategy']]
+    return updated
+
+# re-plan the charge using the last plan from charge_needed(), the current time and the current SoC:
+#  update_settings: 0 no updates, 1 update charge settings. The default is 0
+#  show_data: 1 shows battery SoC, 2 shows battery residual. Default = 0
+#  test_time, test_soc: optional time and SoC to use for testing
+# Only the battery SoC and work mode are fetched and the updated plan is saved to charge_config['save'].
+# The last plan is kept in last_plan_save in storage, so charge_update() can be run from a new process.
+# charge_needed() is run instead if there is no previous plan, the forecast or consumption is older than
+# replan_ttl or the charge period has started
+def charge_update(update_settings=0, show_data=0, test_time=None, test_soc=None):
+    global last_plan, replan_ttl, time_shift, steps_per_hour, base_time, battery, charge_config, charge_needed_app_key
+    system_time = (datetime.now(tz=timezone.utc) + timedelta(hours=time_shift)) if test_time is None else utc_date(test_time)
+    if last_plan_load() is None:
+        output(f"\nNo previous plan, running charge_needed()")
+        return charge_needed(update_settings=update_settings, show_data=show_data, test_time=test_time, test_soc=test_soc)
+    args = {**last_plan['args'], 'update_settings': update_settings, 'show_data': show_data, 'test_time': test_time, 'test_soc': test_soc}
+    expired = [k for k in replan_ttl.keys() if hours_difference(system_time, utc_date(last_plan['fetched'][k])) >= replan_ttl[k]]
+    if len(expired) > 0:
+        output(f"\nUpdating {', '.join(expired)}, running charge_needed()")
+        return charge_needed(**args)
+    time_offset = daylight_saving(system_time) if daylight_saving is not None else 0
+    now = system_time + timedelta(hours=time_offset)
+    hour_now = now.hour + now.minute / 60
+    base_time_now = datetime.strftime(now, '%Y-%m-%d') + f" {hours_time(now.hour)}"
+    inputs = last_plan['inputs']
+    capacity = inputs['capacity']
+    if test_soc is not None:
+        current_soc = test_soc
+        residual = capacity * test_soc / 100
+    else:
+        get_battery()
+        if battery is None or battery['status'] == 0:
+            return None
+        current_soc = battery['soc']
+        residual = battery['residual'] if charge_config.get('capacity') is None else capacity * current_soc / 100
+    updated = replan_inputs(inputs, base_time_now, hour_now, current_soc, residual, get_work_mode())
+    if updated is None:
+        output(f"\nPrevious plan can't be used at {hours_time(hour_now)}, running charge_needed()")
+        return charge_needed(**args)
+    print(f"\n---------------- charge_update ----------------")
+    output_spool(charge_needed_app_key)
+    base_time = base_time_now
+    started = time.time()
+    plan = plan_cached(updated)
+    output(f"\nUpdated plan from {last_plan['inputs']['base_time']} ({(time.time() - started) * 1000:.1f}ms)", 2)
+    plan_output(updated, plan)
+    (work_mode_timed, bat_timed, charge_message) = plan_apply(updated, plan, update_settings)
+    if show_data > 0:
+        plan_data(updated, bat_timed, show_data)
+    last_plan['inputs'] = updated
+    last_plan['plan'] = plan
+    last_plan['time'] = system_time
+    last_plan_store()
+    if last_plan.get('saved') is not None:
+        charge_save(updated, work_mode_timed, last_plan['saved'])
+    output_close()
+    return None
+
 ##################################################################################################
 # CHARGE_COMPARE - load saved data and compare with actual
 ##################################################################################################
 
-def charge_compare(save=None, v=None, show_data=1, show_plot=3):
+def charge_compare(save=None, v=None, show_data=1, show_plot=3, d=None):
     global charge_config, storage
     now = convert_date(d)
     yesterday = datetime.strftime(datetime.date(now - timedelta(days=1)), '%Y-%m-%d')
@@ -3417,33 +5213,16 @@ def charge_compare(save=None, v=None, show_data=1, show_plot=3):
     if v is None:
         v = ['pvPower', 'loadsPower', 'SoC']
     actuals = get_history('day', d=date_list(s=start_day, e=end_day, today=1), v=v)
-    plots = {}
+    t_base = dst_timestamp(base_time)
+    grid = [t_base + int(i * 3600 / steps_per_hour) for i in range(0, run_time)]
+    methods = {var: 'nearest' if var == 'SoC' else 'mean' for var in v}
+    plots = align_history(actuals, grid=grid, method=methods, interval=60 / steps_per_hour)
+    del plots['time']
     names = {}
-    count = {}
-    n = int(12 / steps_per_hour)
     for d in actuals:
-        var = d['variable']
-        name = d['name'] if d.get('name') is not None else var
-        if plots.get(var) is None:
-            plots[var] = [None] * run_time
-            count[var] = [0] * run_time
-            names[var] = name
-        for i in range(0, len(d.get('data'))):
-            value = d['data'][i]['value']
-            if value is not None and var == 'SoC':
-                value *= capacity / 100     # convert % to kWh
-            time = d['data'][i]['time'][:16]
-            t = int(hours_difference(time, base_time) * steps_per_hour)
-            if t >= 0 and t < run_time:
-                if plots[var][t] is None:
-                    plots[var][t] = value
-                    count[var][t] = 1
-                elif var != 'SoC':
-                    plots[var][t] += value
-                    count[var][t] += 1
-    for v in plots.keys():
-        for i in range(0, run_time):
-            plots[v][i] = plots[v][i] / count[v][i] if count[v][i] > 0 else None
+        names[d['variable']] = d['name'] if d.get('name') is not None else d['variable']
+    if plots.get('SoC') is not None:
+        plots['SoC'] = [value * capacity / 100 if value is not None else None for value in plots['SoC']]     # convert % to kWh
     start_t = 0 #int(hour_now % 1 + 0.5) * steps_per_hour
     if show_data > 0 and plots.get('SoC') is not None:
         data_wrap = charge_config['data_wrap'] if charge_config.get('data_wrap') is not None else 6
@@ -3488,6 +5267,338 @@ def charge_compare(save=None, v=None, show_data=1, show_plot=3):
         plot_show()
     return
 
+##################################################################################################
+# CHARGE_REPLAY - re-run charge_plan() for saved days and score the plan against actuals
+##################################################################################################
+
+replay_prices = {'off_peak': 10.0, 'peak': 30.0}      # import prices in p/kWh when agile prices were not saved
+replay_workers = 0                                      # number of processes used to replay days, 0 runs in this process
+
+# load the actual generation and consumption in kW for a day, in steps from local midnight
+def replay_actuals(date, steps=None):
+    global ct2_calibration, steps_per_hour
+    steps = steps_per_hour if steps is None else steps
+    result = get_history('day', d=date, v=['pvPower', 'meterPower2', 'loadsPower'], summary=0)
+    if result is None or type(result) is not list:
+        return None
+    timed = {var['variable']: rescale_history(var.get('data'), steps) for var in result}
+    if timed.get('pvPower') is None or timed.get('loadsPower') is None:
+        return None
+    ct2 = timed['meterPower2'] if timed.get('meterPower2') is not None else [None] * len(timed['pvPower'])
+    pv = [(p + (c / ct2_calibration if c is not None and c > 0.0 else 0.0)) if p is not None else None for p, c in zip(timed['pvPower'], ct2)]
+    return {'date': date, 'pv': pv, 'load': timed['loadsPower']}
+
+# load the inputs saved by charge_needed() for a day
+def replay_inputs(date, save=None):
+    global storage, charge_config
+    save = charge_config.get('save') if save is None else save
+    if save is None or not os.path.exists(storage + save.replace('###', date)):
+        return None
+    file = open(storage + save.replace('###', date))
+    data = json.load(file)
+    file.close()
+    if data.get('inputs') is None:
+        return None
+    inputs = data['inputs']
+    inputs['config'] = data['config']
+    inputs['tariff'] = data['tariff'] if data.get('tariff') is not None else {}
+    inputs['time_line'] = data['time']
+    inputs['generation_timed'] = data['generation']
+    inputs['consumption_timed'] = data['consumption']
+    inputs['steps'] = data['steps']
+    inputs['device'] = data.get('device')
+    return inputs
+
+# import price for each step from saved agile prices or replay_prices
+def replay_import(inputs):
+    global replay_prices
+    prices = agile_timed(inputs['time_line'], inputs.get('base_time'), use=inputs['tariff']) if inputs['tariff'].get('agile') is not None else None
+    periods = [v for k, v in inputs['tariff'].items() if k[:8] == 'off_peak']
+    periods = [{'start': inputs['start_at'], 'end': round_time(inputs['start_at'] + inputs['charge_time'])}] if len(periods) == 0 else periods
+    flat = [replay_prices['off_peak'] if hour_in(h, periods) else replay_prices['peak'] for h in inputs['time_line']]
+    return [p if p is not None else x for p, x in zip(prices, flat)] if prices is not None else flat
+
+# work out the consumption estimate from actual loads for the days before the run (used when consumption_days is changed)
+def replay_consumption(inputs, loads):
+    days = [x for x in loads if x is not None]
+    if len(days) == 0:
+        return None
+    steps = len(days[0]) // 24
+    by_hour = [sum(c_float(day[h * steps + i]) for day in days for i in range(0, steps)) / steps / len(days) for h in range(0, 24)]
+    consumption = sum(by_hour)
+    if consumption <= 0.0:
+        return None
+    return (consumption, timed_list(by_hour, inputs['base_hour'], inputs['run_time']))
+
+# re-run charge_plan() for a day using saved inputs and changed settings, then score the plan using actual generation and consumption
+def replay_day(inputs, actual_pv, actual_load, settings=None, consumption=None):
+    global steps_per_hour
+    inputs = dict(inputs)
+    config = {**inputs['config'], **(settings if settings is not None else {})}
+    inputs['config'] = config
+    if consumption is not None:
+        (inputs['consumption'], inputs['consumption_timed']) = consumption
+    if settings is not None and settings.get('min_soc') is not None:
+        inputs['min_soc'] = settings['min_soc']
+    if settings is not None and settings.get('max_soc') is not None:
+        inputs['max_soc'] = settings['max_soc']
+    device = inputs.get('device')
+    if settings is not None and device is not None and len([k for k in ['charge_current', 'force_charge_power', 'ac_dc_loss'] if k in settings]) > 0:
+        charge_current = device['current'] if config['charge_current'] is None else config['charge_current']
+        if device['bms_current'] is not None and device['bms_current'] < charge_current:
+            charge_current = device['bms_current']
+        (inputs['charge_limit'], inputs['charge_power']) = plan_charge_power(config, charge_current, device['bat_ocv'], device['bat_resistance'], device['power'],
+            inputs['operating_loss'], inputs['timed_mode'])
+    if inputs.get('quarter') is not None:
+        inputs['contingency'] = plan_contingency(config, inputs['quarter'], inputs.get('special_day'))
+    if config.get('probability') is not None:
+        robust = charge_robust(inputs, probability=config['probability'], workers=0, seed=0)
+        inputs['contingency'] = robust['contingency'] if robust is not None else inputs['contingency']
+    plan = charge_plan(inputs)
+    # work modes with the actual generation and consumption and the charge from the plan
+    capacity = inputs['capacity']
+    charge_power = inputs['charge_power']
+    modes = strategy_timed(inputs['timed_mode'], inputs['time_line'], inputs['run_time'], min_soc=inputs['min_soc'], max_soc=inputs['max_soc'],
+        current_mode=inputs.get('current_mode'), strategy=inputs.get('strategy'))
+    (pv, discharge) = plan_flows(inputs, modes, actual_pv, actual_load)
+    grid_load = [0.0] * len(modes)
+    for i in range(0, len(modes)):
+        w = plan['work_mode'][i]
+        if w['mode'] == 'ForceCharge' and modes[i]['mode'] != 'ForceCharge' and w['charge'] > 0.0:
+            t = w['charge'] / charge_power
+            modes[i]['mode'] = 'ForceCharge'
+            modes[i]['charge'] = w['charge']
+            modes[i]['max_soc'] = w['max_soc']
+            grid_load[i] = modes[i]['discharge'] * t
+            modes[i]['discharge'] *= (1 - t)
+    kwh_current = inputs['residual'] - (pv[0] - discharge[0]) * (inputs['hour_now'] % 1)
+    (bat, x) = battery_timed(modes, kwh_current, capacity, time_to_next=plan['start_timed'], config=plan_config(inputs))
+    # estimate grid import: grid charge, load moved to the grid during charging and load the battery could not supply
+    prices = replay_import(inputs)
+    kwh_import = 0.0
+    kwh_charge = 0.0
+    cost = 0.0
+    for i in range(0, len(modes)):
+        w = modes[i]
+        bat_next = bat[i + 1] if i + 1 < len(bat) else bat[i]
+        charge = 0.0
+        if w['charge'] > 0.0 and bat[i] < capacity * w['max_soc'] / 100:
+            charge = min([w['charge'], inputs['charge_limit'] - w['pv']]) / inputs['config']['ac_dc_loss'] / steps_per_hour
+        supplied = max([(bat[i] - bat_next) * steps_per_hour + w['pv'] * inputs['charge_loss'], 0.0]) * inputs['discharge_loss']
+        unmet = max([w['discharge'] - supplied, 0.0]) + grid_load[i]
+        kwh = charge + unmet * inputs['dc_ac_loss'] / steps_per_hour
+        kwh_charge += charge
+        kwh_import += kwh
+        cost += kwh * prices[i]
+    return {'date': inputs['base_time'][:10], 'contingency': inputs['contingency'], 'kwh_needed': plan['kwh_needed'], 'hours': plan['hours'],
+        'charge': kwh_charge, 'import': kwh_import, 'cost': cost, 'min_soc': min(bat) / capacity * 100, 'end_soc': bat[-1] / capacity * 100,
+        'below': min(bat) < capacity * inputs['min_soc'] / 100 - 0.01}
+
+# wrapper for process pool
+def replay_task(task):
+    return replay_day(*task)
+
+# load saved inputs for each day from s to e that match steps_per_hour
+def replay_runs(s, e=None):
+    global steps_per_hour
+    dates = date_list(s=s, e=s if e is None else e, limit=366)
+    return [x for x in [replay_inputs(d) for d in dates] if x is not None and x['steps'] == steps_per_hour]
+
+# days of actuals used for the consumption estimate when consumption_days or consumption_span are changed
+def replay_history(inputs, settings):
+    if settings.get('consumption_days') is None and settings.get('consumption_span') is None:
+        return []
+    config = {**inputs['config'], **settings}
+    days = config['consumption_days']
+    days = 3 if days > 7 or days < 1 else days
+    start = datetime.strptime(inputs['base_time'][:10], '%Y-%m-%d')
+    if config['consumption_span'] == 'weekday':
+        return date_list(span='weekday', e=datetime.strftime(start + timedelta(days=1), '%Y-%m-%d'), today=2)[-days-1:-1]
+    last = start if inputs['hour_now'] >= config['use_today'] else start - timedelta(days=1)
+    return date_list(e=datetime.strftime(last, '%Y-%m-%d'), span='week', today=2)[-days:]
+
+# build replay tasks for a list of cells (run, settings). Returns a task for each cell or None if actuals are not available
+# history is loaded using up to history_workers threads
+def replay_tasks(cells):
+    global history_workers
+    need = set()
+    spans = []
+    for (inputs, settings) in cells:
+        start = inputs['base_time'][:10]
+        steps = inputs['steps']
+        count = (inputs['base_hour'] * steps + inputs['run_time'] - 1) // (24 * steps) + 1
+        span = [datetime.strftime(datetime.strptime(start, '%Y-%m-%d') + timedelta(days=n), '%Y-%m-%d') for n in range(0, count)]
+        history = replay_history(inputs, settings)
+        spans.append((span, history))
+        need.update(span + history)
+    need = sorted(need)
+    with ThreadPoolExecutor(max_workers=max([history_workers, 1])) as executor:
+        actuals = {a['date']: a for a in executor.map(replay_actuals, need) if a is not None}
+    tasks = []
+    for (inputs, settings), (span, history) in zip(cells, spans):
+        if len([d for d in span if actuals.get(d) is None]) > 0:
+            tasks.append(None)
+            continue
+        offset = inputs['base_hour'] * inputs['steps']
+        pv = [c_float(x) for d in span for x in actuals[d]['pv']][offset: offset + inputs['run_time']]
+        load = [c_float(x) for d in span for x in actuals[d]['load']][offset: offset + inputs['run_time']]
+        consumption = replay_consumption(inputs, [actuals[d]['load'] if actuals.get(d) is not None else None for d in history]) if len(history) > 0 else None
+        tasks.append((inputs, pv, load, settings, consumption))
+    return tasks
+
+# run replay tasks in a process pool, falling back to this process
+def replay_run(tasks, workers=None, name='charge_replay'):
+    global replay_workers
+    workers = replay_workers if workers is None else workers
+    results = None
+    if workers > 1 and len(tasks) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(replay_task, tasks))
+        except Exception as e:
+            output(f"** {name}(): process pool failed, running in this process: {e}", 2)
+    if results is None:
+        results = [replay_task(task) for task in tasks]
+    return results
+
+# totals for a list of replayed days
+def replay_summary(results):
+    n = len(results)
+    return {'days': n, 'import': sum(x['import'] for x in results), 'charge': sum(x['charge'] for x in results), 'cost': sum(x['cost'] for x in results),
+        'min_soc': min(x['min_soc'] for x in results), 'avg_min_soc': sum(x['min_soc'] for x in results) / n, 'below': sum(1 for x in results if x['below'])}
+
+# replay charge_needed() for each saved day from s to e with changed settings:
+#  s, e: the first and last date to replay (YYYY-MM-DD). The default for e is s
+#  settings: optional dict of charge_config settings to change e.g. {'contingency': 20, 'min_hours': 1.0}
+#  workers: number of processes to use. The default is replay_workers, 0 runs in this process
+#  show: 1 shows a summary, 2 also shows each day
+# returns a dict with the results for each day and a summary
+def charge_replay(s, e=None, settings=None, workers=None, show=1):
+    global replay_workers
+    workers = replay_workers if workers is None else workers
+    settings = {} if settings is None else settings
+    runs = replay_runs(s, e)
+    if len(runs) == 0:
+        output(f"** charge_replay(): no saved charge_needed() data with inputs from {s} to {e}")
+        return None
+    tasks = [x for x in replay_tasks([(inputs, settings) for inputs in runs]) if x is not None]
+    started = time.time()
+    results = replay_run(tasks, workers)
+    elapsed = time.time() - started
+    if len(results) == 0:
+        output(f"** charge_replay(): no actual data available from {s} to {e}")
+        return None
+    summary = replay_summary(results)
+    summary['seconds'] = round(elapsed, 3)
+    n = summary['days']
+    if show > 0:
+        print(f"\nCharge replay from {results[0]['date']} to {results[-1]['date']}" + (f" with {settings}" if len(settings) > 0 else ""))
+        if show > 1:
+            print(f"  {'date':<10} {'cont%':>6} {'hours':>6} {'charge':>7} {'import':>7} {'cost':>7} {'min SoC':>8} {'end SoC':>8}")
+            for x in results:
+                print(f"  {x['date']:<10} {x['contingency']:6.1f} {x['hours']:6.2f} {x['charge']:7.2f} {x['import']:7.2f} {x['cost'] / 100:7.2f} {x['min_soc']:7.0f}% {x['end_soc']:7.0f}%")
+        print(f"  Days:        {n} ({summary['seconds']:.2f}s)")
+        print(f"  Import:      {summary['import']:.1f}kWh ({summary['charge']:.1f}kWh grid charge), {summary['import'] / n:.2f}kWh per day")
+        print(f"  Cost:        {summary['cost'] / 100:.2f}, {summary['cost'] / n / 100:.2f} per day")
+        print(f"  Min SoC:     {summary['min_soc']:.0f}% (average {summary['avg_min_soc']:.0f}%), {summary['below']} days below min_soc")
+    return {'days': results, 'summary': summary}
+
+
+##################################################################################################
+# CHARGE_SWEEP - rank charge_config settings by replaying saved days
+##################################################################################################
+
+sweep_save = 'charge_sweep.txt'     # file in storage used to keep replay results between runs. None disables
+sweep_cache = None                  # replay results by cell key, loaded from sweep_save
+
+# short hash of settings or saved inputs, used to key cells in the sweep cache
+def sweep_key(data):
+    return hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+# load and save the sweep cache
+def sweep_load():
+    global sweep_save, sweep_cache, storage
+    if sweep_cache is None:
+        sweep_cache = {}
+        if sweep_save is not None and os.path.exists(storage + sweep_save):
+            file = open(storage + sweep_save)
+            sweep_cache = json.load(file)
+            file.close()
+    return sweep_cache
+
+def sweep_store():
+    global sweep_save, sweep_cache, storage
+    if sweep_save is not None and sweep_cache is not None:
+        file = open(storage + sweep_save, 'w')
+        json.dump(sweep_cache, file, sort_keys = True, indent=4, ensure_ascii= False)
+        file.close()
+    return
+
+# list of settings from a grid of values e.g. {'contingency': [10, 20, 30], 'min_soc': [10, 15]}
+def sweep_grid(grid, samples=None, seed=None):
+    settings = [{}]
+    for k in sorted(grid.keys()):
+        values = grid[k] if type(grid[k]) is list else [grid[k]]
+        settings = [{**x, k: v} for x in settings for v in values]
+    if samples is not None and samples < len(settings):
+        settings = random.Random(seed).sample(settings, samples)
+    return settings
+
+# evaluate each combination of charge_config settings over saved days and rank them:
+#  s, e: the first and last date to replay (YYYY-MM-DD). The default for e is s
+#  grid: dict of charge_config settings with a list of values to try e.g. {'contingency': [10, 20, 30], 'min_soc': [10, 15]}
+#  samples: optional number of combinations to pick at random from the grid, using seed
+#  rank: summary value used to rank the settings, lowest first e.g. 'cost', 'import', 'below'
+#  workers: number of processes to use. The default is replay_workers, 0 runs in this process
+#  show: number of settings to show, 0 for none
+# results are cached per day and settings so extending the grid or the dates only replays the new cells
+# returns a list of settings with their summary in ranked order
+def charge_sweep(s, e=None, grid=None, samples=None, seed=None, rank='cost', workers=None, show=10):
+    global replay_workers
+    workers = replay_workers if workers is None else workers
+    settings_list = sweep_grid(grid if grid is not None else {}, samples, seed)
+    runs = replay_runs(s, e)
+    if len(runs) == 0:
+        output(f"** charge_sweep(): no saved charge_needed() data with inputs from {s} to {e}")
+        return None
+    cache = sweep_load()
+    run_keys = [f"{inputs['base_time'][:10]} {sweep_key(inputs)}" for inputs in runs]
+    keys = [[f"{k} {sweep_key(settings)}" for k in run_keys] for settings in settings_list]
+    cells = {}
+    for settings, row in zip(settings_list, keys):
+        for inputs, key in zip(runs, row):
+            if cache.get(key) is None and cells.get(key) is None:
+                cells[key] = (inputs, settings)
+    started = time.time()
+    if len(cells) > 0:
+        new_keys = list(cells.keys())
+        tasks = replay_tasks([cells[k] for k in new_keys])
+        ready = [(k, t) for k, t in zip(new_keys, tasks) if t is not None]
+        output(f"\nReplaying {len(ready)} new days for {len(settings_list)} settings", 2)
+        for (k, t), r in zip(ready, replay_run([t for k, t in ready], workers, 'charge_sweep')):
+            cache[k] = r
+        sweep_store()
+    elapsed = time.time() - started
+    ranked = []
+    for settings, row in zip(settings_list, keys):
+        results = [cache[k] for k in row if cache.get(k) is not None]
+        if len(results) == 0:
+            continue
+        ranked.append({'settings': settings, 'summary': replay_summary(results)})
+    if len(ranked) == 0:
+        output(f"** charge_sweep(): no actual data available from {s} to {e}")
+        return None
+    ranked = sorted(ranked, key=lambda x: x['summary'][rank])
+    if show > 0:
+        print(f"\nCharge sweep from {runs[0]['base_time'][:10]} to {runs[-1]['base_time'][:10]}: {len(ranked)} settings, {len(cells)} new days replayed ({elapsed:.2f}s)")
+        print(f"  {'rank':>4} {'days':>4} {'import':>7} {'cost':>7} {'min SoC':>8} {'below':>5}  settings")
+        for i, x in enumerate(ranked[:show]):
+            y = x['summary']
+            n = y['days']
+            print(f"  {i + 1:4} {n:4} {y['import'] / n:7.2f} {y['cost'] / n / 100:7.2f} {y['min_soc']:7.0f}% {y['below']:5}  {x['settings']}")
+    return ranked
+
+
 ##################################################################################################
 # Battery Info / Battery Monitor
 ##################################################################################################
@@ -3825,8 +5936,10 @@ def get_pvoutput(d = None, tou = 0):
     # apply calibration and merge raw_data for meterPower2 into pvPower:
     pv_index = v.index('pvPower')
     ct2_index = v.index('meterPower2')
-    for i, data in enumerate(raw_data[ct2_index]['data']):
-        raw_data[pv_index]['data'][i]['value'] += data['value'] / ct2_calibration if data['value'] > 0.0 else 0
+    pv_times = history_timestamps(raw_data[pv_index])
+    ct2_values = align_values(history_timestamps(raw_data[ct2_index]), [data['value'] for data in raw_data[ct2_index]['data']], pv_times, 'nearest', sample_time * 60)
+    for i, value in enumerate(ct2_values):
+        raw_data[pv_index]['data'][i]['value'] += value / ct2_calibration if value is not None and value > 0.0 else 0
     # kwh is positive for generation
     raw_data[pv_index]['kwh'] = raw_data[pv_index]['kwh'] / pv_calibration + raw_data[ct2_index]['kwh'] / ct2_calibration
     pv_max = max(data['value'] for data in raw_data[pv_index]['data'])
@@ -4001,6 +6114,90 @@ def get_suntimes(date, utc=0):
     set = hours_time(time_hours(sun_times[month][1]) * (1-part) + time_hours(sun_times[month1][1]) * part + time_offset)
     return (rise, set)
 
+##################################################################################################
+# forecast values for a day held as a fixed set of 48 x 30 minute slots (pt30) or 24 hours (hourly)
+##################################################################################################
+
+class ForecastSlots(dict):
+    """
+    Dictionary of forecast values for a day with a fixed set of slots, in time order.
+    pt30 values are keyed by time 'HH:MM' and hourly values are keyed by hour, as before.
+    Values can also be read and set by position, including negative positions, and slices return lists.
+    """
+
+    def __init__(self, values, step=0.5):
+        values = list(values)
+        keys = list(range(0, len(values))) if step == 1 else [hours_time(i * step) for i in range(0, len(values))]
+        super().__init__(zip(keys, values))
+        self.step = step        # hours per slot
+
+    def key(self, key):
+        # return the dictionary key for a key or position, or None if there is no slot
+        if type(key) is str:
+            h = time_hours(key)
+            i = int(h / self.step) if h is not None else None
+            key = i if i is not None and i * self.step == h else None
+        elif type(key) is int and key < 0:
+            key += len(self)
+        if type(key) is not int or key < 0 or key >= len(self):
+            return None
+        return key if self.step == 1 else hours_time(key * self.step)
+
+    def __getitem__(self, key):
+        if type(key) is slice:
+            return list(self.values())[key]
+        k = self.key(key)
+        if k is None:
+            raise KeyError(key)
+        return dict.__getitem__(self, k)
+
+    def __setitem__(self, key, value):
+        k = self.key(key)
+        if k is None:
+            raise KeyError(key)
+        dict.__setitem__(self, k, value)
+
+    def __contains__(self, key):
+        return self.key(key) is not None
+
+    def get(self, key, default=None):
+        k = self.key(key)
+        return dict.__getitem__(self, k) if k is not None else default
+
+# return hourly values from 30 minute values
+def hourly_slots(pt30):
+    values = list(pt30.values())
+    return ForecastSlots([(values[i] + values[i + 1]) / 2 for i in range(0, 48, 2)], step=1)
+
+# return a forecast day from a list of 48 x 30 minute values
+def forecast_day(values, sun):
+    pt30 = ForecastSlots(values)
+    return {'pt30': pt30, 'hourly': hourly_slots(pt30), 'kwh': 0.0, 'sun': sun}
+
+# return shading multipliers for each 30 minute slot using sunrise / sunset times and shading settings
+def shading_mask(shading, sun, quarter):
+    mask = [1.0] * 48
+    if shading.get('adjust') is not None:
+        loss = shading['adjust'] if type(shading['adjust']) is not list else shading['adjust'][quarter]
+        mask = [m * loss for m in mask]
+    if shading.get('am_delay') is not None:
+        delay = shading['am_delay'] if type(shading['am_delay']) is not list else shading['am_delay'][quarter]
+        shaded = time_hours(sun[0]) + delay
+        mask = [m * shading['am_loss'] if i / 2 < shaded else m for i, m in enumerate(mask)]
+    if shading.get('pm_delay') is not None:
+        delay = shading['pm_delay'] if type(shading['pm_delay']) is not list else shading['pm_delay'][quarter]
+        shaded = time_hours(sun[1]) - delay
+        mask = [m * shading['pm_loss'] if i / 2 > shaded else m for i, m in enumerate(mask)]
+    return mask
+
+# apply shading and calculate hourly values and total for a forecast day
+def forecast_totals(day, mask=None):
+    pt30 = day['pt30'] if mask is None else ForecastSlots([v * m for v, m in zip(day['pt30'].values(), mask)])
+    day['pt30'] = pt30
+    day['hourly'] = hourly_slots(pt30)
+    day['kwh'] = sum(pt30.values()) / 2
+    return
+
 ##################################################################################################
 # Code for loading and displaying yield forecasts from Solcast.com.au.
 ##################################################################################################
@@ -4010,6 +6207,52 @@ solcast_url = 'https://api.solcast.com.au/'
 solcast_api_key = None
 solcast_rids = []       # no longer used, rids loaded from solcast.com
 solcast_save = 'solcast.txt'
+solcast_max_age = 1     # hours before a rooftop is refreshed when reload = 1
+solcast_workers = 4     # number of rooftops to load at the same time
+solcast_quota = {}      # API call limit from the last response: {'limit', 'remaining', 'reset'}
+solcast_daily_limit = 10    # maximum API calls made each day (UTC). None for no limit
+solcast_calls = {}      # API calls made today: {'date', 'count'}
+
+# save the API call limit information from a response
+def solcast_rate_limit(response):
+    global solcast_quota
+    for k, h in [('limit', 'x-rate-limit'), ('remaining', 'x-rate-limit-remaining'), ('reset', 'x-rate-limit-reset')]:
+        if response.headers.get(h) is not None:
+            solcast_quota[k] = c_int(response.headers[h])
+    return
+
+# return the 30 minute values (UTC) for each day from the forecasts for a rid. Missing slots are None
+def solcast_slots(forecasts):
+    slots = {}
+    for f in forecasts if forecasts is not None else []:
+        period_end = f.get('period_end')
+        date = period_end[:10]
+        i = int(round_time(time_hours(period_end[11:16]) - 0.5) * 2)
+        if slots.get(date) is None:
+            slots[date] = [None] * 48
+        slots[date][i] = c_float(f.get('pv_estimate')) + (slots[date][i] if slots[date][i] is not None else 0.0)
+    return slots
+
+# return the number of API calls left or None if not known
+def solcast_quota_left():
+    global solcast_quota
+    if solcast_quota.get('remaining') is None:
+        return None
+    if solcast_quota.get('reset') is not None and time.time() > solcast_quota['reset']:
+        return None
+    return solcast_quota['remaining']
+
+# return the number of API calls made today (UTC), using the count saved in data if it is higher
+def solcast_calls_today(data=None):
+    global solcast_calls
+    today = datetime.now(tz=timezone.utc).strftime('%Y-%m-%d')
+    if solcast_calls.get('date') != today:
+        solcast_calls = {'date': today, 'count': 0}
+    saved = data.get('calls') if data is not None else None
+    if saved is not None and saved.get('date') == today and saved.get('count', 0) > solcast_calls['count']:
+        solcast_calls['count'] = saved['count']
+    return solcast_calls['count']
+
 page_width = 100        # maximum text string for display
 
 class Solcast :
@@ -4017,13 +6260,15 @@ class Solcast :
     Load Solcast Estimate / Actuals / Forecast daily yield
     """ 
 
-    def __init__(self, days = 7, reload = 2, quiet = False, estimated=0, shading=None, d=None) :
+    def __init__(self, days = 7, reload = 2, quiet = False, estimated=0, shading=None, d=None, max_age=None) :
         # days sets the number of days to get for forecasts (and estimated if enabled)
         # reload: 0 = use solcast.json, 1 = load new forecast, 2 = use solcast.json if date matches
+        # max_age: hours before a rooftop is refreshed when reload = 1. The default is solcast_max_age
         # The forecasts and estimated both include the current date, so the total number of days covered is 2 * days - 1.
         # The forecasts and estimated also both include the current time, so the data has to be de-duplicated to get an accurate total for a day
-        global debug_setting, solcast_url, solcast_api_key, solcast_save, storage
+        global debug_setting, solcast_url, solcast_api_key, solcast_save, storage, solcast_quota, solcast_workers, solcast_daily_limit, solcast_calls
         now = convert_date(d)
+        self.max_age = max_age
         self.shading = None if shading is None else shading if shading.get('solcast') is None else shading['solcast'] 
         self.today = datetime.strftime(datetime.date(now), '%Y-%m-%d')
         self.quarter = int(self.today[5:7]) // 3 % 4
@@ -4032,8 +6277,6 @@ class Solcast :
         self.save = solcast_save #.replace('.', '_%.'.replace('%', self.today.replace('-','')))
         self.data = {}
         self.rids = []
-        if reload == 1 and os.path.exists(storage + self.save):
-            os.remove(storage + self.save)
         if self.save is not None and os.path.exists(storage + self.save):
             file = open(storage + self.save)
             self.data = json.load(file)
@@ -4041,12 +6284,23 @@ class Solcast :
             if len(self.data) == 0:
                 print(f"No data in {self.save}")
             else:
-                self.rids = self.data['forecasts'].keys() if self.data.get('forecasts') is not None else []
-                if reload == 2 and self.data.get('date') is not None and self.data['date'] != self.today:
-                    self.data = {}
-                elif debug_setting > 0 and not quiet:
-                    print(f"Using data for {self.data['date']} from {self.save}")
-        if len(self.data) == 0 :
+                self.rids = list(self.data['forecasts'].keys()) if self.data.get('forecasts') is not None else []
+                if len(solcast_quota) == 0 and self.data.get('quota') is not None:
+                    solcast_quota.update(self.data['quota'])
+        types = ['forecasts'] if estimated == 0 else ['forecasts', 'estimated_actuals']
+        stale = self.stale(types, reload)
+        left = solcast_quota_left()
+        calls = solcast_calls_today(self.data)
+        if len(stale) > 0 and len(self.rids) > 0 and len(self.stale(types, 0)) == 0:
+            if left is not None and left < len(stale):
+                if debug_setting > 0 and not quiet:
+                    print(f"Solcast: {left} API calls left, using saved data from {self.save}")
+                stale = []
+            elif solcast_daily_limit is not None and calls + len(stale) > solcast_daily_limit:
+                if debug_setting > 0 and not quiet:
+                    print(f"Solcast: {calls} of {solcast_daily_limit} API calls made today, using saved data from {self.save}")
+                stale = []
+        if len(stale) > 0 or len(self.rids) == 0:
             if solcast_api_key is None or solcast_api_key == 'my.solcast_api_key>':
                 print(f"\nSolcast: solcast_api_key not set, exiting")
                 return
@@ -4056,6 +6310,7 @@ class Solcast :
                     print(f"Getting rids from solcast.com")
                 params = {'format' : 'json'}
                 response = requests.get(solcast_url + 'rooftop_sites', auth = self.credentials, params = params)
+                solcast_calls['count'] += 1
                 if response.status_code != 200:
                     if response.status_code == 429:
                         print(f"\nSolcast API call limit reached for today")
@@ -4064,28 +6319,52 @@ class Solcast :
                     return
                 sites = response.json().get('sites')
                 self.rids = [s['resource_id'] for s in sites]
+                stale = self.stale(types, reload)
             if debug_setting > 0 and not quiet:
-                print(f"Getting forecast for {self.today} from solcast.com")
-            self.data['date'] = self.today
-            params = {'format' : 'json', 'hours' : 168, 'period' : 'PT30M'}     # always get 168 x 30 min values
-            for t in ['forecasts'] if estimated == 0 else ['forecasts', 'estimated_actuals']:
-                self.data[t] = {}
+                print(f"Getting forecast for {self.today} from solcast.com ({len(stale)} of {len(types) * len(self.rids)} updates)")
+            with ThreadPoolExecutor(max_workers=solcast_workers) as executor:
+                responses = list(executor.map(lambda x: self.fetch(x[0], x[1]), stale))
+            solcast_calls['count'] += len([r for r in responses if r is not None])
+            for (t, rid), response in zip(stale, responses):
+                if response is None:
+                    continue
+                if self.data.get(t) is None:
+                    self.data[t] = {}
+                if response.status_code == 200:
+                    self.data[t][rid] = response.json().get(t)
+                    if t == 'forecasts':
+                        archive_forecast('solcast', rid, solcast_slots(self.data[t][rid]), utc=1)
+                elif response.status_code != 304:
+                    if response.status_code == 429:
+                        solcast_quota['remaining'] = 0
+                        if solcast_quota.get('reset') is None:
+                            solcast_quota['reset'] = int(datetime.combine(datetime.now(tz=timezone.utc).date() + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc).timestamp())
+                        print(f"\nSolcast: API call limit reached for today")
+                    else:
+                        print(f"Solcast: response code getting {t} for {rid} was {response.status_code}: {response.reason}")
+                    continue
+                self.fetched(t, rid, response)
+            for t in types:
                 for rid in self.rids:
-                    response = requests.get(solcast_url + 'rooftop_sites/' + rid + '/' + t, auth = self.credentials, params = params)
-                    if response.status_code != 200 :
-                        if response.status_code == 429:
-                            print(f"\nSolcast: API call limit reached for today")
-                        else:
-                            print(f"Solcast: response code getting {t} was {response.status_code}: {response.reason}")
+                    if self.data.get(t) is None or self.data[t].get(rid) is None:
                         return
-                    self.data[t][rid] = response.json().get(t)
+            self.data['date'] = self.today
+            self.data['quota'] = solcast_quota
+            self.data['calls'] = solcast_calls
             if self.save is not None:
                 file = open(storage + self.save, 'w')
                 json.dump(self.data, file, sort_keys = True, indent=4, ensure_ascii= False)
                 file.close()
+        elif debug_setting > 0 and not quiet:
+            print(f"Using data for {self.data['date']} from {self.save}")
+        self.quota = solcast_quota_left()
+        self.calls = solcast_calls_today(self.data)
+        self.age = self.data_age(types)
         self.daily = {}
         estimated = 0 if self.data.get('estimated_actuals') is None else 1
         loaded = {}     # track what we have loaded so we don't duplicate between forecast and actuals
+        slots = {}      # 30 minute values for each day
+        present = {}    # track the slots loaded for each day
         for t in ['forecasts'] if estimated == 0 else ['forecasts', 'estimated_actuals']:
             for rid in self.data[t].keys() :            # aggregate sites
                 if loaded.get(rid) is None:
@@ -4096,15 +6375,15 @@ class Solcast :
                         loaded[rid][period_end] = t
                     elif loaded[rid][period_end] != t:
                         continue
-                    value = c_float(f.get('pv_estimate'))
                     date = period_end[:10]
-                    time = round_time(time_hours(period_end[11:16])-0.5)
-                    key = hours_time(time)
-                    if date not in self.daily.keys() :
-                        self.daily[date] = {'pt30': {}, 'hourly': {}, 'kwh': 0.0, 'sun': get_suntimes(date, utc=1)}
-                    if self.daily[date]['pt30'].get(key) is None:
-                        self.daily[date]['pt30'][key] = 0.0
-                    self.daily [date]['pt30'][key] += value
+                    i = int(round_time(time_hours(period_end[11:16]) - 0.5) * 2)
+                    if date not in slots.keys() :
+                        slots[date] = [0.0] * 48
+                        present[date] = [False] * 48
+                    slots[date][i] += c_float(f.get('pv_estimate'))
+                    present[date][i] = True
+        for date in slots.keys():
+            self.daily[date] = forecast_day(slots[date], get_suntimes(date, utc=1))
         # ignore first and last dates as these only cover part of the day, so are not accurate
         self.keys = sorted(self.daily.keys())[estimated:-1]
         self.days = len(self.keys)
@@ -4112,48 +6391,69 @@ class Solcast :
         while self.days > days * (1 + estimated) :
             self.keys = self.keys[estimated:-1]
             self.days = len(self.keys)
-        # fill out forecast to cover 24 hours and set forecast start time
+        # set forecast start time, apply shading and calculate hourly values and total
         for date in self.keys:
-            for t in [hours_time(t / 2) for t in range(0,48)]:
-                if self.daily[date]['pt30'].get(t) is None:
-                    self.daily[date]['pt30'][t] = 0.0
-                elif self.daily[date].get('from') is None:
-                    self.daily[date]['from'] = t
-        # apply shading
-        if self.shading is not None:
-            for date in self.keys:
-                times = sorted(time_hours(t) for t in self.daily[date]['pt30'].keys())
-                if self.shading.get('adjust') is not None:
-                    loss = self.shading['adjust'] if type(self.shading['adjust']) is not list else self.shading['adjust'][self.quarter]
-                    for t in times:
-                        self.daily[date]['pt30'][hours_time(t)] *= loss
-                if self.shading.get('am_delay') is not None:
-                    delay = self.shading['am_delay'] if type(self.shading['am_delay']) is not list else self.shading['am_delay'][self.quarter]
-                    shaded = time_hours(self.daily[date]['sun'][0]) + delay
-                    loss = self.shading['am_loss']
-                    for t in [t for t in times if t < shaded]:
-                        self.daily[date]['pt30'][hours_time(t)] *= loss
-                if self.shading.get('pm_delay') is not None:
-                    delay = self.shading['pm_delay'] if type(self.shading['pm_delay']) is not list else self.shading['pm_delay'][self.quarter]
-                    shaded = time_hours(self.daily[date]['sun'][1]) - delay
-                    loss = self.shading['pm_loss']
-                    for t in [t for t in times if t > shaded]:
-                        self.daily[date]['pt30'][hours_time(t)] *= loss
-        # calculate hourly values and total
-        for date in self.keys:
-            for t in self.daily[date]['pt30'].keys():
-                value = self.daily[date]['pt30'][t] / 2
-                hour = int(time_hours(t))
-                if self.daily[date]['hourly'].get(hour) is None:
-                    self.daily[date]['hourly'][hour] = 0.0
-                self.daily[date]['hourly'][hour] += value
-                self.daily[date]['kwh'] += value
+            first = [i for i in range(0, 48) if present[date][i]][:1]
+            if len(first) > 0:
+                self.daily[date]['from'] = hours_time(first[0] / 2)
+            forecast_totals(self.daily[date], shading_mask(self.shading, self.daily[date]['sun'], self.quarter) if self.shading is not None else None)
         self.values = [self.daily[date]['kwh'] for date in self.keys]
         self.total = sum(self.values)
         if self.days > 0 :
             self.avg = self.total / self.days
         return
 
+    def stale(self, types, reload):
+        # return a list of (type, rid) that need to be loaded
+        # reload: 0 = only missing data, 1 = data older than max_age (or solcast_max_age) hours, 2 = data not loaded today
+        global solcast_max_age
+        max_age = solcast_max_age if self.max_age is None else self.max_age
+        stale = []
+        for t in types:
+            for rid in self.rids:
+                if self.data.get(t) is None or self.data[t].get(rid) is None:
+                    stale.append((t, rid))
+                    continue
+                fetched = self.data.get('fetched', {}).get(t, {}).get(rid)
+                if fetched is None and self.data.get('date') is not None:
+                    fetched = datetime.strptime(self.data['date'], '%Y-%m-%d').timestamp()
+                if reload == 1 and (fetched is None or time.time() - fetched > max_age * 3600):
+                    stale.append((t, rid))
+                elif reload == 2 and self.data.get('date') != self.today:
+                    stale.append((t, rid))
+        return stale
+
+    def fetch(self, t, rid):
+        # get forecasts or estimated_actuals for a rid, using If-Modified-Since when the data has been loaded before
+        params = {'format' : 'json', 'hours' : 168, 'period' : 'PT30M'}     # always get 168 x 30 min values
+        headers = {}
+        modified = self.data.get('modified', {}).get(t, {}).get(rid)
+        if modified is not None and self.data.get(t, {}).get(rid) is not None:
+            headers['If-Modified-Since'] = modified
+        try:
+            response = requests.get(solcast_url + 'rooftop_sites/' + rid + '/' + t, auth = self.credentials, params = params, headers = headers)
+        except Exception as e:
+            print(f"Solcast: error getting {t} for {rid}: {str(e)}")
+            return None
+        solcast_rate_limit(response)
+        return response
+
+    def fetched(self, t, rid, response):
+        # record when data was loaded and the Last-Modified time from the response
+        for k, v in [('fetched', time.time()), ('modified', response.headers.get('Last-Modified'))]:
+            if self.data.get(k) is None:
+                self.data[k] = {}
+            if self.data[k].get(t) is None:
+                self.data[k][t] = {}
+            self.data[k][t][rid] = v
+        return
+
+    def data_age(self, types):
+        # return the age in hours of the oldest data loaded
+        ages = [time.time() - self.data.get('fetched', {}).get(t, {}).get(rid) for t in types for rid in self.rids
+            if self.data.get('fetched', {}).get(t, {}).get(rid) is not None]
+        return round(max(ages) / 3600, 2) if len(ages) > 0 else None
+
     def __str__(self) :
         # return printable Solcast info
         global debug_setting
@@ -4335,6 +6635,34 @@ solar_api_key = None
 solar_url = "https://api.forecast.solar/"
 solar_save = "solar.txt"
 solar_arrays = None
+solar_max_age = 1       # hours before an array is refreshed when reload = 1
+solar_workers = 4       # number of arrays to load at the same time
+solar_cache = {}        # 30 minute values for each array: {key: (fetched, {date: [48 values]})}
+
+# return the cache key for an array from its settings
+def solar_key(a):
+    settings = [a.get(k) for k in ['lat', 'lon', 'dec', 'az', 'kwp', 'dam', 'inv', 'hor']]
+    return hashlib.md5(json.dumps(settings).encode('utf-8')).hexdigest()[:16]
+
+# return the 30 minute values for each day from a cache entry, only recalculating when the entry changes
+def solar_slots(key, entry):
+    global solar_cache
+    cached = solar_cache.get(key)
+    if cached is not None and cached[0] == entry.get('fetched'):
+        return cached[1]
+    slots = {}
+    watts = entry['result'].get('watts') if entry.get('result') is not None else None
+    if watts is not None:
+        for dt in watts.keys():
+            date = dt[:10]
+            i = int(dt[11:13]) * 2
+            if slots.get(date) is None:
+                slots[date] = [0.0] * 48
+            value = watts[dt] / 1000
+            slots[date][i] += value
+            slots[date][i + 1] += value
+    solar_cache[key] = (entry.get('fetched'), slots)
+    return slots
 
 # configure a solar_array
 def solar_array(name = None, lat=51.1790, lon=-1.8262, dec = 30, az = 0, kwp = 5.0, dam = None, inv = None, hor = None):
@@ -4362,8 +6690,10 @@ class Solar :
     """ 
 
     # get solar forecast and return total expected yield
-    def __init__(self, reload=0, quiet=False, shading=None, d=None):
-        global solar_arrays, solar_save, solar_total, solar_url, solar_api_key, storage
+    def __init__(self, reload=2, quiet=False, shading=None, d=None, max_age=None):
+        # max_age: hours before an array is refreshed when reload = 1. The default is solar_max_age
+        global solar_arrays, solar_save, solar_total, solar_url, solar_api_key, storage, solar_workers
+        self.max_age = max_age
         self.shading = None if shading is None else shading if shading.get('solar') is None else shading['solar'] 
         now = convert_date(d)
         self.today = datetime.strftime(datetime.date(now), '%Y-%m-%d')
@@ -4373,93 +6703,67 @@ class Solar :
         self.arrays = None
         self.results = None
         self.save = solar_save #.replace('.', '_%.'.replace('%',self.today.replace('-','')))
-        if reload == 1 and os.path.exists(storage + self.save):
-            os.remove(storage + self.save)
+        self.cache = {}
         if self.save is not None and os.path.exists(storage + self.save):
             file = open(storage + self.save)
             data = json.load(file)
             file.close()
-            if data.get('date') is not None and (data['date'] == self.today and reload != 1):
-                if debug_setting > 0 and not quiet:
-                    print(f"Using data for {data['date']} from {self.save}")
-                self.results = data['results'] if data.get('results') is not None else None
-                self.arrays = data['arrays'] if data.get('arrays') is not None else None
-        if self.arrays is None or self.results is None:
-            if solar_arrays is None or len(solar_arrays) < 1:
-                print(f"** Solar: you need to add an array using solar_array()")
-                return
-            self.api_key = solar_api_key + '/' if solar_api_key is not None else ''
-            self.arrays = deepcopy(solar_arrays)
-            self.results = {}
-            for name, a in self.arrays.items():
-                if debug_setting > 0 and not quiet:
-                    print(f"Getting data for {name} array")
-                path = f"{a['lat']}/{a['lon']}/{a['dec']}/{a['az']}/{a['kwp']}"
-                params = {'no_sun': 1, 'damping': a['dam'], 'inverter': a['inv'], 'horizon': a['hor']}
-                response = requests.get(solar_url + self.api_key + 'estimate/' + path, params = params)
+            self.cache = data['cache'] if data.get('cache') is not None else {}
+        if solar_arrays is None or len(solar_arrays) < 1:
+            print(f"** Solar: you need to add an array using solar_array()")
+            return
+        self.api_key = solar_api_key + '/' if solar_api_key is not None else ''
+        self.arrays = deepcopy(solar_arrays)
+        keys = {name: solar_key(a) for name, a in self.arrays.items()}
+        stale = [name for name in self.arrays.keys() if self.stale(keys[name], reload)]
+        if len(stale) > 0:
+            if debug_setting > 0 and not quiet:
+                print(f"Getting data for {', '.join(stale)} array{'s' if len(stale) > 1 else ''}")
+            with ThreadPoolExecutor(max_workers=solar_workers) as executor:
+                responses = list(executor.map(lambda name: self.fetch(self.arrays[name]), stale))
+            for name, response in zip(stale, responses):
+                if response is None:
+                    continue
                 if response.status_code != 200:
                     if response.status_code == 429:
                         print(f"\nSolar: forecast.solar API call limit reached for today")
                     else:
                         print(f"** Solar() got response code {response.status_code}: {response.reason}")
+                    continue
+                self.cache[keys[name]] = {'array': self.arrays[name], 'date': self.today, 'fetched': time.time(), 'result': response.json().get('result')}
+                archive_forecast('solar', name, solar_slots(keys[name], self.cache[keys[name]]))
+            for name in self.arrays.keys():
+                if self.cache.get(keys[name]) is None:
                     return
-                self.results[name] = response.json().get('result')
             if self.save is not None :
                 if debug_setting > 0 and not quiet:
                     print(f"Saving data to {self.save}")
+                # only keep entries for current arrays
+                self.cache = {k: self.cache[k] for k in keys.values()}
                 file = open(storage + self.save, 'w')
-                json.dump({'date': self.today, 'arrays': self.arrays, 'results': self.results}, file, indent=4, ensure_ascii= False)
+                json.dump({'date': self.today, 'cache': self.cache}, file, indent=4, ensure_ascii= False)
                 file.close()
+        elif debug_setting > 0 and not quiet:
+            print(f"Using data from {self.save}")
+        self.results = {name: self.cache[keys[name]]['result'] for name in self.arrays.keys()}
+        self.age = round(max([time.time() - self.cache[keys[name]].get('fetched', 0) for name in self.arrays.keys()]) / 3600, 2)
+        # add up the 30 minute values for each array, reusing values for arrays that have not changed
+        slots = {}      # 30 minute values for each day
+        for name in self.arrays.keys():
+            array_slots = solar_slots(keys[name], self.cache[keys[name]])
+            for date in array_slots.keys():
+                if slots.get(date) is None:
+                    slots[date] = [0.0] * 48
+                slots[date] = [x + y for x, y in zip(slots[date], array_slots[date])]
         self.daily = {}
-        for k in self.results.keys():
-            if self.results[k].get('watts') is not None:
-                watts = self.results[k]['watts']
-                for dt in watts.keys():
-                    date = dt[:10]
-                    hour = int(dt[11:13])
-                    if self.daily.get(date) is None:
-                        self.daily[date] = {'hourly': {}, 'pt30': {}, 'kwh': 0.0, 'sun': get_suntimes(date)}
-                    value = watts[dt] / 1000
-                    for t in [hours_time(hour), hours_time(hour + 0.5)]:
-                        if self.daily[date]['pt30'].get(t) is None:
-                            self.daily[date]['pt30'][t] = 0.0
-                        self.daily[date]['pt30'][t] += value
+        for date in slots.keys():
+            self.daily[date] = forecast_day(slots[date], get_suntimes(date))
         self.keys = sorted(self.daily.keys())
         self.days = len(self.keys)
-        # fill out forecast to cover 24 hours
-        for date in self.keys:
-            for t in [hours_time(t / 2) for t in range(0,48)]:
-                if self.daily[date]['pt30'].get(t) is None:
-                    self.daily[date]['pt30'][t] = 0.0
-        # apply shading
-        if self.shading is not None and self.shading.get('solar') is not None:
-            for date in self.keys:
-                times = sorted(time_hours(t) for t in self.daily[date]['pt30'].keys())
-                if self.shading.get('adjust') is not None:
-                    loss = self.shading['adjust'] if type(self.shading['adjust']) is not list else self.shading['adjust'][self.quarter]
-                    for t in times:
-                        self.daily[date]['pt30'][hours_time(t)] *= loss
-                if self.shading.get('am_delay') is not None:
-                    delay = self.shading['am_delay'] if type(self.shading['am_delay']) is not list else self.shading['am_delay'][self.quarter]
-                    shaded = time_hours(self.daily[date]['sun'][0]) + delay
-                    loss = self.shading['am_loss']
-                    for t in [t for t in times if t < shaded]:
-                        self.daily[date]['pt30'][hours_time(t)] *= loss
-                if self.shading.get('pm_delay') is not None:
-                    delay = self.shading['pm_delay'] if type(self.shading['pm_delay']) is not list else self.shading['pm_delay'][self.quarter]
-                    shaded = time_hours(self.daily[date]['sun'][1]) - delay
-                    loss = self.shading['pm_loss']
-                    for t in [t for t in times if t > shaded]:
-                        self.daily[date]['pt30'][hours_time(t)] *= loss
-        # calculate hourly values and total
+        # apply shading and calculate hourly values and total
+        shading = self.shading is not None and self.shading.get('solar') is not None
         for date in self.keys:
-            for t in self.daily[date]['pt30'].keys():
-                value = self.daily[date]['pt30'][t] / 2
-                hour = int(time_hours(t))
-                if self.daily[date]['hourly'].get(hour) is None:
-                    self.daily[date]['hourly'][hour] = 0.0
-                self.daily[date]['hourly'][hour] += value
-                self.daily[date]['kwh'] += value
+            forecast_totals(self.daily[date], shading_mask(self.shading, self.daily[date]['sun'], self.quarter) if shading else None)
         self.values = [self.daily[date]['kwh'] for date in self.keys]
         self.total = sum(self.values)
         if self.days > 0 :
@@ -4467,6 +6771,29 @@ class Solar :
         return
 
 
+    def stale(self, key, reload):
+        # True if an array needs to be loaded
+        # reload: 0 = use saved data, 1 = load data older than max_age (or solar_max_age) hours, 2 = use data loaded today
+        global solar_max_age
+        max_age = solar_max_age if self.max_age is None else self.max_age
+        entry = self.cache.get(key)
+        if entry is None or entry.get('result') is None:
+            return True
+        if reload == 1:
+            return time.time() - entry.get('fetched', 0) > max_age * 3600
+        return reload == 2 and entry.get('date') != self.today
+
+    def fetch(self, a):
+        # get the forecast for an array
+        path = f"{a['lat']}/{a['lon']}/{a['dec']}/{a['az']}/{a['kwp']}"
+        params = {'no_sun': 1, 'damping': a['dam'], 'inverter': a['inv'], 'horizon': a['hor']}
+        try:
+            response = requests.get(solar_url + self.api_key + 'estimate/' + path, params = params)
+        except Exception as e:
+            print(f"** Solar() error getting forecast: {str(e)}")
+            return None
+        return response
+
     def __str__(self) :
         # return printable Solar info
         global debug_setting
@@ -4646,6 +6973,294 @@ class Solar :
         return
 
 
+##################################################################################################
+# Forecast cache - serve the latest forecast and refresh in the background
+##################################################################################################
+# source: 'solcast' or 'solar'
+# day: the date that must be in the forecast. Saved data without this date is reloaded
+# reload: 2 = use cached / saved data and load new data when older than forecast_ttl,
+#   0 = use saved data, 1 = load new data
+# only rooftops / arrays older than forecast_ttl are loaded again and Solcast calls are limited to
+#   solcast_daily_limit each day, so repeated runs from cron do not use up the API quota
+# forecast_background = 1 is for long running processes: stale data is returned straight away and
+#   refreshed in the background. Otherwise stale data is reloaded before returning, so scripts run
+#   from cron plan with a current forecast
+##################################################################################################
+
+forecast_ttl = 2            # hours before a forecast is refreshed
+forecast_background = 0     # 1 = refresh stale forecasts in the background (long running process)
+forecast_cache = {}         # latest forecast for each source: {'forecast', 'shading', 'refreshing'}
+forecast_lock = threading.Lock()
+
+# load a forecast and return it or None if the forecast is not available
+def forecast_load(source, reload, shading=None, d=None, max_age=None):
+    fc = Solcast(quiet=True, reload=reload, shading=shading, d=d, max_age=max_age) if source == 'solcast' else Solar(quiet=True, reload=reload, shading=shading, d=d, max_age=max_age)
+    return fc if hasattr(fc, 'daily') else None
+
+# save a forecast in the cache
+def forecast_store(source, fc, shading):
+    global forecast_cache, forecast_lock
+    with forecast_lock:
+        entry = forecast_cache.get(source)
+        forecast_cache[source] = {'forecast': fc, 'shading': shading, 'refreshing': entry['refreshing'] if entry is not None else False}
+    return
+
+# refresh a forecast in the background. Returns the thread or None if a refresh is already running
+def forecast_refresh(source, shading=None, d=None):
+    global forecast_cache, forecast_lock, forecast_ttl
+    with forecast_lock:
+        entry = forecast_cache.get(source)
+        if entry is not None and entry['refreshing']:
+            return None
+        if entry is None:
+            entry = {'forecast': None, 'shading': shading, 'refreshing': False}
+            forecast_cache[source] = entry
+        entry['refreshing'] = True
+    def refresh():
+        try:
+            fc = forecast_load(source, 1, shading, d, forecast_ttl)
+            if fc is not None:
+                forecast_store(source, fc, shading)
+        except Exception as e:
+            output(f"** forecast_refresh(): {source} {str(e)}", 1)
+        finally:
+            with forecast_lock:
+                forecast_cache[source]['refreshing'] = False
+        return
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    return thread
+
+# True if a forecast should be refreshed in preparation for the next forecast time
+def forecast_due(forecast_times, hour):
+    return forecast_times is not None and (hour + 1) % 24 in forecast_times
+
+# return the latest forecast for a source, refreshing it when it is older than forecast_ttl
+def get_forecast(source, day=None, reload=2, shading=None, d=None):
+    global forecast_cache, forecast_ttl, forecast_background
+    if reload != 2:
+        fc = forecast_load(source, reload, shading, d)
+        if fc is not None:
+            forecast_store(source, fc, shading)
+        return fc
+    entry = forecast_cache.get(source)
+    fc = entry['forecast'] if entry is not None and entry['shading'] == shading else None
+    for r in [0, 2]:
+        if fc is None or (day is not None and fc.daily.get(day) is None):
+            fc = forecast_load(source, r, shading, d)
+    if fc is None:
+        return None
+    forecast_store(source, fc, shading)
+    if fc.age is None or fc.age > forecast_ttl:
+        if forecast_background == 1:
+            forecast_refresh(source, shading, d)
+            return fc
+        new_fc = forecast_load(source, 1, shading, d, forecast_ttl)
+        if new_fc is not None and (day is None or new_fc.daily.get(day) is not None):
+            forecast_store(source, new_fc, shading)
+            fc = new_fc
+    return fc
+
+
+##################################################################################################
+# Forecast archive and backtest
+##################################################################################################
+# every forecast loaded is added to a monthly archive file. Each line holds the source, the rooftop
+# or array, when the forecast was loaded and the 30 minute values (kW) for one day.
+# forecast_backtest() compares the archived forecasts with actual generation from pvPower and
+# meterPower2 and reports the errors by days ahead (horizon) and by season. The generation history
+# fallback used by charge_needed() is included as the 'history' source.
+##################################################################################################
+
+forecast_archive = 'forecast ###.txt'   # archive file, ### is replaced by the month YYYY-MM. None to disable
+backtest_workers = 4                    # number of months to process at the same time
+archive_lock = threading.Lock()
+
+# add a forecast to the archive. slots is a dictionary of {date: [48 values]}
+def archive_forecast(source, name, slots, utc=0):
+    global forecast_archive, storage, archive_lock
+    if forecast_archive is None or slots is None:
+        return
+    fetched = datetime.now().strftime('%Y-%m-%d %H:%M')
+    lines = {}
+    for date in sorted(slots.keys()):
+        values = [round(v, 3) if v is not None else None for v in slots[date]]
+        month = date[:7]
+        if lines.get(month) is None:
+            lines[month] = []
+        lines[month].append(json.dumps({'s': source, 'id': name, 'f': fetched, 'd': date, 'utc': utc, 'v': values}, separators=(',', ':')))
+    with archive_lock:
+        for month in lines.keys():
+            file = open(storage + forecast_archive.replace('###', month), 'a')
+            file.write('\n'.join(lines[month]) + '\n')
+            file.close()
+    return
+
+# load archived forecasts for a month: returns {(source, date, horizon): [48 values]}
+# the latest forecast from each rooftop / array for each horizon is used and rooftops / arrays are added together
+def load_archive(month):
+    global forecast_archive, storage
+    file_name = storage + forecast_archive.replace('###', month)
+    if not os.path.exists(file_name):
+        return {}
+    latest = {}
+    file = open(file_name)
+    for line in file:
+        if len(line.strip()) == 0:
+            continue
+        x = json.loads(line)
+        horizon = (datetime.strptime(x['d'], '%Y-%m-%d') - datetime.strptime(x['f'][:10], '%Y-%m-%d')).days
+        if horizon < 0:
+            continue
+        values = x['v']
+        if x.get('utc') == 1:
+            # shift UTC slots to local time
+            shift = int(daylight_saving(x['d']) * 2)
+            values = [values[i - shift] if i - shift >= 0 and i - shift < 48 else None for i in range(0, 48)]
+        key = (x['s'], x['d'], horizon, x['id'])
+        if latest.get(key) is None or latest[key][0] <= x['f']:
+            latest[key] = (x['f'], values)
+    file.close()
+    forecasts = {}
+    for (source, date, horizon, name), (fetched, values) in latest.items():
+        key = (source, date, horizon)
+        if forecasts.get(key) is None:
+            forecasts[key] = values
+        else:
+            forecasts[key] = [a + b if a is not None and b is not None else None for a, b in zip(forecasts[key], values)]
+    return forecasts
+
+# return actual generation (kW) for each 30 minute slot of a day, or None if there is no data
+def actual_generation(date):
+    global ct2_calibration
+    result = get_history('day', d=date, v=['pvPower', 'meterPower2'], summary=0)
+    if result is None:
+        return None
+    slots = {var['variable']: rescale_history(var.get('data'), 2) for var in result}
+    pv = slots.get('pvPower')
+    ct2 = slots.get('meterPower2')
+    if pv is None:
+        return None
+    return [(p + (c / ct2_calibration if c is not None and c > 0.0 else 0.0)) if p is not None else None
+        for p, c in zip(pv, ct2 if ct2 is not None else [None] * 48)]
+
+# return empty error totals
+def backtest_totals():
+    return {'days': 0, 'slots': 0, 'abs': 0.0, 'square': 0.0, 'bias': 0.0, 'kwh_abs': 0.0, 'kwh_actual': 0.0}
+
+# add the errors for a day to the totals
+def backtest_add(totals, forecast, actual):
+    pairs = [(f, a) for f, a in zip(forecast, actual) if f is not None and a is not None]
+    if len(pairs) == 0:
+        return
+    totals['days'] += 1
+    totals['slots'] += len(pairs)
+    for f, a in pairs:
+        totals['abs'] += abs(f - a)
+        totals['square'] += (f - a) ** 2
+        totals['bias'] += f - a
+    totals['kwh_abs'] += abs(sum(f for f, a in pairs) - sum(a for f, a in pairs)) / 2
+    totals['kwh_actual'] += sum(a for f, a in pairs) / 2
+    return
+
+# return error metrics from totals
+def backtest_metrics(totals):
+    n = totals['slots']
+    if n == 0:
+        return None
+    return {'days': totals['days'], 'mae': round(totals['abs'] / n, 3), 'rmse': round(math.sqrt(totals['square'] / n), 3), 'bias': round(totals['bias'] / n, 3),
+        'kwh_error': round(totals['kwh_abs'] / totals['days'], 2), 'kwh_pct': round(100 * totals['kwh_abs'] / totals['kwh_actual'], 1) if totals['kwh_actual'] > 0 else None}
+
+# backtest the dates from start to end (YYYY-MM-DD, both included) in a month
+# returns {source: {'horizon': {h: totals}, 'season': {name: totals}, 'all': totals}}
+def backtest_month(month, start, end, sources):
+    global seasonal_sun, charge_config
+    forecasts = load_archive(month)
+    first = max(start, month + '-01')
+    dates = sorted(set(k[1] for k in forecasts.keys() if k[1] >= first and k[1] <= end))
+    if 'history' in sources and len(forecasts) == 0:
+        dates = [d for d in date_list(s=first, e=end, limit=31) if d[:7] == month]
+    actuals = {}
+    totals = {}
+    gen_days = charge_config['generation_days']
+    for date in dates:
+        if actuals.get(date) is None:
+            actuals[date] = actual_generation(date)
+        actual = actuals[date]
+        if actual is None:
+            continue
+        quarter = int(date[5:7]) // 3 % 4
+        season = seasonal_sun[quarter]['name']
+        day_forecasts = [(k[0], k[2], v) for k, v in forecasts.items() if k[1] == date and k[0] in sources]
+        if 'history' in sources:
+            # average generation of previous days spread using the seasonal sun profile, as used by charge_needed()
+            previous = date_list(e=date, span='week', today=1)[-gen_days - 1:-1]
+            kwh = []
+            for d in previous:
+                if actuals.get(d) is None:
+                    actuals[d] = actual_generation(d)
+                if actuals[d] is not None:
+                    kwh.append(sum(v for v in actuals[d] if v is not None) / 2)
+            if len(kwh) > 0:
+                sun = seasonal_sun[quarter]['sun']
+                expected = sum(kwh) / len(kwh)
+                day_forecasts.append(('history', 1, [expected * sun[i // 2] / sum(sun) for i in range(0, 48)]))
+        for source, horizon, values in day_forecasts:
+            if totals.get(source) is None:
+                totals[source] = {'horizon': {}, 'season': {}, 'all': backtest_totals()}
+            for group, key in [('horizon', horizon), ('season', season)]:
+                if totals[source][group].get(key) is None:
+                    totals[source][group][key] = backtest_totals()
+                backtest_add(totals[source][group][key], values, actual)
+            backtest_add(totals[source]['all'], values, actual)
+    return totals
+
+# compare archived forecasts with actual generation for the days from s to e (YYYY-MM-DD, both included)
+def forecast_backtest(s=None, e=None, sources=None, show=1):
+    global backtest_workers
+    if sources is None:
+        sources = ['solcast', 'solar', 'history']
+    end = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    e = end if e is None or e > end else e
+    s = datetime.strftime(datetime.strptime(e, '%Y-%m-%d') - timedelta(days=90), '%Y-%m-%d') if s is None else s
+    months = []
+    m = s[:7]
+    while m <= e[:7]:
+        months.append(m)
+        m = f"{int(m[:4]) + 1}-01" if m[5:7] == '12' else f"{m[:4]}-{int(m[5:7]) + 1:02d}"
+    with ThreadPoolExecutor(max_workers=backtest_workers) as executor:
+        month_totals = list(executor.map(lambda m: backtest_month(m, s, e, sources), months))
+    # merge totals for each month
+    totals = {}
+    for month in month_totals:
+        for source in month.keys():
+            if totals.get(source) is None:
+                totals[source] = {'horizon': {}, 'season': {}, 'all': backtest_totals()}
+            for group in ['horizon', 'season']:
+                for key, x in month[source][group].items():
+                    if totals[source][group].get(key) is None:
+                        totals[source][group][key] = backtest_totals()
+                    for k in x.keys():
+                        totals[source][group][key][k] += x[k]
+            for k in month[source]['all'].keys():
+                totals[source]['all'][k] += month[source]['all'][k]
+    result = {}
+    for source in totals.keys():
+        result[source] = {'all': backtest_metrics(totals[source]['all']),
+            'horizon': {h: backtest_metrics(totals[source]['horizon'][h]) for h in sorted(totals[source]['horizon'].keys())},
+            'season': {n: backtest_metrics(totals[source]['season'][n]) for n in totals[source]['season'].keys()}}
+    if show > 0:
+        print(f"\nForecast backtest from {s} to {e}:")
+        print(f"  {'source':<8} {'group':<10} {'days':>5} {'mae':>7} {'rmse':>7} {'bias':>7} {'kWh err':>8} {'%':>6}")
+        for source in result.keys():
+            rows = [('all', result[source]['all'])] + [(f"{h} day", x) for h, x in result[source]['horizon'].items()] + list(result[source]['season'].items())
+            for name, x in rows:
+                if x is not None:
+                    pct = f"{x['kwh_pct']:5.1f}%" if x['kwh_pct'] is not None else ''
+                    print(f"  {source:<8} {name:<10} {x['days']:>5} {x['mae']:7.3f} {x['rmse']:7.3f} {x['bias']:7.3f} {x['kwh_error']:8.2f} {pct:>6}")
+    return result
+
+
 ##################################################################################################
 ##################################################################################################
 # Pushover API